@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from helpers.api_executor import DEFAULT_MAX_WORKERS, ApiExecutor
+from helpers.email_database import connect_database, upsert_emails
+from helpers.fake_gmail import FakeGmailService, FakeMailbox
+from helpers.label_store import LabelStore
+from fetch_emails import DEFAULT_BATCH_SIZE, METADATA_HEADERS, email_row, iter_messages, save_emails_batched
+from process_emails import DEFAULT_CHUNK_SIZE, EmailProcessor, RuleProcessor
+
+DEFAULT_MESSAGES = 10000
+# A benchmark regresses when it gets this much slower, or makes this many more API calls per email, than its baseline
+DEFAULT_TOLERANCE = 0.2
+SEED_CHUNK_SIZE = 10000
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None where the resource module is missing."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+def seed_database(mailbox):
+    """Writes every message of the mailbox and its labels to the email database, without going through the API."""
+    conn = connect_database()
+    label_store = LabelStore(conn)
+    for start in range(0, mailbox.message_count, SEED_CHUNK_SIZE):
+        indexes = range(start, min(start + SEED_CHUNK_SIZE, mailbox.message_count))
+        rows = [email_row(mailbox.message_id(index), mailbox.message(index, 'metadata', METADATA_HEADERS))
+                for index in indexes]
+        upsert_emails(conn, rows)
+        label_store.set_labels_many((mailbox.message_id(index), mailbox.label_ids(index)) for index in indexes)
+        conn.commit()
+    conn.close()
+
+def load_json(path):
+    """Loads a rules or results JSON file."""
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def benchmark_save_emails(service, executor, options):
+    """Lists the whole inbox and saves every email, like a full sync of fetch_emails.py."""
+    saved_count, _ = save_emails_batched(service, iter_messages(service, label_ids=['INBOX'], executor=executor),
+                                         batch_size=options.batch_size, executor=executor)
+    return saved_count
+
+def benchmark_apply_rules(service, executor, options):
+    """Calls RuleProcessor.apply_rules on every email, with the emails already loaded in memory."""
+    conn = connect_database()
+    rule_processor = RuleProcessor(service, LabelStore(conn), rules=options.rules, executor=executor)
+    emails = list(EmailProcessor(rule_processor, load_emails=False, chunk_size=options.chunk_size).iter_emails())
+    start = time.perf_counter()
+    for email in emails:
+        rule_processor.apply_rules(email)
+    conn.close()
+    return len(emails), time.perf_counter() - start
+
+def benchmark_process_emails(service, executor, options):
+    """Runs EmailProcessor over the email database in the process mode given by options.mode."""
+    conn = connect_database()
+    rule_processor = RuleProcessor(service, LabelStore(conn), rules=options.rules, executor=executor)
+    email_processor = EmailProcessor(rule_processor, load_emails=False, chunk_size=options.chunk_size,
+                                     progress_interval=options.messages + 1)
+    if options.mode == 'immediate':
+        email_processor.process_emails()
+    elif options.mode == 'plan':
+        email_processor.process_emails_planned()
+    else:
+        email_processor.process_emails_in_database()
+    conn.close()
+    return options.messages
+
+# Benchmark name -> (function, needs the email database seeded with the mailbox)
+BENCHMARKS = {
+    'save_emails': (benchmark_save_emails, False),
+    'apply_rules': (benchmark_apply_rules, True),
+    'process_emails': (benchmark_process_emails, True),
+}
+
+def measure(name, options):
+    """Runs one benchmark against a fresh fake mailbox in the current directory and returns its results.
+
+    A benchmark function returns the number of emails it handled, or a tuple of (emails, seconds) when
+    only part of its run should be timed.
+    """
+    function, seeded = BENCHMARKS[name]
+    mailbox = FakeMailbox(options.messages, seed=options.seed)
+    if seeded:
+        seed_database(mailbox)
+    service = FakeGmailService(mailbox, latency=options.latency, error_rate=options.error_rate, seed=options.seed)
+    executor = ApiExecutor(lambda: service, max_workers=options.concurrency, quota_per_second=None,
+                           backoff_base=options.backoff_base)
+
+    start = time.perf_counter()
+    result = function(service, executor, options)
+    seconds = time.perf_counter() - start
+    executor.shutdown()
+    emails, seconds = result if isinstance(result, tuple) else (result, seconds)
+
+    return {
+        'benchmark': name,
+        'emails': emails,
+        'seconds': round(seconds, 3),
+        'emails_per_second': round(emails / seconds, 1) if seconds else None,
+        'api_calls': service.api_calls(),
+        'api_calls_per_email': round(service.api_calls() / emails, 4) if emails else None,
+        'http_requests': service.http_requests,
+        'errors': service.errors,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def measure_in_temp_dir(name, options):
+    """Runs measure inside a new temporary directory, so every benchmark starts with an empty email database."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        return measure(name, options)
+
+def run_benchmark(name, options):
+    """Runs one benchmark in a fresh worker process, so its peak RSS isn't inflated by earlier benchmarks."""
+    with ProcessPoolExecutor(max_workers=1) as process_pool:
+        return process_pool.submit(measure_in_temp_dir, name, options).result()
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compares results against baseline results and returns a description of each regression found."""
+    baseline = {result['benchmark']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['benchmark'])
+        if previous is None:
+            continue
+        if previous['emails_per_second'] and result['emails_per_second'] < previous['emails_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['benchmark']}: {result['emails_per_second']} emails/s, "
+                               f"baseline {previous['emails_per_second']} emails/s")
+        if previous['api_calls_per_email'] is not None and \
+                result['api_calls_per_email'] > previous['api_calls_per_email'] * (1 + tolerance):
+            regressions.append(f"{result['benchmark']}: {result['api_calls_per_email']} API calls per email, "
+                               f"baseline {previous['api_calls_per_email']}")
+    return regressions
+
+def parse_args(argv=None):
+    """Parses command line options of the benchmark.py script."""
+    arg_parser = argparse.ArgumentParser(description='Benchmark fetching and processing emails against a fake gmail service.')
+    arg_parser.add_argument('--benchmark', action='append', dest='benchmarks', choices=list(BENCHMARKS),
+                            help='Benchmark to run, can be repeated. Runs all of them by default.')
+    arg_parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES, help='Messages in the synthetic mailbox.')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='Seconds every HTTP request to the fake gmail takes.')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of API calls failing with a rate limit error.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic mailbox and injected errors.')
+    arg_parser.add_argument('--rules', default='rules.json', help='Rules file used by the rule benchmarks.')
+    arg_parser.add_argument('--mode', choices=['query', 'plan', 'immediate'], default='query',
+                            help='Process mode of the process_emails benchmark, see process_emails.py.')
+    arg_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Messages fetched per batch request.')
+    arg_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Emails read from the database at a time.')
+    arg_parser.add_argument('--concurrency', type=int, default=DEFAULT_MAX_WORKERS, help='Gmail API calls run at once.')
+    arg_parser.add_argument('--backoff-base', type=float, default=0.01, help='Seconds of the first retry backoff.')
+    arg_parser.add_argument('--output', help='Write the results to this JSON file.')
+    arg_parser.add_argument('--baseline', help='Results JSON file to compare against. Regressions exit with status 1.')
+    arg_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                            help='Allowed slow down and API call increase relative to the baseline.')
+    args = arg_parser.parse_args(argv)
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    args.rules = load_json(args.rules)
+    return args
+
+if __name__ == '__main__':
+    print("!!!!! SCRIPT STARTED - benchmark.py")
+    args = parse_args()
+    results = []
+    for name in args.benchmarks:
+        print(f"===== Running {name} on {args.messages} messages")
+        result = run_benchmark(name, args)
+        results.append(result)
+        print(f"===== {name}: {result['emails']} emails in {result['seconds']}s, {result['emails_per_second']} emails/s, "
+              f"{result['api_calls_per_email']} API calls per email, {result['http_requests']} HTTP requests, "
+              f"peak RSS {result['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+    regressions = find_regressions(results, load_json(args.baseline), args.tolerance) if args.baseline else []
+    for regression in regressions:
+        print(f"===== Regression - {regression}")
+    print("!!!!! SCRIPT COMPLETED - benchmark.py")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import queue
+import threading
+from helpers.api_executor import DEFAULT_BATCH_SIZE, ApiExecutor, is_retryable
+from helpers.arguments import (api_arguments, batch_arguments, metrics_arguments, raw_arguments, rule_arguments,
+                              rule_options)
+from helpers.email_database import connect_database
+from helpers.gmail_helper import GmailHelper
+from helpers.metrics import NULL_METRICS, Metrics
+from fetch_emails import sync_emails
+from process_emails import open_processors
+
+DEFAULT_POLL_INTERVAL = 5.0
+# Emails saved but not processed yet. When processing falls behind, ingest waits instead of piling them up in memory
+DEFAULT_QUEUE_SIZE = 1000
+# Emails planned together, so their label changes still go out in bulk batchModify calls
+DEFAULT_MAX_BATCH = 500
+# Seconds the processing thread waits for an email before checking the rules file again
+QUEUE_TIMEOUT = 1.0
+
+class RulesWatcher:
+    """Loads a rules file again whenever it changes on disk."""
+    def __init__(self, path='rules.json'):
+        """Initializes RulesWatcher object."""
+        self.path = path
+        self.version = None
+
+    def poll(self):
+        """Returns the rules if the file changed since the last call, and on the first call. Returns None otherwise.
+
+        Raises OSError when the file can't be read and ValueError when it isn't valid JSON. Either way the change
+        counts as seen, so the file is only loaded again once it changes again.
+        """
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return None
+        self.version = version
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+class EmailDaemon:
+    """Keeps the email database in sync with a gmail label and applies the rules to new emails within seconds.
+
+    An ingest thread polls gmail history every poll_interval seconds and passes each saved batch of emails to
+    the processing thread over a bounded queue. The rules file is reloaded when it changes, without a restart.
+    The gmail services of the executor and the database connections stay open for the life of the daemon.
+    """
+    def __init__(self, service, executor, rules_watcher, label='INBOX', batch_size=DEFAULT_BATCH_SIZE,
+                 poll_interval=DEFAULT_POLL_INTERVAL, queue_size=DEFAULT_QUEUE_SIZE, max_batch=DEFAULT_MAX_BATCH,
+                 rule_options=None, metrics=None, metrics_json=None, metrics_prometheus=None, raw=False):
+        """Initializes EmailDaemon object.
+
+        rule_options are passed on to RuleProcessor, e.g. {'ignore_case': True}. With metrics_json or
+        metrics_prometheus, metrics are written after every processed batch of emails. raw ingests whole
+        messages, bodies included, for rules with body conditions.
+        """
+        self.service = service
+        self.executor = executor
+        self.rules_watcher = rules_watcher
+        self.label = label
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_batch = max_batch
+        self.rule_options = rule_options or {}
+        self.metrics = metrics or NULL_METRICS
+        self.metrics_json = metrics_json
+        self.metrics_prometheus = metrics_prometheus
+        self.raw = raw
+        self.email_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.ingest_error = None
+        self.conn = None
+
+    def run(self):
+        """Runs the daemon until stop is called or ingest fails, processing emails in the calling thread.
+
+        Emails already in the database that some rule is not done with are processed first.
+        Raises the error ingest failed with, if any.
+        """
+        print(f"===== Starting daemon on {self.label}, polling every {self.poll_interval}s")
+        self.open()
+        ingest_thread = threading.Thread(target=self.ingest_loop, name='ingest', daemon=True)
+        ingest_thread.start()
+        try:
+            while not self.stop_event.is_set():
+                self.process_queued()
+        finally:
+            self.stop_event.set()
+            ingest_thread.join()
+            self.close()
+        if self.ingest_error:
+            raise self.ingest_error
+
+    def stop(self):
+        """Asks the daemon to stop. Emails saved but not processed yet are picked up on the next start."""
+        self.stop_event.set()
+
+    def open(self):
+        """Opens the processing connection, loads the rules and processes the emails they are not done with yet."""
+        self.conn, self.rule_processor, self.email_processor = open_processors(
+            self.service, rules=self.rules_watcher.poll(), executor=self.executor, metrics=self.metrics,
+            **self.rule_options)
+        self.ledger = self.rule_processor.ledger
+        self.email_processor.process_emails_in_database()
+
+    def close(self):
+        """Closes the processing connection."""
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def ingest_loop(self):
+        """Ingest thread. Syncs the label every poll_interval seconds on its own connection until the daemon stops.
+
+        Gmail errors still failing after the executor's retries, e.g. a dropped connection, are reported and the
+        sync runs again on the next poll. Other errors, e.g. a revoked authorization, stop the daemon.
+        """
+        conn = connect_database()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.ingest(conn)
+                except Exception as error:
+                    if not is_retryable(error):
+                        raise
+                    # The history id only moves on after a successful sync, so the next poll picks up the same changes
+                    conn.rollback()
+                    self.metrics.increment('ingest_errors_total')
+                    print(f"===== Sync failed, trying again in {self.poll_interval}s: {error}")
+                self.stop_event.wait(self.poll_interval)
+        except BaseException as error:
+            self.ingest_error = error
+            self.stop_event.set()
+        finally:
+            conn.close()
+
+    def ingest(self, conn):
+        """Saves the emails added to the label since the last sync and queues them for processing.
+
+        Returns the number of emails saved.
+        """
+        return sync_emails(self.service, label=self.label, batch_size=self.batch_size, executor=self.executor,
+                           conn=conn, on_saved=self.enqueue, raw=self.raw, metrics=self.metrics)
+
+    def enqueue(self, rows):
+        """Queues saved emails table rows for processing, waiting while the queue is full."""
+        for row in rows:
+            while not self.stop_event.is_set():
+                try:
+                    self.email_queue.put(row, timeout=QUEUE_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+
+    def process_queued(self, timeout=QUEUE_TIMEOUT):
+        """Reloads the rules if they changed, then applies them to up to max_batch queued emails.
+
+        Waits up to timeout seconds for an email to arrive. Returns the number of emails processed.
+        """
+        self.reload_rules()
+        try:
+            emails = [self.email_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return 0
+        while len(emails) < self.max_batch:
+            try:
+                emails.append(self.email_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        rule_processor = self.rule_processor
+        if any(compiled_rule.time_dependent for compiled_rule in rule_processor.compiled_rules):
+            # Date conditions count from the time the rules were compiled, which has to keep up with a long run
+            rule_processor.set_rules(rule_processor.rules)
+        plan = {}
+        with self.metrics.timer('stage_seconds', stage='plan'):
+            rule_processor.load_bodies([email[0] for email in emails])
+            for email in emails:
+                rule_processor.plan_rules(email, plan)
+        with self.metrics.timer('stage_seconds', stage='apply'):
+            rule_processor.apply_plan(plan)
+        rule_processor.commit()
+        self.metrics.increment('emails_processed_total', len(emails))
+        print(f"===== Processed {len(emails)} new emails, changed labels of {sum(len(ids) for ids in plan.values())}")
+        self.metrics.export(self.metrics_json, self.metrics_prometheus)
+        return len(emails)
+
+    def reload_rules(self):
+        """Switches to the rules in the rules file if it changed, and applies them to the emails in the database.
+
+        Rules that fail to load or validate are reported and the current rules are kept. Returns True if the rules changed.
+        """
+        try:
+            rules = self.rules_watcher.poll()
+            if rules is None:
+                return False
+            self.rule_processor.set_rules(rules)
+        except (OSError, ValueError) as error:
+            print(f"===== Keeping the current rules, {self.rules_watcher.path} couldn't be loaded: {error}")
+            return False
+
+        print(f"===== Reloaded {len(rules)} rules from {self.rules_watcher.path}")
+        self.ledger.prune(self.rule_processor.rule_hashes)
+        self.ledger.commit()
+        # New and edited rules apply to every email, like after a restart. Rules the ledger has are skipped
+        self.email_processor.process_emails_in_database()
+        return True
+
+def parse_args():
+    """Parses command line options of the daemon.py script."""
+    arg_parser = argparse.ArgumentParser(description='Fetch new emails from gmail and apply rules.json to them as they arrive.',
+                                         parents=[api_arguments(), batch_arguments(), raw_arguments(), rule_arguments(),
+                                                  metrics_arguments()])
+    arg_parser.add_argument('--label', default='INBOX', help='Label id to watch. Defaults to INBOX.')
+    arg_parser.add_argument('--rules', default='rules.json', help='Rules file, reloaded whenever it changes.')
+    arg_parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                            help='Seconds between checks of gmail for new emails.')
+    arg_parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                            help='Emails saved but not processed yet before fetching waits for processing.')
+    arg_parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                            help='Queued emails whose label changes are applied together.')
+    return arg_parser.parse_args()
+
+if __name__ == '__main__':
+    print("!!!!! SCRIPT STARTED - daemon.py")
+    args = parse_args()
+    gmail_helper_instance = GmailHelper()
+    service = gmail_helper_instance.authenticate_gmail()
+
+    metrics = Metrics() if args.metrics_json or args.metrics_prometheus else NULL_METRICS
+    executor = ApiExecutor(gmail_helper_instance.build_service, max_workers=args.concurrency,
+                           quota_per_second=args.quota or None, metrics=metrics)
+    daemon = EmailDaemon(service, executor, RulesWatcher(args.rules), label=args.label, batch_size=args.batch_size,
+                         poll_interval=args.poll_interval, queue_size=args.queue_size, max_batch=args.max_batch,
+                         rule_options=rule_options(args),
+                         metrics=metrics, metrics_json=args.metrics_json, metrics_prometheus=args.metrics_prometheus,
+                         raw=args.raw)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        print("===== Stopping daemon")
+    finally:
+        executor.shutdown()
+    print("!!!!! SCRIPT COMPLETED - daemon.py")
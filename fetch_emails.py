@@ -1,43 +1,409 @@
-import sqlite3
+import argparse
+import base64
+import json
+from collections import deque
+from email import policy
+from email.parser import BytesParser
+from itertools import islice
+from helpers.api_executor import (DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE, QUOTA_UNITS, ApiExecutor, RetryableError,
+                                  is_retryable)
+from helpers.arguments import api_arguments, batch_arguments, metrics_arguments, raw_arguments
+from helpers.body_store import BodyStore
+from helpers.email_database import CREATE_SYNC_STATE_TABLE, connect_database, parse_date_epoch, upsert_emails
 from helpers.gmail_helper import GmailHelper
+from helpers.label_store import LabelStore
+from helpers.metrics import NULL_METRICS, Metrics
+from helpers.rule_ledger import RuleLedger
+
+# Headers requested with format=metadata, gmail then skips downloading the message body.
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date', 'Cc', 'List-Id']
+# Gmail returns at most 500 message ids per messages().list page.
+DEFAULT_PAGE_SIZE = 500
+# Saved emails between progress lines
+PROGRESS_INTERVAL = 1000
 
 def fetch_emails(service, folder):
-    """Fetch emails from Gmail."""
-    print("===== Fetching emails from gmail")
-    results = service.users().messages().list(userId='me', labelIds=[folder]).execute()
-    messages = results.get('messages', [])
-    return messages
+    """Fetch emails from Gmail. Returns the references of every message in the folder, see iter_messages."""
+    return list(iter_messages(service, label_ids=[folder]))
+
+def iter_messages(service, label_ids=None, query=None, max_results=DEFAULT_PAGE_SIZE, limit=None, executor=None):
+    """Lazily yields message references ({'id': ..., 'threadId': ...}) from gmail, walking every result page.
+
+    Only one page of ids is held in memory at a time. label_ids and query (gmail search syntax, sent as q=)
+    filter the listing, limit stops after that many messages in total. Calls go through executor when given.
+    """
+    executor = executor or ApiExecutor.for_service(service)
+    if not 1 <= max_results <= DEFAULT_PAGE_SIZE:
+        raise ValueError(f"{max_results} - Invalid page size. Use a value between 1 and {DEFAULT_PAGE_SIZE}.")
+
+    print("===== Listing emails from gmail")
+    page_token = None
+    yielded = 0
+    while limit is None or yielded < limit:
+        params = {'userId': 'me', 'maxResults': max_results if limit is None else min(max_results, limit - yielded)}
+        if label_ids:
+            params['labelIds'] = label_ids
+        if query:
+            params['q'] = query
+        if page_token:
+            params['pageToken'] = page_token
+
+        results = executor.execute(lambda service: service.users().messages().list(**params), 'messages.list')
+        for msg in results.get('messages', []):
+            if limit is not None and yielded >= limit:
+                return
+            yielded += 1
+            yield msg
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
 
 def save_emails(service, messages):
-    """Saves emails to sqlite3 email database."""
-    print("===== Saving emails to database")
-    conn = sqlite3.connect('email_database.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS emails
-                 (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT)''')
-
-    for msg in messages[:10]:  # Fetch and saves only the first 10 emails detailed info
-        msg_id = msg['id']
-        msg = service.users().messages().get(userId='me', id=msg_id).execute()
-
-        headers = msg['payload']['headers']
-        from_email = next(header['value'] for header in headers if header['name'] == 'From')
-        to_email = next(header['value'] for header in headers if header['name'] == 'To')
-        subject = next(header['value'] for header in headers if header['name'] == 'Subject')
-        date_received = next(header['value'] for header in headers if header['name'] == 'Date')
-        
-        c.execute('INSERT OR IGNORE INTO emails (id, from_email, to_email, subject, date_received) VALUES (?, ?, ?, ?, ?)',
-                  (msg_id, from_email, to_email, subject, date_received))
+    """Saves emails to sqlite3 email database. Returns a tuple of (saved_count, failed_ids), see save_emails_batched."""
+    return save_emails_batched(service, messages)
+
+def fetch_metadata_batch(executor, message_ids, raw=False):
+    """Fetches the metadata of message_ids with one gmail batch request, through executor.
+
+    With raw, whole messages are fetched in format=raw instead, bodies included.
+    Messages throttled inside the batch are retried with backoff, other failures are reported and skipped.
+    Returns a tuple of (responses, failed_ids), responses maps message id to its message resource.
+    """
+    responses = {}
+    failed_ids = []
+    pending = list(message_ids)
+
+    def run_batch(service):
+        retry_ids = []
+        def on_response(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif is_retryable(exception):
+                retry_ids.append(request_id)
+            else:
+                print(f"===== Failed to fetch email {request_id}: {exception}")
+                failed_ids.append(request_id)
+
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in pending:
+            if raw:
+                request = service.users().messages().get(userId='me', id=msg_id, format='raw')
+            else:
+                request = service.users().messages().get(userId='me', id=msg_id, format='metadata',
+                                                         metadataHeaders=METADATA_HEADERS)
+            batch.add(request, request_id=msg_id)
+        batch.execute()
+        if retry_ids:
+            pending[:] = retry_ids
+            raise RetryableError(f"{len(retry_ids)} messages of the batch were throttled")
+
+    try:
+        executor.call(run_batch, 'messages.get', units=QUOTA_UNITS['messages.get'] * len(pending))
+    except Exception as error:
+        # Retries ran out. Other batches may still succeed, so only this one's pending messages are given up on
+        if not is_retryable(error):
+            raise
+        print(f"===== Giving up on {len(pending)} emails: {error}")
+        failed_ids.extend(pending)
+    return responses, failed_ids
+
+def save_emails_batched(service, messages, batch_size=DEFAULT_BATCH_SIZE, executor=None, conn=None, on_saved=None,
+                        raw=False, metrics=None):
+    """Saves emails to sqlite3 email database, fetching their metadata through gmail batch requests.
+
+    Batches are written in order as they complete. Returns a tuple of (saved_count, failed_ids).
+    """
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"{batch_size} - Invalid batch size. Use a value between 1 and {MAX_BATCH_SIZE}.")
+
+    print("===== Saving emails to database in batches")
+    metrics = metrics or NULL_METRICS
+    own_conn = conn is None
+    conn = conn or connect_database()
+    label_store = LabelStore(conn)
+    body_store = BodyStore(conn) if raw else None
+    ledger = RuleLedger(conn)
+    own_executor = executor is None
+    executor = executor or ApiExecutor.for_service(service, metrics)
+
+    saved_count = 0
+    failed_ids = []
+    in_flight = deque()  # batch futures, written to the database in submission order
+
+    def write_batch(future):
+        nonlocal saved_count
+        responses, batch_failed_ids = future.result()
+        failed_ids.extend(batch_failed_ids)
+        rows, bodies, labels = [], [], []
+        for msg_id, response in responses.items():
+            try:
+                if raw:
+                    headers, body = parse_raw_message(response)
+                    row = headers_row(msg_id, headers, response.get('sizeEstimate'))
+                    bodies.append((msg_id, body))
+                else:
+                    row = email_row(msg_id, response)
+            except Exception as error:
+                # A malformed message is skipped like a failed fetch, the rest of the batch is still saved
+                print(f"===== Failed to parse email {msg_id}: {error}")
+                failed_ids.append(msg_id)
+                continue
+            rows.append(row)
+            labels.append((msg_id, response.get('labelIds', [])))
+        with metrics.timer('db_write_seconds', table='emails'):
+            changed_ids = upsert_emails(conn, rows)
+        if changed_ids:
+            # Rules settled on the old fields, e.g. the empty Cc of an email saved before Cc was stored, apply again
+            with metrics.timer('db_write_seconds', table='rule_ledger'):
+                ledger.forget_emails(changed_ids)
+        with metrics.timer('db_write_seconds', table='email_labels'):
+            label_store.set_labels_many(labels)
+        if raw:
+            with metrics.timer('db_write_seconds', table='email_bodies'):
+                body_store.set_bodies_many(bodies)
+        conn.commit()
+        metrics.increment('emails_saved_total', len(rows))
+        if saved_count // PROGRESS_INTERVAL < (saved_count + len(rows)) // PROGRESS_INTERVAL:
+            print(f"===== Saved {saved_count + len(rows)} emails")
+        saved_count += len(rows)
+        if on_saved and rows:
+            on_saved(rows)
+
+    messages = iter(messages)
+    try:
+        while True:
+            chunk = list(islice(messages, batch_size))
+            if not chunk:
+                break
+            in_flight.append(executor.submit(fetch_metadata_batch, executor, [msg['id'] for msg in chunk], raw))
+            # Bound the batches waiting to be written, so memory stays flat
+            if len(in_flight) >= executor.max_workers * 2:
+                write_batch(in_flight.popleft())
+
+        while in_flight:
+            write_batch(in_flight.popleft())
+        conn.commit()
+        print(f"===== Saved {saved_count} emails")
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if own_conn:
+            conn.close()
+    return saved_count, failed_ids
+
+def parse_headers(headers):
+    """Returns a dict of lower cased header name to value, built in a single pass over the headers list.
+
+    Header names are case insensitive, e.g. List-Id is often sent as List-ID.
+    """
+    return {header['name'].lower(): header['value'] for header in headers}
 
+def email_row(msg_id, msg):
+    """Converts a gmail message resource to an emails table row. Missing headers are stored as empty strings."""
+    return headers_row(msg_id, parse_headers(msg.get('payload', {}).get('headers', [])), msg.get('sizeEstimate'))
+
+def headers_row(msg_id, headers, size):
+    """Builds an emails table row from a dict of lower cased header name to value."""
+    date_received = headers.get('date', '')
+    return (msg_id, headers.get('from', ''), headers.get('to', ''), headers.get('subject', ''), date_received,
+            parse_date_epoch(date_received), headers.get('cc', ''), headers.get('list-id', ''), size)
+
+def parse_raw_message(msg):
+    """Parses a gmail message resource in raw format into a tuple of (headers, body).
+
+    headers maps each lower cased header name to its decoded value, read in a single pass. body is the
+    text/plain part of the message, or its text/html part when it has no plain one, and an empty string
+    when it has neither.
+    """
+    message = BytesParser(policy=policy.default).parsebytes(base64.urlsafe_b64decode(msg['raw']))
+    headers = {name.lower(): str(value) for name, value in message.items()}
+    part = message.get_body(preferencelist=('plain', 'html'))
+    try:
+        body = part.get_content() if part is not None else ''
+    except (LookupError, ValueError):
+        # Unknown charsets and broken transfer encodings leave the email without a body rather than failing the batch
+        body = ''
+    return headers, body
+
+def get_sync_state(conn, name):
+    """Returns the stored sync state value for name, or None if it was never saved."""
+    conn.execute(CREATE_SYNC_STATE_TABLE)
+    row = conn.execute('SELECT value FROM sync_state WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(conn, name, value):
+    """Saves the sync state value for name."""
+    conn.execute(CREATE_SYNC_STATE_TABLE)
+    conn.execute('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)', (name, str(value)))
     conn.commit()
-    conn.close()
+
+def get_synced_labels(conn):
+    """Returns the labels whose history the email database follows, see sync_emails."""
+    conn.execute(CREATE_SYNC_STATE_TABLE)
+    return [name.split(':', 1)[1] for (name,) in conn.execute("SELECT name FROM sync_state WHERE name LIKE 'history_id:%'")]
+
+def fetch_history_changes(service, start_history_id, label, executor=None):
+    """Lists mailbox history since start_history_id and works out which messages entered or left the label.
+
+    Returns a tuple of (added_ids, removed_ids, label_changes, latest_history_id). When a message changes
+    several times only its final state counts. label_changes lists every (message_id, label_ids, added)
+    label change in history order, for keeping the local label copy current.
+    Raises HttpError with status 404 when start_history_id has expired.
+    """
+    executor = executor or ApiExecutor.for_service(service)
+    print("===== Fetching mailbox history from gmail")
+    changes = {}  # message id -> True if it is now in the label, False if it left the label or was deleted
+    label_changes = []
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        params = {'userId': 'me', 'startHistoryId': start_history_id,
+                  'historyTypes': ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']}
+        if page_token:
+            params['pageToken'] = page_token
+        results = executor.execute(lambda service: service.users().history().list(**params), 'history.list')
+
+        for record in results.get('history', []):
+            for change in record.get('messagesAdded', []):
+                if label in change['message'].get('labelIds', []):
+                    changes[change['message']['id']] = True
+            for change in record.get('labelsAdded', []):
+                label_changes.append((change['message']['id'], change.get('labelIds', []), True))
+                if label in change.get('labelIds', []):
+                    changes[change['message']['id']] = True
+            for change in record.get('labelsRemoved', []):
+                label_changes.append((change['message']['id'], change.get('labelIds', []), False))
+                if label in change.get('labelIds', []):
+                    changes[change['message']['id']] = False
+            for change in record.get('messagesDeleted', []):
+                changes[change['message']['id']] = False
+
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    added_ids = [msg_id for msg_id, in_label in changes.items() if in_label]
+    removed_ids = [msg_id for msg_id, in_label in changes.items() if not in_label]
+    return added_ids, removed_ids, label_changes, latest_history_id
+
+def delete_emails(conn, email_ids):
+    """Deletes the emails from the emails table, with their labels, bodies and ledger rows. Doesn't commit."""
+    conn.executemany('DELETE FROM emails WHERE id = ?', ((email_id,) for email_id in email_ids))
+    LabelStore(conn).delete_labels(email_ids)
+    BodyStore(conn).delete_bodies(email_ids)
+    RuleLedger(conn).forget_emails(email_ids)
+
+def sync_emails(service, label='INBOX', batch_size=DEFAULT_BATCH_SIZE, full=False, executor=None, conn=None,
+                on_saved=None, raw=False, metrics=None, max_results=DEFAULT_PAGE_SIZE):
+    """Brings the email database in line with the gmail label, using gmail history after the first run.
+
+    An email database follows one label. Returns the number of emails saved.
+    """
+    from googleapiclient.errors import HttpError
+    metrics = metrics or NULL_METRICS
+    executor = executor or ApiExecutor.for_service(service, metrics)
+    state_name = f'history_id:{label}'
+    failed_state_name = f'failed_ids:{label}'
+    own_conn = conn is None
+    conn = conn or connect_database()
+    # Every label shares the emails table, so syncing a second one would delete the emails of the first
+    other_labels = [synced_label for synced_label in get_synced_labels(conn) if synced_label != label]
+    if other_labels:
+        if own_conn:
+            conn.close()
+        raise ValueError(f"{label} - Invalid label, the email database already syncs {other_labels[0]}. "
+                         "Use an email database of its own for each label.")
+    saved_count = 0
+    failed_ids = []
+    start_history_id = None if full else get_sync_state(conn, state_name)
+
+    if start_history_id is not None:
+        try:
+            added_ids, removed_ids, label_changes, latest_history_id = fetch_history_changes(service, start_history_id, label,
+                                                                                             executor)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            print(f"===== History id {start_history_id} has expired, running a full resync")
+            start_history_id = None
+
+    if start_history_id is None:
+        # Read the history id before listing, so changes made while listing are replayed on the next run
+        latest_history_id = executor.execute(lambda service: service.users().getProfile(userId='me'), 'getProfile')['historyId']
+        listed_ids = set()
+        def listed_messages():
+            for msg in iter_messages(service, label_ids=[label], max_results=max_results, executor=executor):
+                listed_ids.add(msg['id'])
+                yield msg
+        saved_count, failed_ids = save_emails_batched(service, listed_messages(), batch_size=batch_size,
+                                                      executor=executor, conn=conn, on_saved=on_saved, raw=raw,
+                                                      metrics=metrics)
+        # Emails that left the label while there was no history to tell are not listed anymore
+        stale_ids = [email_id for (email_id,) in conn.execute('SELECT id FROM emails') if email_id not in listed_ids]
+        if stale_ids:
+            print(f"===== {len(stale_ids)} emails are no longer in {label}, removing them")
+        with metrics.timer('db_write_seconds', table='emails'):
+            delete_emails(conn, stale_ids)
+    else:
+        print(f"===== {len(added_ids)} emails added and {len(removed_ids)} emails removed since last sync")
+        label_store = LabelStore(conn)
+        with metrics.timer('db_write_seconds', table='email_labels'):
+            for msg_id, label_ids, added in label_changes:
+                if added:
+                    label_store.update_labels([msg_id], add_labels=label_ids)
+                else:
+                    label_store.update_labels([msg_id], remove_labels=label_ids)
+            conn.commit()
+        changed_ids = set(added_ids) | set(removed_ids)
+        retry_ids = [msg_id for msg_id in json.loads(get_sync_state(conn, failed_state_name) or '[]')
+                     if msg_id not in changed_ids]
+        if retry_ids:
+            print(f"===== Fetching {len(retry_ids)} emails that failed on an earlier sync again")
+        if added_ids or retry_ids:
+            saved_count, failed_ids = save_emails_batched(service, ({'id': msg_id} for msg_id in added_ids + retry_ids),
+                                                          batch_size=batch_size, executor=executor, conn=conn,
+                                                          on_saved=on_saved, raw=raw, metrics=metrics)
+        with metrics.timer('db_write_seconds', table='emails'):
+            delete_emails(conn, removed_ids)
+
+    set_sync_state(conn, failed_state_name, json.dumps(failed_ids))
+    set_sync_state(conn, state_name, latest_history_id)
+    if own_conn:
+        conn.close()
+    return saved_count
+
+def parse_args():
+    """Parses command line options of the fetch_emails.py script."""
+    arg_parser = argparse.ArgumentParser(description='Fetch emails from gmail into the email database.',
+                                         parents=[api_arguments(), batch_arguments(), raw_arguments(), metrics_arguments()])
+    arg_parser.add_argument('--label', action='append', dest='labels',
+                            help='Label id to fetch from, can be repeated. Defaults to INBOX.')
+    arg_parser.add_argument('--query', help="Gmail search query, e.g. 'newer_than:7d'.")
+    arg_parser.add_argument('--limit', type=int, help='Maximum number of emails to fetch.')
+    arg_parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='Message ids listed per page.')
+    arg_parser.add_argument('--full', action='store_true', help='Ignore the saved history id and resync the whole label.')
+    return arg_parser.parse_args()
 
 if __name__ == '__main__':
     print("!!!!! SCRIPT STARTED - fetch_emails.py")
+    args = parse_args()
     gmail_helper_instance = GmailHelper()
     service = gmail_helper_instance.authenticate_gmail()
-    messages = fetch_emails(service, 'INBOX')
-    save_emails(service, messages)
+    metrics = Metrics() if args.metrics_json or args.metrics_prometheus else NULL_METRICS
+    executor = ApiExecutor(gmail_helper_instance.build_service, max_workers=args.concurrency,
+                           quota_per_second=args.quota or None, metrics=metrics)
+    labels = args.labels or ['INBOX']
+    if args.query or args.limit or len(labels) > 1:
+        # A filtered listing is not a complete copy of a label, so it can't be a starting point for incremental sync
+        messages = iter_messages(service, label_ids=labels, query=args.query, max_results=args.page_size, limit=args.limit,
+                                 executor=executor)
+        save_emails_batched(service, messages, batch_size=args.batch_size, executor=executor, raw=args.raw,
+                            metrics=metrics)
+    else:
+        sync_emails(service, label=labels[0], batch_size=args.batch_size, full=args.full, executor=executor, raw=args.raw,
+                    metrics=metrics, max_results=args.page_size)
+    executor.shutdown()
+    metrics.export(args.metrics_json, args.metrics_prometheus)
     print("!!!!! SCRIPT COMPLETED - fetch_emails.py")
-
-
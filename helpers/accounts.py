@@ -0,0 +1,63 @@
+import json
+from collections import Counter
+from helpers.gmail_helper import CREDENTIALS_PATH
+
+# Keys of an account in the accounts file, and whether the account needs them
+ACCOUNT_KEYS = {'name': True, 'token': True, 'database': True, 'credentials': False, 'rules': False, 'label': False,
+                'raw': False}
+STRING_KEYS = ('name', 'token', 'database', 'credentials', 'rules', 'label')
+
+class Account:
+    """One gmail account of the accounts file, with its own token store, email database and rules file."""
+    def __init__(self, name, token, database, credentials=CREDENTIALS_PATH, rules='rules.json', label='INBOX', raw=False):
+        """Initializes Account object.
+
+        token is the token store of the account and credentials the OAuth client secrets file, see GmailHelper.
+        Emails of label are synced to the email database at database and the rules in rules are applied to them.
+        raw ingests whole messages, bodies included, for rules with body conditions.
+        """
+        self.name = name
+        self.token = token
+        self.database = database
+        self.credentials = credentials
+        self.rules = rules
+        self.label = label
+        self.raw = raw
+
+def validate_account(account):
+    """Checks one account entry of the accounts file. Returns a list of errors, empty if the account is valid."""
+    if not isinstance(account, dict):
+        return ["Invalid account, expected an object."]
+
+    errors = [f"{key} - Missing account key." for key, required in ACCOUNT_KEYS.items() if required and key not in account]
+    errors += [f"{key} - Invalid account key." for key in account if key not in ACCOUNT_KEYS]
+    errors += [f"{account[key]} - Invalid value for {key}, expected a non empty string." for key in STRING_KEYS
+               if key in account and not (isinstance(account[key], str) and account[key])]
+    if 'raw' in account and not isinstance(account['raw'], bool):
+        errors.append(f"{account['raw']} - Invalid value for raw, expected true or false.")
+    return errors
+
+def parse_accounts(accounts):
+    """Validates the parsed accounts file and returns its Account objects.
+
+    Raises ValueError listing every problem, so a typo in one account fails before any mailbox is touched.
+    Accounts can't share a name, token store or email database.
+    """
+    if not isinstance(accounts, list):
+        raise ValueError("Invalid accounts, expected a list of accounts.")
+
+    errors = [f"Account {number}: {error}" for number, account in enumerate(accounts, 1)
+              for error in validate_account(account)]
+    if not errors:
+        for key in ('name', 'token', 'database'):
+            counts = Counter(account[key] for account in accounts)
+            errors += [f"{value} - Duplicate {key}, accounts need one of their own." for value, count in counts.items()
+                       if count > 1]
+    if errors:
+        raise ValueError("Invalid accounts:\n" + "\n".join(errors))
+    return [Account(**account) for account in accounts]
+
+def load_accounts(path='accounts.json'):
+    """Loads the accounts file. Raises ValueError if it isn't valid."""
+    with open(path, 'r') as file:
+        return parse_accounts(json.load(file))
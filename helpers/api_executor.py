@@ -0,0 +1,191 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from helpers.metrics import NULL_METRICS
+
+# Gmail quota units charged per call, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+}
+# Gmail accepts at most 100 calls in one batch request, but recommends keeping batches at 50 or below.
+DEFAULT_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+# Gmail allows 15,000 quota units per user per minute
+DEFAULT_QUOTA_PER_SECOND = 250
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_RETRIES = 5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED'}
+
+class RetryableError(Exception):
+    """Raised by API calls that failed in a way worth retrying, e.g. some messages of a batch were throttled."""
+
+def error_reasons(error):
+    """Returns the reasons listed in the JSON body of an HttpError, in both the legacy and the newer error format."""
+    try:
+        body = json.loads(error.content).get('error', {})
+    except (ValueError, TypeError, AttributeError):
+        return set()
+    return {item.get('reason') for item in body.get('errors', []) + body.get('details', []) if isinstance(item, dict)}
+
+def is_retryable(error):
+    """Checks if a failed API call should be retried: throttling, gmail server errors and dropped connections."""
+    from googleapiclient.errors import HttpError
+    if isinstance(error, (RetryableError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        # Gmail reports per-user rate limits as 403 with a rate limit reason
+        return error.resp.status == 403 and bool(error_reasons(error) & RATE_LIMIT_REASONS)
+    return False
+
+class TokenBucket:
+    """Thread-safe token bucket refilling rate tokens per second, up to capacity tokens."""
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """Initializes TokenBucket object, full."""
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Blocks until tokens are available and takes them.
+
+        A request costing more than the capacity waits for a full bucket and leaves it in debt.
+        """
+        needed = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+            self.sleep(wait)
+
+class SharedBudget:
+    """Limits shared by the executors of several accounts: gmail API calls running at once and quota units per second.
+
+    Gmail quotas are per user and per project. Each executor keeps to the per user quota, a shared budget
+    keeps the executors of every account together within the project quota and the connections of one host.
+    """
+    def __init__(self, max_calls, quota_per_second=None, sleep=time.sleep):
+        """Initializes SharedBudget object. quota_per_second=None only limits the calls running at once."""
+        self.slots = threading.BoundedSemaphore(max_calls)
+        self.rate_limiter = TokenBucket(quota_per_second, sleep=sleep) if quota_per_second else None
+
+class ApiExecutor:
+    """Runs gmail API calls with a bounded thread pool, quota rate limiting and retries with backoff.
+
+    Calls are functions of a gmail service object. Each thread gets its own service from service_factory,
+    since the underlying httplib2 connection is not thread-safe.
+    """
+    def __init__(self, service_factory, max_workers=DEFAULT_MAX_WORKERS, quota_per_second=DEFAULT_QUOTA_PER_SECOND,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_base=1.0, backoff_max=32.0, sleep=time.sleep, metrics=None,
+                 budget=None, inline=False):
+        """Initializes ApiExecutor object. quota_per_second=None turns rate limiting off.
+
+        Calls, errors, retries, quota units and call durations are recorded by method in metrics (see helpers/metrics.py).
+        With a SharedBudget, calls also wait for a slot and quota units of the budget. inline runs submitted
+        work in the calling thread instead of the thread pool.
+        """
+        self.service_factory = service_factory
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(quota_per_second, sleep=sleep) if quota_per_second else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.metrics = metrics or NULL_METRICS
+        self.budget = budget
+        self.inline = inline
+        self.local = threading.local()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    @classmethod
+    def for_service(cls, service, metrics=None):
+        """Returns an executor without rate limiting on one existing service object.
+
+        The service can't be shared between threads, so submitted work runs inline in the calling thread.
+        """
+        return cls(lambda: service, max_workers=1, quota_per_second=None, metrics=metrics, inline=True)
+
+    def service(self):
+        """Returns the gmail service of the calling thread, building it on first use."""
+        if not hasattr(self.local, 'service'):
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def call(self, fn, method, units=None):
+        """Runs fn(service) in the calling thread and returns its result.
+
+        Quota units for method are taken from the rate limiter, and the budget if any, before every attempt. Retryable errors are
+        retried up to max_retries times with exponential backoff and full jitter, other errors are raised.
+        """
+        units = QUOTA_UNITS.get(method, 1) if units is None else units
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(units)
+            if self.budget and self.budget.rate_limiter:
+                self.budget.rate_limiter.acquire(units)
+            self.metrics.increment('api_calls_total', method=method)
+            self.metrics.increment('api_quota_units_total', units, method=method)
+            # The budget slot is only held during the call, not while backing off
+            slot = self.budget.slots if self.budget else nullcontext()
+            try:
+                with slot, self.metrics.timer('api_call_seconds', method=method):
+                    return fn(self.service())
+            except Exception as error:
+                self.metrics.increment('api_errors_total', method=method)
+                if attempt >= self.max_retries or not is_retryable(error):
+                    raise
+                self.metrics.increment('api_retries_total', method=method)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                print(f"===== {method} failed ({error}), retrying in {delay:.1f}s")
+                self.sleep(delay)
+                attempt += 1
+
+    def execute(self, build_request, method):
+        """Builds a request with build_request(service), executes it through call and returns the response."""
+        return self.call(lambda service: build_request(service).execute(), method)
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the thread pool and returns a Future.
+
+        Use submit(executor.call, fn, method) to run a rate limited, retried API call concurrently.
+        Inline executors run fn right away and return a completed Future.
+        """
+        if self.inline:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='gmail-api')
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        """Waits for submitted calls and stops the thread pool."""
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
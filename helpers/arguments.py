@@ -0,0 +1,50 @@
+import argparse
+from helpers.api_executor import DEFAULT_BATCH_SIZE, DEFAULT_MAX_WORKERS, DEFAULT_QUOTA_PER_SECOND
+
+# Parent parsers of the command line options the scripts share, pass them as parents to argparse.ArgumentParser
+
+def api_arguments():
+    """Returns a parent parser with the --concurrency and --quota options of the gmail executor."""
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument('--concurrency', type=int, default=DEFAULT_MAX_WORKERS,
+                            help='Gmail API calls run at once, per account.')
+    arg_parser.add_argument('--quota', type=int, default=DEFAULT_QUOTA_PER_SECOND,
+                            help='Gmail quota units to use per second per account, 0 turns rate limiting off.')
+    return arg_parser
+
+def batch_arguments():
+    """Returns a parent parser with the --batch-size option of fetching emails."""
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Messages fetched per batch request.')
+    return arg_parser
+
+def raw_arguments():
+    """Returns a parent parser with the --raw option of fetching emails."""
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument('--raw', action='store_true',
+                            help='Fetch whole messages and store their bodies too, for rules on the message body.')
+    return arg_parser
+
+def rule_arguments():
+    """Returns a parent parser with the --multi-pattern, --ignore-case and --refresh-labels options of RuleProcessor."""
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument('--multi-pattern', action='store_true',
+                            help='Check all contains conditions with one scan per email field, where rules are '
+                                 'evaluated in python.')
+    arg_parser.add_argument('--ignore-case', action='store_true', help='Make contains conditions case insensitive.')
+    arg_parser.add_argument('--refresh-labels', action='store_true',
+                            help='Re-read email labels from gmail instead of trusting the locally stored copy.')
+    return arg_parser
+
+def metrics_arguments():
+    """Returns a parent parser with the --metrics-json and --metrics-prometheus options."""
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument('--metrics-json', help='Write a JSON summary of the run metrics to this file.')
+    arg_parser.add_argument('--metrics-prometheus',
+                            help='Write the run metrics to this file in the Prometheus text format, e.g. for the '
+                                 'node exporter textfile collector.')
+    return arg_parser
+
+def rule_options(args):
+    """Returns the RuleProcessor keyword arguments of parsed rule_arguments options."""
+    return {'multi_pattern': args.multi_pattern, 'ignore_case': args.ignore_case, 'refresh_labels': args.refresh_labels}
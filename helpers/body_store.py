@@ -0,0 +1,48 @@
+import zlib
+from helpers.email_database import CREATE_EMAIL_BODIES_TABLE
+
+# SQLite limits the number of bound parameters of a statement, 999 in older versions
+MAX_QUERY_IDS = 500
+
+def compress_body(body):
+    """Compresses a message body for the email_bodies table."""
+    return zlib.compress(body.encode('utf-8'))
+
+def decompress_body(blob):
+    """Returns the message body stored as blob."""
+    return zlib.decompress(blob).decode('utf-8')
+
+class BodyStore:
+    """Keeps the text bodies of emails ingested in raw format, zlib compressed, in the email_bodies side table.
+
+    Bodies are only read when asked for, so rules without body conditions never load them. Callers commit the writes.
+    """
+    def __init__(self, conn):
+        """Initializes BodyStore object on an open sqlite3 connection and creates its table."""
+        self.conn = conn
+        self.conn.execute(CREATE_EMAIL_BODIES_TABLE)
+
+    def get_body(self, email_id):
+        """Returns the body stored for the email, or None if it has none."""
+        row = self.conn.execute('SELECT body FROM email_bodies WHERE id = ?', (email_id,)).fetchone()
+        return decompress_body(row[0]) if row else None
+
+    def get_bodies(self, email_ids):
+        """Returns a dict of email id to body for email_ids, with None for emails without a body."""
+        email_ids = list(email_ids)
+        bodies = dict.fromkeys(email_ids)
+        for start in range(0, len(email_ids), MAX_QUERY_IDS):
+            chunk = email_ids[start:start + MAX_QUERY_IDS]
+            placeholders = ', '.join('?' * len(chunk))
+            for email_id, blob in self.conn.execute(f'SELECT id, body FROM email_bodies WHERE id IN ({placeholders})', chunk):
+                bodies[email_id] = decompress_body(blob)
+        return bodies
+
+    def set_bodies_many(self, rows):
+        """Replaces the stored body for each (email_id, body) pair in rows."""
+        self.conn.executemany('INSERT OR REPLACE INTO email_bodies (id, body) VALUES (?, ?)',
+                              ((email_id, compress_body(body)) for email_id, body in rows))
+
+    def delete_bodies(self, email_ids):
+        """Forgets the stored bodies of the emails."""
+        self.conn.executemany('DELETE FROM email_bodies WHERE id = ?', ((email_id,) for email_id in email_ids))
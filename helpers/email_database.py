@@ -0,0 +1,202 @@
+import sqlite3
+from datetime import timezone
+from dateutil import parser
+
+DATABASE_PATH = 'email_database.db'
+# Applied to every connection. In WAL mode readers don't block the writer and the writer doesn't block readers,
+# and synchronous=NORMAL only syncs at checkpoints, which is still safe against corruption in WAL mode.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+)
+
+CREATE_EMAILS_TABLE = '''CREATE TABLE IF NOT EXISTS emails
+                 (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT)'''
+CREATE_EMAIL_LABELS_TABLE = 'CREATE TABLE IF NOT EXISTS email_labels (id TEXT PRIMARY KEY, label_ids TEXT)'
+CREATE_SYNC_STATE_TABLE = 'CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)'
+# Keyed by rule hash first, so the rows of a removed rule are deleted as one range
+CREATE_RULE_LEDGER_TABLE = ('CREATE TABLE IF NOT EXISTS rule_ledger (rule_hash TEXT, email_id TEXT, '
+                            'PRIMARY KEY (rule_hash, email_id)) WITHOUT ROWID')
+CREATE_RULE_LEDGER_RULES_TABLE = 'CREATE TABLE IF NOT EXISTS rule_ledger_rules (rule_hash TEXT PRIMARY KEY)'
+# Message bodies are kept apart from the emails table, zlib compressed, so scans of the emails table never read them
+CREATE_EMAIL_BODIES_TABLE = 'CREATE TABLE IF NOT EXISTS email_bodies (id TEXT PRIMARY KEY, body BLOB)'
+
+UPSERT_EMAIL = ('INSERT INTO emails (id, from_email, to_email, subject, date_received, date_epoch, cc, list_id, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET from_email = excluded.from_email, '
+                'to_email = excluded.to_email, subject = excluded.subject, date_received = excluded.date_received, '
+                'date_epoch = excluded.date_epoch, cc = excluded.cc, list_id = excluded.list_id, size = excluded.size')
+
+# Columns of an emails table row, in SELECT * order
+EMAIL_COLUMNS = ('id', 'from_email', 'to_email', 'subject', 'date_received', 'date_epoch', 'cc', 'list_id', 'size')
+DATE_EPOCH_INDEX = EMAIL_COLUMNS.index('date_epoch')
+# Ids looked up per query, well below SQLite's limit on query parameters
+MAX_QUERY_IDS = 500
+
+class EmailRecord:
+    """Compact emails table row with named fields. Fields can also be read by column index, like the row tuple."""
+    __slots__ = EMAIL_COLUMNS
+
+    def __init__(self, id, from_email, to_email, subject, date_received, date_epoch=None, cc='', list_id='', size=None):
+        """Initializes EmailRecord object."""
+        self.id = id
+        self.from_email = from_email
+        self.to_email = to_email
+        self.subject = subject
+        self.date_received = date_received
+        self.date_epoch = date_epoch
+        self.cc = cc
+        self.list_id = list_id
+        self.size = size
+
+    def __getitem__(self, index):
+        """Returns the field at the column index."""
+        return getattr(self, EMAIL_COLUMNS[index])
+
+    def __len__(self):
+        """Returns the number of fields."""
+        return len(EMAIL_COLUMNS)
+
+    def __eq__(self, other):
+        """Records are equal when all their fields are."""
+        return isinstance(other, EmailRecord) and all(self[index] == other[index] for index in range(len(self)))
+
+    def __repr__(self):
+        """Returns the record as EmailRecord(field=value, ...)."""
+        return 'EmailRecord(' + ', '.join(f'{column}={getattr(self, column)!r}' for column in EMAIL_COLUMNS) + ')'
+
+def parse_date_epoch(date_received):
+    """Converts a Date header to UTC epoch seconds. Dates without a timezone are taken as UTC.
+
+    Returns None when the header can't be parsed.
+    """
+    try:
+        date = parser.parse(date_received)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+def migrate_emails_table(c):
+    """Creates the emails table and brings older databases up to date.
+
+    Databases created before date_epoch existed get the column added and their rows' Date headers parsed once.
+    """
+    c.execute(CREATE_EMAILS_TABLE)
+    columns = [column[1] for column in c.execute('PRAGMA table_info(emails)').fetchall()]
+    if 'date_epoch' not in columns:
+        c.execute('ALTER TABLE emails ADD COLUMN date_epoch INTEGER')
+        rows = c.execute('SELECT id, date_received FROM emails').fetchall()
+        updates = [(parse_date_epoch(date_received), email_id) for email_id, date_received in rows]
+        if updates:
+            c.executemany('UPDATE emails SET date_epoch = ? WHERE id = ?', updates)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_emails_date_epoch ON emails (date_epoch)')
+    # Support equals conditions pushed down to SQL by the query planner
+    c.execute('CREATE INDEX IF NOT EXISTS idx_emails_from_email ON emails (from_email)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_emails_to_email ON emails (to_email)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_emails_subject ON emails (subject)')
+
+def create_side_tables(c):
+    """Creates the tables kept next to the emails table: labels, sync state and the rule ledger."""
+    for create_table in (CREATE_EMAIL_LABELS_TABLE, CREATE_SYNC_STATE_TABLE, CREATE_RULE_LEDGER_TABLE,
+                         CREATE_RULE_LEDGER_RULES_TABLE):
+        c.execute(create_table)
+
+def add_message_details(c):
+    """Adds the Cc, List-Id and size columns to the emails table, and the email_bodies table.
+
+    Emails saved before keep an empty Cc and List-Id and an unknown size until they are fetched again.
+    """
+    columns = [column[1] for column in c.execute('PRAGMA table_info(emails)').fetchall()]
+    for column, definition in (('cc', "TEXT DEFAULT ''"), ('list_id', "TEXT DEFAULT ''"), ('size', 'INTEGER')):
+        if column not in columns:
+            c.execute(f'ALTER TABLE emails ADD COLUMN {column} {definition}')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_emails_list_id ON emails (list_id)')
+    c.execute(CREATE_EMAIL_BODIES_TABLE)
+
+def index_rule_ledger_emails(c):
+    """Indexes the rule ledger by email, so the rows of deleted emails are found without a full scan."""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_rule_ledger_email_id ON rule_ledger (email_id)')
+
+# Schema migrations in order. The database's PRAGMA user_version is the number of migrations applied to it.
+# Migrations must also work on databases created before versioning, which have user_version 0.
+MIGRATIONS = (
+    migrate_emails_table,
+    create_side_tables,
+    add_message_details,
+    index_rule_ledger_emails,
+)
+
+def migrate(conn):
+    """Applies the migrations the database doesn't have yet, in one transaction.
+
+    The write lock is taken before the schema version is read, so concurrent processes don't migrate twice.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            migration(conn.cursor())
+        conn.execute(f'PRAGMA user_version = {max(version, len(MIGRATIONS))}')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def unicode_lower(value):
+    """SQL function lower casing text like python does. SQLite's own lower() only folds ASCII letters."""
+    return value.lower() if isinstance(value, str) else value
+
+def connect_database(path=DATABASE_PATH):
+    """Opens the email database with the PRAGMAS applied, its schema up to date and unicode_lower registered.
+
+    Readers and writers can use the database from several connections and processes at the same time.
+    A writer waits up to busy_timeout for another writer to finish instead of failing right away.
+    """
+    conn = sqlite3.connect(path)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.create_function('unicode_lower', 1, unicode_lower, deterministic=True)
+    migrate(conn)
+    return conn
+
+def upsert_emails(conn, rows):
+    """Inserts emails table rows with one executemany, replacing the fields of emails already stored. Doesn't commit.
+
+    Returns the ids of the stored emails whose fields changed, e.g. older rows filled in with Cc, List-Id and size.
+    """
+    rows = {row[0]: tuple(row) for row in rows}
+    changed_ids = []
+    email_ids = list(rows)
+    for start in range(0, len(email_ids), MAX_QUERY_IDS):
+        chunk = email_ids[start:start + MAX_QUERY_IDS]
+        stored_rows = conn.execute(f'SELECT {", ".join(EMAIL_COLUMNS)} FROM emails WHERE id IN ({", ".join("?" * len(chunk))})',
+                                   chunk)
+        changed_ids += [stored_row[0] for stored_row in stored_rows if stored_row != rows[stored_row[0]]]
+    conn.executemany(UPSERT_EMAIL, list(rows.values()))
+    return changed_ids
+
+def iter_email_chunks(conn, chunk_size, after_rowid=0, last_rowid=None, condition=None):
+    """Lazily yields the emails of the emails table as lists of up to chunk_size EmailRecords, in rowid order.
+
+    Chunks are read by rowid ranges, so no read lock is held between chunks while the caller writes.
+    after_rowid and last_rowid limit the emails to those with after_rowid < rowid <= last_rowid, and condition
+    is an optional (sql, params) condition on emails table rows.
+    """
+    upper_bound, upper_params = ('', ()) if last_rowid is None else (' AND rowid <= ?', (last_rowid,))
+    extra, extra_params = (f' AND {condition[0]}', condition[1]) if condition else ('', ())
+    c = conn.cursor()
+    while True:
+        c.execute(f'SELECT rowid, * FROM emails WHERE rowid > ?{upper_bound}{extra} ORDER BY rowid LIMIT ?',
+                  (after_rowid, *upper_params, *extra_params, chunk_size))
+        rows = c.fetchmany(chunk_size)
+        if not rows:
+            return
+        after_rowid = rows[-1][0]
+        yield [EmailRecord(*row[1:]) for row in rows]
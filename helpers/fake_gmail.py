@@ -0,0 +1,315 @@
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+# Used to generate synthetic mailboxes
+SENDERS = ['Mukesh Dhyani <mukesh@example.com>', 'HappyFox <no-reply@happyfox.com>', 'GitHub <noreply@github.com>',
+           'Alice Smith <alice@example.org>', 'Bob Jones <bob@example.net>', 'Security Team <security@example.com>',
+           'Newsletter <news@example.io>', 'Carol White <carol@example.org>']
+RECIPIENTS = ['sahilrawat667@gmail.com', 'me@example.com', 'team@example.com']
+SUBJECTS = ['HappyFox Assignment', 'Test Video Recording', 'Security alert', 'Weekly digest', 'Meeting notes',
+            'Invoice #{index}', 'Re: Project update {index}', 'Build {index} failed', 'Your order has shipped']
+BODIES = ['Please find the report attached.', 'Your invoice is ready, the total is due in 30 days.',
+          'Click the link below to unsubscribe from this list.', 'The build broke on the main branch.',
+          'Can we move the meeting to Thursday?', 'We noticed a new sign in to your account.']
+# Most listing pages carry this many ids by default, like gmail
+DEFAULT_LIST_PAGE_SIZE = 100
+DEFAULT_HISTORY_PAGE_SIZE = 100
+
+def http_error(status, reason):
+    """Returns a googleapiclient HttpError with the status and a gmail style JSON body giving the reason."""
+    from googleapiclient.errors import HttpError
+    from httplib2 import Response
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(Response({'status': status}), content.encode())
+
+class FakeMailbox:
+    """Synthetic gmail mailbox of message_count messages, generated on demand so millions of messages fit in memory.
+
+    Only label changes and the message count are stored. Every change, and every message delivered with
+    add_messages, is recorded as a history record, like gmail does.
+    """
+    def __init__(self, message_count, seed=0, now=None):
+        """Initializes FakeMailbox object."""
+        self.message_count = message_count
+        self.seed = seed
+        self.now = now or datetime.now(timezone.utc)
+        self.labels = {}  # message index -> set of label ids, for messages whose labels changed
+        self.history = []  # history records, oldest first
+        self.history_id = 1000
+        self.lock = threading.RLock()
+
+    def message_id(self, index):
+        """Returns the gmail style id of the message at index."""
+        return f'{index:016x}'
+
+    def message_index(self, message_id):
+        """Returns the index of the message, or None when there is no such message."""
+        try:
+            index = int(message_id, 16)
+        except (TypeError, ValueError):
+            return None
+        return index if 0 <= index < self.message_count else None
+
+    def headers(self, index):
+        """Returns the From, To, Subject and Date headers of the message at index, and Cc and List-Id for some."""
+        generator = random.Random(self.seed * 1000003 + index)
+        date = self.now - timedelta(seconds=generator.randrange(180 * 24 * 3600))
+        headers = {
+            'From': generator.choice(SENDERS),
+            'To': generator.choice(RECIPIENTS),
+            'Subject': generator.choice(SUBJECTS).format(index=index),
+            'Date': format_datetime(date),
+        }
+        if index % 4 == 0:
+            headers['Cc'] = generator.choice(RECIPIENTS)
+        if headers['From'].startswith('Newsletter'):
+            headers['List-Id'] = 'Weekly news <news.example.io>'
+        return headers
+
+    def body(self, index):
+        """Returns the text body of the message at index."""
+        generator = random.Random(self.seed * 1000003 + index + 1)
+        return '\n\n'.join(generator.choice(BODIES) for _ in range(1 + generator.randrange(3)))
+
+    def raw(self, index):
+        """Returns the message at index in RFC 2822 format."""
+        message = EmailMessage()
+        for name, value in self.headers(index).items():
+            message[name] = value
+        message.set_content(self.body(index))
+        return message.as_bytes()
+
+    def label_ids(self, index):
+        """Returns the label ids of the message at index."""
+        with self.lock:
+            if index in self.labels:
+                return set(self.labels[index])
+        return {'INBOX', 'UNREAD'} if index % 3 == 0 else {'INBOX'}
+
+    def modify(self, index, add_labels=(), remove_labels=()):
+        """Changes the labels of the message at index, records the change in history and returns the new labels."""
+        labels = self.label_ids(index)
+        added = set(add_labels) - labels
+        removed = set(remove_labels) & labels
+        labels = (labels | added) - removed
+        with self.lock:
+            self.labels[index] = labels
+            message = {'id': self.message_id(index), 'labelIds': sorted(labels)}
+            for key, changed in (('labelsAdded', added), ('labelsRemoved', removed)):
+                if changed:
+                    self.history_id += 1
+                    self.history.append({'id': str(self.history_id),
+                                         key: [{'message': message, 'labelIds': sorted(changed)}]})
+        return labels
+
+    def add_messages(self, count):
+        """Delivers count new messages to the mailbox, recording each in history, and returns their ids."""
+        with self.lock:
+            indexes = range(self.message_count, self.message_count + count)
+            self.message_count += count
+            for index in indexes:
+                self.history_id += 1
+                message = {'id': self.message_id(index), 'labelIds': sorted(self.label_ids(index))}
+                self.history.append({'id': str(self.history_id), 'messagesAdded': [{'message': message}]})
+        return [self.message_id(index) for index in indexes]
+
+    def message(self, index, format='full', metadata_headers=None):
+        """Returns the message resource at index, in the gmail format requested. Format full has no body parts."""
+        resource = {'id': self.message_id(index), 'threadId': self.message_id(index),
+                    'labelIds': sorted(self.label_ids(index))}
+        if format == 'minimal':
+            return resource
+        raw = self.raw(index)
+        resource['sizeEstimate'] = len(raw)
+        if format == 'raw':
+            resource['raw'] = base64.urlsafe_b64encode(raw).decode()
+            return resource
+        headers = self.headers(index)
+        if metadata_headers is not None:
+            headers = {name: value for name, value in headers.items() if name in metadata_headers}
+        resource['payload'] = {'headers': [{'name': name, 'value': value} for name, value in headers.items()]}
+        return resource
+
+class FakeRequest:
+    """Stands in for googleapiclient's HttpRequest, running handler on execute."""
+    def __init__(self, service, method, handler):
+        """Initializes FakeRequest object."""
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        """Sends the request as its own HTTP request and returns the response."""
+        self.service.http_request()
+        return self.service.call(self)
+
+class FakeBatch:
+    """Stands in for googleapiclient's BatchHttpRequest. The whole batch is one HTTP request."""
+    def __init__(self, service, callback):
+        """Initializes FakeBatch object."""
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        """Adds a request to the batch."""
+        self.requests.append((request_id or str(len(self.requests) + 1), request))
+
+    def execute(self):
+        """Runs every request of the batch and reports each result or error to the callback."""
+        self.service.http_request()
+        for request_id, request in self.requests:
+            try:
+                response = self.service.call(request)
+            except Exception as error:
+                self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, response, None)
+
+class FakeResource:
+    """Collection of methods, like service.users() or service.users().messages()."""
+    def __init__(self, **methods):
+        """Initializes FakeResource object."""
+        for name, method in methods.items():
+            setattr(self, name, method)
+
+class FakeGmailService:
+    """In-process stand-in for the gmail v1 service object built by googleapiclient.
+
+    Implements users().getProfile, users().messages().list/get/modify/batchModify, users().history().list and
+    new_batch_http_request on a FakeMailbox. Every HTTP request sleeps latency seconds, and each API call
+    fails with a rate limit error with probability error_rate. Calls and HTTP requests are counted, and
+    one service may be shared by several threads.
+    """
+    def __init__(self, mailbox, latency=0.0, error_rate=0.0, seed=0, sleep=time.sleep):
+        """Initializes FakeGmailService object."""
+        self.mailbox = mailbox
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sleep = sleep
+        self.calls = Counter()  # API method -> calls, batched calls included
+        self.http_requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def users(self):
+        """Returns the users resource."""
+        return FakeResource(getProfile=self.get_profile, messages=self.messages, history=self.history)
+
+    def messages(self):
+        """Returns the users.messages resource."""
+        return FakeResource(list=self.list_messages, get=self.get_message, modify=self.modify_message,
+                            batchModify=self.batch_modify_messages)
+
+    def history(self):
+        """Returns the users.history resource."""
+        return FakeResource(list=self.list_history)
+
+    def new_batch_http_request(self, callback=None):
+        """Returns a new batch request."""
+        return FakeBatch(self, callback)
+
+    def http_request(self):
+        """Counts an HTTP request and waits for its latency."""
+        with self.lock:
+            self.http_requests += 1
+        if self.latency:
+            self.sleep(self.latency)
+
+    def call(self, request):
+        """Counts an API call and runs it, failing it at random with the configured error rate."""
+        with self.lock:
+            self.calls[request.method] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            raise http_error(429, 'rateLimitExceeded')
+        return request.handler()
+
+    def api_calls(self):
+        """Returns the total number of API calls made."""
+        return sum(self.calls.values())
+
+    def get_profile(self, userId):
+        """users.getProfile"""
+        return FakeRequest(self, 'getProfile', lambda: {
+            'emailAddress': 'me@example.com', 'messagesTotal': self.mailbox.message_count,
+            'historyId': str(self.mailbox.history_id)})
+
+    def list_messages(self, userId, labelIds=None, q=None, maxResults=DEFAULT_LIST_PAGE_SIZE, pageToken=None,
+                      includeSpamTrash=False):
+        """users.messages.list. Search queries (q) are not supported and are ignored."""
+        def handler():
+            mailbox = self.mailbox
+            labels = set(labelIds or [])
+            index = int(pageToken or 0)
+            messages = []
+            while index < mailbox.message_count and len(messages) < maxResults:
+                if labels <= mailbox.label_ids(index):
+                    messages.append({'id': mailbox.message_id(index), 'threadId': mailbox.message_id(index)})
+                index += 1
+            response = {'resultSizeEstimate': len(messages)}
+            if messages:
+                response['messages'] = messages
+            if index < mailbox.message_count:
+                response['nextPageToken'] = str(index)
+            return response
+        return FakeRequest(self, 'messages.list', handler)
+
+    def get_message(self, userId, id, format='full', metadataHeaders=None):
+        """users.messages.get"""
+        def handler():
+            index = self.__message_index(id)
+            return self.mailbox.message(index, format, metadataHeaders)
+        return FakeRequest(self, 'messages.get', handler)
+
+    def modify_message(self, userId, id, body):
+        """users.messages.modify"""
+        def handler():
+            index = self.__message_index(id)
+            self.mailbox.modify(index, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return self.mailbox.message(index, 'minimal')
+        return FakeRequest(self, 'messages.modify', handler)
+
+    def batch_modify_messages(self, userId, body):
+        """users.messages.batchModify"""
+        def handler():
+            if len(body.get('ids', [])) > 1000:
+                raise http_error(400, 'invalidArgument')
+            indexes = [self.__message_index(message_id) for message_id in body['ids']]
+            for index in indexes:
+                self.mailbox.modify(index, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return ''
+        return FakeRequest(self, 'messages.batchModify', handler)
+
+    def list_history(self, userId, startHistoryId, historyTypes=None, maxResults=DEFAULT_HISTORY_PAGE_SIZE,
+                     pageToken=None):
+        """users.history.list. historyTypes is ignored, every record is returned."""
+        def handler():
+            with self.mailbox.lock:
+                records = [record for record in self.mailbox.history if int(record['id']) > int(startHistoryId)]
+                history_id = str(self.mailbox.history_id)
+            start = int(pageToken or 0)
+            response = {'historyId': history_id}
+            if records[start:start + maxResults]:
+                response['history'] = records[start:start + maxResults]
+            if start + maxResults < len(records):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeRequest(self, 'history.list', handler)
+
+    def __message_index(self, message_id):
+        """Returns the mailbox index of the message, raising a 404 HttpError for unknown ids."""
+        index = self.mailbox.message_index(message_id)
+        if index is None:
+            raise http_error(404, 'notFound')
+        return index
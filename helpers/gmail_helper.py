@@ -1,32 +1,111 @@
+import json
 import os
 import pickle
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+import threading
+
+# The google client libraries take a few hundred milliseconds to import, so they are imported
+# inside the methods that need them. Code paths that never call gmail don't pay for them.
+
+TOKEN_PATH = 'helpers/token.pickle'
+CREDENTIALS_PATH = 'helpers/credentials.json'
 
 class GmailHelper:
-    # If modifying these SCOPES, delete the file token.pickle.
+    # If modifying these SCOPES, delete the token.pickle files.
     scopes = ['https://www.googleapis.com/auth/gmail.modify']
 
+    # The discovery document is shared by the whole process, credentials and services by every helper of one token store
+    lock = threading.RLock()
+    credentials = {}  # token path -> credentials
+    discovery_document = None
+    services = {}  # token path -> service
+    token_locks = {}  # token path -> lock of the credentials and service of the token store
+
+    def __init__(self, token_path=TOKEN_PATH, credentials_path=CREDENTIALS_PATH):
+        """Initializes GmailHelper object for the account whose tokens are stored in token_path.
+
+        credentials_path is the OAuth client secrets file, only read when the account has to be authorized.
+        """
+        self.token_path = token_path
+        self.credentials_path = credentials_path
+
     def authenticate_gmail(self):
-        """Authenticate the user and return the Gmail service."""
+        """Authenticate the user and return the Gmail service.
+
+        The service is built once per process and token store, and reused by later calls. It must only be used
+        from one thread at a time, threads of their own should use build_service.
+        """
+        with self.__token_lock():
+            if self.token_path not in GmailHelper.services:
+                GmailHelper.services[self.token_path] = self.build_service()
+            return GmailHelper.services[self.token_path]
+
+    def build_service(self):
+        """Builds a new Gmail service on the shared credentials, from the discovery document bundled with the client."""
+        from googleapiclient.discovery import build, build_from_document
+
+        creds = self.get_credentials()
+        document = self.__get_discovery_document()
+        if document is None:
+            return build('gmail', 'v1', credentials=creds)
+        return build_from_document(document, credentials=creds)
+
+    def get_credentials(self):
+        """Returns the credentials of the token store, loading, refreshing or creating them on first use."""
+        with self.__token_lock():
+            if self.token_path not in GmailHelper.credentials:
+                creds = self.__load_credentials()
+                self.__lock_refresh(creds)
+                GmailHelper.credentials[self.token_path] = creds
+            return GmailHelper.credentials[self.token_path]
+
+    def __token_lock(self):
+        """Returns the lock of the token store, so accounts load their credentials without waiting for each other."""
+        with GmailHelper.lock:
+            return GmailHelper.token_locks.setdefault(self.token_path, threading.RLock())
+
+    def __load_credentials(self):
+        """Loads credentials from the token store, running the authorization flow when there are no valid ones."""
         creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
+        # The token store keeps the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first time.
-        if os.path.exists('helpers/token.pickle'):
-            with open('helpers/token.pickle', 'rb') as token:
+        if os.path.exists(self.token_path):
+            with open(self.token_path, 'rb') as token:
                 creds = pickle.load(token)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
                 creds.refresh(Request())
             else:
-                flow = InstalledAppFlow.from_client_secrets_file('helpers/credentials.json', self.scopes)
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, self.scopes)
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open('helpers/token.pickle', 'wb') as token:
+            with open(self.token_path, 'wb') as token:
                 pickle.dump(creds, token)
+        return creds
+
+    def __lock_refresh(self, creds):
+        """Makes token refreshes of the shared credentials thread-safe.
+
+        Services on several threads share creds. When the token expires, only the first thread to notice
+        refreshes it, the others wait and then use the new token. Each account has a lock of its own, so
+        refreshes of different accounts don't wait for each other.
+        """
+        refresh = creds.refresh
+        lock = self.__token_lock()
+        def locked_refresh(request):
+            token = creds.token
+            with lock:
+                if creds.token == token:
+                    refresh(request)
+        creds.refresh = locked_refresh
 
-        service = build('gmail', 'v1', credentials=creds)
-        return service
+    def __get_discovery_document(self):
+        """Returns the parsed gmail v1 discovery document shipped with the client library, or None if it is missing."""
+        with GmailHelper.lock:
+            if GmailHelper.discovery_document is None:
+                from googleapiclient.discovery_cache import get_static_doc
+                document = get_static_doc('gmail', 'v1')
+                GmailHelper.discovery_document = json.loads(document) if document else None
+            return GmailHelper.discovery_document
@@ -0,0 +1,44 @@
+from helpers.email_database import CREATE_EMAIL_LABELS_TABLE
+
+class LabelStore:
+    """Keeps a local copy of each email's gmail label ids in the email database.
+
+    Labels are kept in the email_labels side table, one row per email with its label ids joined by commas.
+    An email without a row has unknown labels, an email with an empty string is known to have no labels.
+    Changes are not committed here, callers commit them together with their own writes.
+    """
+    def __init__(self, conn):
+        """Initializes LabelStore object on an open sqlite3 connection and creates its table."""
+        self.conn = conn
+        self.conn.execute(CREATE_EMAIL_LABELS_TABLE)
+
+    def get_labels(self, email_id):
+        """Returns the set of label ids stored for the email, or None if they are not known."""
+        row = self.conn.execute('SELECT label_ids FROM email_labels WHERE id = ?', (email_id,)).fetchone()
+        if row is None:
+            return None
+        return set(row[0].split(',')) if row[0] else set()
+
+    def set_labels(self, email_id, label_ids):
+        """Replaces the stored label ids of the email."""
+        self.set_labels_many([(email_id, label_ids)])
+
+    def set_labels_many(self, rows):
+        """Replaces the stored label ids for each (email_id, label_ids) pair in rows."""
+        self.conn.executemany('INSERT OR REPLACE INTO email_labels (id, label_ids) VALUES (?, ?)',
+                              ((email_id, ','.join(sorted(label_ids))) for email_id, label_ids in rows))
+
+    def update_labels(self, email_ids, add_labels=(), remove_labels=()):
+        """Adds and removes label ids for emails whose labels are known. Emails with unknown labels are left alone."""
+        for email_id in email_ids:
+            labels = self.get_labels(email_id)
+            if labels is not None:
+                self.set_labels(email_id, (labels | set(add_labels)) - set(remove_labels))
+
+    def delete_labels(self, email_ids):
+        """Forgets the stored label ids of the emails."""
+        self.conn.executemany('DELETE FROM email_labels WHERE id = ?', ((email_id,) for email_id in email_ids))
+
+    def commit(self):
+        """Commits pending label changes."""
+        self.conn.commit()
@@ -0,0 +1,167 @@
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds in seconds of the histogram buckets, like the Prometheus client defaults
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, math.inf)
+DEFAULT_PREFIX = 'happyfox_'
+
+class Metrics:
+    """Thread-safe counters and histograms of a run, exported as a JSON summary or in the Prometheus text format.
+
+    Series are identified by a metric name and keyword labels, e.g. increment('api_calls_total', method='messages.get').
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initializes Metrics object."""
+        self.buckets = buckets
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [count, sum, count per bucket]}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """Adds value to the counter."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value, usually a duration in seconds, in the histogram."""
+        key = tuple(sorted(labels.items()))
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [0, 0.0, [0] * len(self.buckets)]
+            series[key][0] += 1
+            series[key][1] += value
+            series[key][2][bucket] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager recording the seconds spent inside it in the histogram, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def labeled(self, **labels):
+        """Returns a view of these metrics that adds labels to every series, e.g. labeled(account='support')."""
+        return LabeledMetrics(self, labels)
+
+    def summary(self):
+        """Returns every counter and histogram as a JSON serializable dict."""
+        with self.lock:
+            counters = {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                        for name, series in self.counters.items()}
+            histograms = {name: [{'labels': dict(key), 'count': count, 'sum': total,
+                                  'buckets': {format_bound(bound): bucket_count
+                                              for bound, bucket_count in zip(self.buckets, bucket_counts)}}
+                                 for key, (count, total, bucket_counts) in series.items()]
+                          for name, series in self.histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self, prefix=DEFAULT_PREFIX):
+        """Returns every counter and histogram in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {prefix}{name} counter')
+                for key, value in series.items():
+                    lines.append(f'{prefix}{name}{format_labels(key)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for key, (count, total, bucket_counts) in series.items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f'{prefix}{name}_bucket{format_labels(key + (("le", format_bound(bound)),))} {cumulative}')
+                    lines.append(f'{prefix}{name}_sum{format_labels(key)} {total}')
+                    lines.append(f'{prefix}{name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path=None, prometheus_path=None):
+        """Writes the JSON summary and the Prometheus text file to the paths given.
+
+        Files are replaced atomically, so a Prometheus node exporter never reads a half written file.
+        """
+        for path, content in ((json_path, lambda: json.dumps(self.summary(), indent=4)),
+                              (prometheus_path, self.to_prometheus)):
+            if path:
+                with open(f'{path}.tmp', 'w') as file:
+                    file.write(content())
+                os.replace(f'{path}.tmp', path)
+                print(f"===== Metrics written to {path}")
+
+class LabeledMetrics:
+    """Records into a Metrics object with fixed labels added to every series, see Metrics.labeled."""
+    enabled = True
+
+    def __init__(self, metrics, labels):
+        """Initializes LabeledMetrics object."""
+        self.metrics = metrics
+        self.labels = labels
+
+    def increment(self, name, value=1, **labels):
+        """Adds value to the counter."""
+        self.metrics.increment(name, value, **self.labels, **labels)
+
+    def observe(self, name, value, **labels):
+        """Records a value in the histogram."""
+        self.metrics.observe(name, value, **self.labels, **labels)
+
+    def timer(self, name, **labels):
+        """Context manager recording the seconds spent inside it in the histogram."""
+        return self.metrics.timer(name, **self.labels, **labels)
+
+    def labeled(self, **labels):
+        """Returns a view that adds labels on top of these ones."""
+        return LabeledMetrics(self.metrics, {**self.labels, **labels})
+
+    def export(self, json_path=None, prometheus_path=None):
+        """Writes every series of the underlying metrics, see Metrics.export."""
+        self.metrics.export(json_path, prometheus_path)
+
+class NullMetrics:
+    """Metrics that record nothing, used when instrumentation is turned off."""
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        """Does nothing."""
+
+    def observe(self, name, value, **labels):
+        """Does nothing."""
+
+    def timer(self, name, **labels):
+        """Returns a context manager that does nothing."""
+        return nullcontext()
+
+    def labeled(self, **labels):
+        """Returns these metrics, which record nothing either way."""
+        return self
+
+    def export(self, json_path=None, prometheus_path=None):
+        """Does nothing."""
+
+NULL_METRICS = NullMetrics()
+
+def format_bound(bound):
+    """Formats a bucket upper bound as Prometheus does, +Inf for the last bucket."""
+    return '+Inf' if bound == math.inf else repr(bound)
+
+def format_labels(key):
+    """Formats (name, value) label pairs as a Prometheus label set, escaping the values."""
+    if not key:
+        return ''
+    pairs = []
+    for name, value in key:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
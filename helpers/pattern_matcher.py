@@ -0,0 +1,84 @@
+from collections import deque
+from helpers.rule_compiler import BODY_FIELD, DATE_FIELDS, FIELD_INDEXES, SUBSTRING_PREDICATES
+
+class AhoCorasick:
+    """Aho-Corasick automaton, finds which of many patterns occur in a text with one pass over the text."""
+    def __init__(self, patterns):
+        """Initializes AhoCorasick object and builds the automaton for the patterns."""
+        self.patterns = set(patterns)
+        self.goto = [{}]     # node -> {character: next node}
+        self.fail = [0]      # node -> node of the longest proper suffix that is also in the trie
+        self.outputs = [()]  # node -> patterns ending at this node, including those reached through fail links
+
+        for pattern in self.patterns:
+            node = 0
+            for character in pattern:
+                if character not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append(())
+                    self.goto[node][character] = len(self.goto) - 1
+                node = self.goto[node][character]
+            self.outputs[node] = (pattern,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for character, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(character, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def find_all(self, text):
+        """Returns the set of patterns occurring in text."""
+        found = set(self.outputs[0])  # the empty pattern occurs in every text
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for character in text:
+            while node and character not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(character, 0)
+            if outputs[node]:
+                found.update(outputs[node])
+        return found
+
+class ContainsMatcher:
+    """Checks all contains and does_not_contains conditions of a rule set with one automaton per email field.
+
+    Each field of an email is scanned once, the first time any condition asks about that email, and the
+    matches are shared by every condition and rule evaluated for it.
+    """
+    def __init__(self, rules, ignore_case=False):
+        """Initializes ContainsMatcher object and builds an automaton for each field used by substring conditions."""
+        self.ignore_case = ignore_case
+        patterns = {}
+        for rule in rules:
+            for condition in rule['conditions']:
+                # Bodies are not part of the email row, body conditions scan them on their own
+                if condition['predicate'] in SUBSTRING_PREDICATES and condition['field'] not in DATE_FIELDS | {BODY_FIELD}:
+                    patterns.setdefault(condition['field'], set()).add(self.normalize(condition['value']))
+        self.automatons = {field: AhoCorasick(field_patterns) for field, field_patterns in patterns.items()}
+        self.field_indexes = {field: FIELD_INDEXES[field] for field in self.automatons}
+        self.__email = None
+        self.__found = set()
+
+    def normalize(self, text):
+        """Returns text as it is compared, lower cased when matching ignores case."""
+        return text.lower() if self.ignore_case else text
+
+    def scan(self, email):
+        """Returns the set of (field, pattern) pairs occurring in the email row."""
+        found = set()
+        for field, automaton in self.automatons.items():
+            found.update((field, pattern) for pattern in automaton.find_all(self.normalize(email[self.field_indexes[field]])))
+        return found
+
+    def contains(self, email, field, pattern):
+        """Checks if the normalized pattern occurs in the email field, scanning each email only once."""
+        if email is not self.__email:
+            self.__found = self.scan(email)
+            self.__email = email
+        return (field, pattern) in self.__found
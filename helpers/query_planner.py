@@ -0,0 +1,50 @@
+from helpers.rule_compiler import DATE_FIELDS, NUMBER_FIELDS, SUBSTRING_PREDICATES, parse_age, rule_needs_body
+
+# Predicate -> SQL condition on the column named by the rule field. Values are always bound as parameters.
+# instr() keeps contains case sensitive like python's `in`, LIKE would ignore ASCII case.
+STRING_PREDICATE_SQL = {
+    'equals': '{field} = ?',
+    'does_not_equals': '{field} IS NOT ?',
+    'contains': 'instr({field}, ?) > 0',
+    'does_not_contains': 'instr({field}, ?) = 0',
+}
+# Date conditions become range scans on the indexed date_epoch column
+DATE_PREDICATE_SQL = {
+    'less_than': 'date_epoch > ?',
+    'greater_than': 'date_epoch < ?',
+}
+NUMBER_PREDICATE_SQL = {
+    'less_than': '{field} < ?',
+    'greater_than': '{field} > ?',
+}
+RULE_PREDICATE_SQL = {'All': ' AND ', 'Any': ' OR '}
+
+def condition_sql(condition, now, ignore_case=False):
+    """Returns the (sql, param) pair checking the condition. The rule must already be validated."""
+    field, predicate, value = condition['field'], condition['predicate'], condition['value']
+    if field in DATE_FIELDS:
+        return DATE_PREDICATE_SQL[predicate], int((now - parse_age(value)).timestamp())
+    if field in NUMBER_FIELDS:
+        return NUMBER_PREDICATE_SQL[predicate].format(field=field), value
+    if ignore_case and predicate in SUBSTRING_PREDICATES:
+        # unicode_lower is registered by connect_database, SQLite's lower() only folds ASCII letters
+        return STRING_PREDICATE_SQL[predicate].format(field=f'unicode_lower({field})'), value.lower()
+    return STRING_PREDICATE_SQL[predicate].format(field=field), value
+
+def rule_query(rule, now, ignore_case=False, extra_condition=None):
+    """Translates a validated rule into a parameterized query selecting the ids of matching emails.
+
+    ignore_case makes contains and does_not_contains conditions case insensitive, like in python, on connections
+    opened with connect_database. extra_condition is an optional
+    (sql, params) condition the selected emails must meet as well. Returns a tuple of (sql, params), or None for
+    rules with body conditions, since bodies are stored compressed and can't be searched in SQL.
+    """
+    if rule_needs_body(rule):
+        return None
+    conditions = [condition_sql(condition, now, ignore_case) for condition in rule['conditions']]
+    where_clause = RULE_PREDICATE_SQL[rule['predicate']].join(f'({sql})' for sql, _ in conditions)
+    params = [param for _, param in conditions]
+    if extra_condition:
+        where_clause = f'({where_clause}) AND {extra_condition[0]}'
+        params += extra_condition[1]
+    return f'SELECT id FROM emails WHERE {where_clause} ORDER BY rowid', params
@@ -0,0 +1,215 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from helpers.email_database import DATE_EPOCH_INDEX, parse_date_epoch
+
+# Rule field -> index of the column in an emails table row
+FIELD_INDEXES = {'id': 0, 'from_email': 1, 'to_email': 2, 'subject': 3, 'date_received': 4, 'cc': 6, 'list_id': 7,
+                 'size': 8}
+DATE_FIELDS = {'date_received'}
+NUMBER_FIELDS = {'size'}
+# The message body is not part of the row, it is looked up for the email when a condition needs it
+BODY_FIELD = 'body'
+
+# Rule action -> (label, True to add the label / False to remove it)
+ACTION_LABELS = {
+    'mark_as_unread': ('UNREAD', True),
+    'mark_as_read': ('UNREAD', False),
+    'move_to_starred': ('STARRED', True),
+    'move_to_important': ('IMPORTANT', True),
+    'move_to_spam': ('SPAM', True),
+    'move_to_category_social': ('CATEGORY_SOCIAL', True),
+    'move_to_inbox': ('INBOX', True),
+}
+
+STRING_PREDICATES = {
+    'equals': lambda email_value, target: target == email_value,
+    'does_not_equals': lambda email_value, target: target != email_value,
+    'contains': lambda email_value, target: target in email_value,
+    'does_not_contains': lambda email_value, target: target not in email_value,
+}
+# Date predicates compare UTC epoch seconds of the email against the cutoff
+DATE_PREDICATES = {
+    'less_than': lambda email_epoch, cutoff: email_epoch > cutoff,
+    'greater_than': lambda email_epoch, cutoff: email_epoch < cutoff,
+}
+# Number predicates compare the field with the value, e.g. the size in bytes
+NUMBER_PREDICATES = {
+    'less_than': lambda email_value, target: email_value < target,
+    'greater_than': lambda email_value, target: email_value > target,
+}
+SUBSTRING_PREDICATES = {'contains', 'does_not_contains'}
+# Rough relative cost of each predicate, cheaper conditions are evaluated first
+PREDICATE_COSTS = {'equals': 0, 'does_not_equals': 0, 'contains': 1, 'does_not_contains': 1,
+                   'less_than': 2, 'greater_than': 2}
+# Added to the cost of body conditions, which may have to load the body and scan much more text
+BODY_COST = 10
+RULE_PREDICATES = {'All', 'Any'}
+
+class CompiledRule:
+    """A rule from rules.json turned into a ready to call matcher and its label changes."""
+    def __init__(self, rule, matches, actions):
+        """Initializes CompiledRule object."""
+        self.rule = rule
+        self.matches = matches
+        self.actions = actions
+        self.label_changes = [ACTION_LABELS[action] for action in actions]
+        self.hash = rule_hash(rule)
+        # Whether the rule matches an email can change as time passes only when it has date conditions
+        self.time_dependent = any(condition['field'] in DATE_FIELDS for condition in rule['conditions'])
+        self.needs_body = rule_needs_body(rule)
+
+def rule_needs_body(rule):
+    """Checks if any condition of the rule is on the message body."""
+    return any(condition['field'] == BODY_FIELD for condition in rule['conditions'])
+
+def rule_hash(rule):
+    """Returns a short hash of the rule's content. Editing a rule in any way gives it a new hash."""
+    return hashlib.sha256(json.dumps(rule, sort_keys=True).encode()).hexdigest()[:16]
+
+def parse_age(value):
+    """Converts a rule value like '2 days' or '3 months' to a timedelta. One month is taken as 30 days."""
+    parts = value.split()
+    if len(parts) != 2 or parts[1] not in ('days', 'months') or not parts[0].isdigit():
+        raise ValueError(f"{value} - Invalid time unit in predicate value. Use 'days' or 'months'.")
+    days = int(parts[0])
+    return timedelta(days=days * 30 if parts[1] == 'months' else days)
+
+def validate_rule(rule):
+    """Returns a list of problems found in the rule, empty when the rule is valid."""
+    if not isinstance(rule, dict):
+        return [f"{rule} - Invalid rule, expected an object."]
+
+    errors = []
+    if rule.get('predicate') not in RULE_PREDICATES:
+        errors.append(f"{rule.get('predicate')} - Invalid rule predicate. Use 'All' or 'Any'.")
+
+    conditions = rule.get('conditions')
+    if not isinstance(conditions, list) or not conditions:
+        errors.append("Rule needs a non empty list of conditions.")
+        conditions = []
+    for condition in conditions:
+        field, predicate, value = condition.get('field'), condition.get('predicate'), condition.get('value')
+        if field not in FIELD_INDEXES and field != BODY_FIELD:
+            errors.append(f"{field} - Invalid field.")
+        elif field in NUMBER_FIELDS:
+            if predicate not in NUMBER_PREDICATES:
+                errors.append(f"{predicate} - Invalid predicate for number type field.")
+            if not isinstance(value, int) or isinstance(value, bool):
+                errors.append(f"{value} - Invalid value for number type field, expected an integer.")
+        elif field in DATE_FIELDS:
+            if predicate not in DATE_PREDICATES:
+                errors.append(f"{predicate} - Invalid predicate for date type field.")
+            try:
+                parse_age(str(value))
+            except ValueError as error:
+                errors.append(str(error))
+        elif predicate not in STRING_PREDICATES:
+            errors.append(f"{predicate} - Invalid predicate for string type field")
+        elif not isinstance(value, str):
+            errors.append(f"{value} - Invalid value for string type field, expected a string.")
+
+    actions = rule.get('actions')
+    if not isinstance(actions, list) or not actions:
+        errors.append("Rule needs a non empty list of actions.")
+        actions = []
+    for action in actions:
+        if action not in ACTION_LABELS:
+            errors.append(f"{action} - Invalid rule action.")
+
+    return errors
+
+def email_epoch(email, index):
+    """Returns the UTC epoch of an email row, parsing the Date header only for rows stored without date_epoch."""
+    if len(email) > DATE_EPOCH_INDEX and email[DATE_EPOCH_INDEX] is not None:
+        return email[DATE_EPOCH_INDEX]
+    return parse_date_epoch(email[index])
+
+def compile_condition(condition, now, matcher=None, body_of=None):
+    """Returns a function of an email row that checks the condition, with field index and date cutoff resolved.
+
+    With a ContainsMatcher, substring conditions look up the matcher's single scan of the email instead.
+    Body conditions get the body from body_of(email), and match no email without a body.
+    """
+    field = condition['field']
+    predicate, value = condition['predicate'], condition['value']
+
+    if field == BODY_FIELD:
+        return compile_body_condition(predicate, value, matcher, body_of)
+
+    index = FIELD_INDEXES[field]
+    if field in NUMBER_FIELDS:
+        compare = NUMBER_PREDICATES[predicate]
+        def check_number(email):
+            email_value = email[index] if len(email) > index else None
+            # Emails with an unknown value match no number condition
+            return email_value is not None and compare(email_value, value)
+        return check_number
+
+    if condition['field'] in DATE_FIELDS:
+        compare = DATE_PREDICATES[predicate]
+        cutoff = int((now - parse_age(value)).timestamp())
+        def check_date(email):
+            epoch = email_epoch(email, index)
+            # Emails with an unparseable date match no date condition
+            return epoch is not None and compare(epoch, cutoff)
+        return check_date
+
+    if matcher is not None and predicate in SUBSTRING_PREDICATES:
+        pattern = matcher.normalize(value)
+        if predicate == 'contains':
+            return lambda email: matcher.contains(email, field, pattern)
+        return lambda email: not matcher.contains(email, field, pattern)
+
+    compare = STRING_PREDICATES[predicate]
+    return lambda email: compare(email[index], value)
+
+def compile_body_condition(predicate, value, matcher=None, body_of=None):
+    """Returns a function of an email row that checks a body condition. The matcher only lends its case folding."""
+    compare = STRING_PREDICATES[predicate]
+    normalize = matcher.normalize if matcher is not None else None
+    target = normalize(value) if normalize else value
+    def check_body(email):
+        body = body_of(email) if body_of else None
+        if body is None:
+            return False
+        return compare(normalize(body) if normalize else body, target)
+    return check_body
+
+def condition_cost(condition):
+    """Returns the rough relative cost of checking the condition."""
+    return PREDICATE_COSTS.get(condition['predicate'], 0) + (BODY_COST if condition['field'] == BODY_FIELD else 0)
+
+def compile_conditions(rule, now=None, matcher=None, body_of=None):
+    """Returns a function of an email row that checks all conditions of the rule, short-circuiting cheapest first."""
+    now = now or datetime.now()
+    conditions = sorted(rule['conditions'], key=condition_cost)
+    checks = tuple(compile_condition(condition, now, matcher, body_of) for condition in conditions)
+
+    if rule['predicate'] == 'All':
+        return lambda email: all(check(email) for check in checks)
+    return lambda email: any(check(email) for check in checks)
+
+def compile_rule(rule, now=None, matcher=None, body_of=None):
+    """Compiles one valid rule into a CompiledRule object, see compile_rules."""
+    return CompiledRule(rule, compile_conditions(rule, now, matcher, body_of), rule['actions'])
+
+def validate_rules(rules):
+    """Checks all rules. Raises ValueError listing every problem in the rules."""
+    if not isinstance(rules, list):
+        raise ValueError("Invalid rules, expected a list of rules.")
+
+    errors = [f"Rule {number}: {error}" for number, rule in enumerate(rules, 1) for error in validate_rule(rule)]
+    if errors:
+        raise ValueError("Invalid rules:\n" + "\n".join(errors))
+
+def compile_rules(rules, now=None, matcher=None, body_of=None):
+    """Validates all rules and compiles them into CompiledRule objects.
+
+    Raises ValueError listing every problem in the rules, so an invalid rules.json fails before any email is touched.
+    matcher is an optional ContainsMatcher built from the same rules, see helpers/pattern_matcher.py.
+    body_of(email) returns the body of an email for body conditions, or None when it has none.
+    """
+    validate_rules(rules)
+    now = now or datetime.now()
+    return [compile_rule(rule, now, matcher, body_of) for rule in rules]
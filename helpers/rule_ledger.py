@@ -0,0 +1,61 @@
+from helpers.email_database import CREATE_RULE_LEDGER_RULES_TABLE, CREATE_RULE_LEDGER_TABLE
+
+class RuleLedger:
+    """Records which rules are done with which emails in the email database, so later runs skip them.
+
+    A rule is done with an email once its actions were applied to it, or when it didn't match and can't
+    match later. Rules are identified by the hash of their content, so an edited rule counts as a new rule
+    and is processed again for every email.
+    """
+    def __init__(self, conn):
+        """Initializes RuleLedger object on an open sqlite3 connection and creates its tables."""
+        self.conn = conn
+        self.conn.execute(CREATE_RULE_LEDGER_TABLE)
+        self.conn.execute(CREATE_RULE_LEDGER_RULES_TABLE)
+
+    def done_rules(self, email_id, rule_hashes):
+        """Returns the set of rule_hashes that are done with the email."""
+        placeholders = ', '.join('?' * len(rule_hashes))
+        rows = self.conn.execute(f'SELECT rule_hash FROM rule_ledger WHERE rule_hash IN ({placeholders}) AND email_id = ?',
+                                 (*rule_hashes, email_id)).fetchall()
+        return {row[0] for row in rows}
+
+    def record(self, email_id, rule_hashes):
+        """Records the rules as done with the email."""
+        self.record_many((email_id, rule_hash) for rule_hash in rule_hashes)
+
+    def record_many(self, pairs):
+        """Records each (email_id, rule_hash) pair in pairs as done."""
+        self.conn.executemany('INSERT OR IGNORE INTO rule_ledger (email_id, rule_hash) VALUES (?, ?)', pairs)
+
+    def pending_condition(self, rule_hashes):
+        """Returns a (sql, params) condition on emails table rows, true for emails some of rule_hashes are not done with."""
+        placeholders = ', '.join('?' * len(rule_hashes))
+        return (f'(SELECT count(*) FROM rule_ledger WHERE rule_hash IN ({placeholders}) AND email_id = emails.id) < ?',
+                [*rule_hashes, len(rule_hashes)])
+
+    def not_done_condition(self, rule_hash):
+        """Returns a (sql, params) condition on emails table rows, true for emails the rule is not done with."""
+        return 'NOT EXISTS (SELECT 1 FROM rule_ledger WHERE rule_hash = ? AND email_id = emails.id)', [rule_hash]
+
+    def forget_emails(self, email_ids):
+        """Forgets every rule recorded for the emails, e.g. emails deleted or moved out of the synced label."""
+        self.conn.executemany('DELETE FROM rule_ledger WHERE email_id = ?', ((email_id,) for email_id in email_ids))
+
+    def prune(self, rule_hashes):
+        """Forgets rules other than rule_hashes, e.g. rules since edited or removed from rules.json."""
+        known_hashes = {row[0] for row in self.conn.execute('SELECT rule_hash FROM rule_ledger_rules').fetchall()}
+        stale_hashes = known_hashes - set(rule_hashes)
+        self.conn.executemany('DELETE FROM rule_ledger WHERE rule_hash = ?', ((rule_hash,) for rule_hash in stale_hashes))
+        self.conn.executemany('DELETE FROM rule_ledger_rules WHERE rule_hash = ?', ((rule_hash,) for rule_hash in stale_hashes))
+        self.conn.executemany('INSERT OR IGNORE INTO rule_ledger_rules (rule_hash) VALUES (?)',
+                              ((rule_hash,) for rule_hash in set(rule_hashes) - known_hashes))
+
+    def clear(self):
+        """Forgets every recorded rule, so the next run processes all emails again."""
+        self.conn.execute('DELETE FROM rule_ledger')
+        self.conn.execute('DELETE FROM rule_ledger_rules')
+
+    def commit(self):
+        """Commits pending ledger changes."""
+        self.conn.commit()
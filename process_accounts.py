@@ -0,0 +1,117 @@
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from helpers.accounts import load_accounts
+from helpers.api_executor import (DEFAULT_BATCH_SIZE, DEFAULT_MAX_WORKERS, DEFAULT_QUOTA_PER_SECOND, ApiExecutor,
+                                  SharedBudget)
+from helpers.arguments import api_arguments, batch_arguments, metrics_arguments, rule_arguments, rule_options
+from helpers.gmail_helper import GmailHelper
+from helpers.metrics import NULL_METRICS, Metrics
+from fetch_emails import sync_emails
+from process_emails import open_processors
+
+DEFAULT_PARALLEL_ACCOUNTS = 8
+# Gmail API calls running at once over every account, which bounds the connections of the host
+DEFAULT_MAX_CALLS = 32
+# Gmail allows 1,200,000 quota units per project per minute, shared by every account
+DEFAULT_PROJECT_QUOTA_PER_SECOND = 20000
+
+def account_gmail_helper(account):
+    """Returns the GmailHelper of the account's token store."""
+    return GmailHelper(account.token, account.credentials)
+
+class AccountScheduler:
+    """Syncs and processes many gmail accounts at once, within one budget of API calls and quota units.
+
+    Up to parallel_accounts accounts run at a time, each on its own email database and executor. Every
+    executor keeps to the per user quota and all of them share budget (see helpers/api_executor.py).
+    """
+    def __init__(self, accounts, budget, parallel_accounts=DEFAULT_PARALLEL_ACCOUNTS, concurrency=DEFAULT_MAX_WORKERS,
+                 quota_per_second=DEFAULT_QUOTA_PER_SECOND, batch_size=DEFAULT_BATCH_SIZE, rule_options=None,
+                 metrics=None, gmail_helper_factory=account_gmail_helper):
+        """Initializes AccountScheduler object.
+
+        concurrency and quota_per_second limit each account's executor. rule_options are passed on to
+        RuleProcessor, e.g. {'ignore_case': True}. Metrics of every account are recorded in metrics, with an account label.
+        gmail_helper_factory returns the GmailHelper of an account.
+        """
+        self.accounts = accounts
+        self.budget = budget
+        self.parallel_accounts = parallel_accounts
+        self.concurrency = concurrency
+        self.quota_per_second = quota_per_second
+        self.batch_size = batch_size
+        self.rule_options = rule_options or {}
+        self.metrics = metrics or NULL_METRICS
+        self.gmail_helper_factory = gmail_helper_factory
+
+    def run(self):
+        """Runs every account and returns a dict of account name to the error it failed with, or None.
+
+        A failing account is reported and doesn't stop the others.
+        """
+        print(f"===== Running {len(self.accounts)} accounts, {self.parallel_accounts} at a time")
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.parallel_accounts, thread_name_prefix='account') as pool:
+            futures = {pool.submit(self.run_account, account): account for account in self.accounts}
+            for future in as_completed(futures):
+                account = futures[future]
+                errors[account.name] = future.exception()
+                if errors[account.name]:
+                    print(f"===== Account {account.name} failed: {errors[account.name]}")
+                self.metrics.increment('accounts_total', status='failed' if errors[account.name] else 'done')
+        print(f"===== {sum(error is None for error in errors.values())}/{len(self.accounts)} accounts done")
+        return errors
+
+    def run_account(self, account):
+        """Syncs the account's label into its email database, then applies its rules. Returns the number of emails saved."""
+        with open(account.rules, 'r') as file:
+            rules = json.load(file)
+        gmail_helper = self.gmail_helper_factory(account)
+        service = gmail_helper.authenticate_gmail()
+        # Series of every account go to the same metrics, told apart by the account label
+        metrics = self.metrics.labeled(account=account.name)
+        executor = ApiExecutor(gmail_helper.build_service, max_workers=self.concurrency,
+                               quota_per_second=self.quota_per_second, metrics=metrics, budget=self.budget)
+        conn = None
+        try:
+            conn, _, email_processor = open_processors(service, account.database, rules=rules, executor=executor,
+                                                       metrics=metrics, **self.rule_options)
+            saved_count = sync_emails(service, label=account.label, batch_size=self.batch_size, executor=executor,
+                                      conn=conn, raw=account.raw, metrics=metrics)
+            email_processor.process_emails_in_database()
+        finally:
+            executor.shutdown()
+            if conn:
+                conn.close()
+        print(f"===== Account {account.name} done, {saved_count} emails saved")
+        return saved_count
+
+def parse_args():
+    """Parses command line options of the process_accounts.py script."""
+    arg_parser = argparse.ArgumentParser(description='Fetch and process the emails of every account in an accounts file.',
+                                         parents=[api_arguments(), batch_arguments(), rule_arguments(), metrics_arguments()])
+    arg_parser.add_argument('--accounts', default='accounts.json', help='Accounts file, see README.md.')
+    arg_parser.add_argument('--parallel-accounts', type=int, default=DEFAULT_PARALLEL_ACCOUNTS,
+                            help='Accounts fetched and processed at once.')
+    arg_parser.add_argument('--max-calls', type=int, default=DEFAULT_MAX_CALLS,
+                            help='Gmail API calls run at once over every account.')
+    arg_parser.add_argument('--project-quota', type=int, default=DEFAULT_PROJECT_QUOTA_PER_SECOND,
+                            help='Gmail quota units to use per second over every account, 0 turns it off.')
+    return arg_parser.parse_args()
+
+if __name__ == '__main__':
+    print("!!!!! SCRIPT STARTED - process_accounts.py")
+    args = parse_args()
+    accounts = load_accounts(args.accounts)
+    metrics = Metrics() if args.metrics_json or args.metrics_prometheus else NULL_METRICS
+    scheduler = AccountScheduler(accounts, SharedBudget(args.max_calls, args.project_quota or None),
+                                 parallel_accounts=args.parallel_accounts, concurrency=args.concurrency,
+                                 quota_per_second=args.quota or None, batch_size=args.batch_size,
+                                 rule_options=rule_options(args),
+                                 metrics=metrics)
+    errors = scheduler.run()
+    metrics.export(args.metrics_json, args.metrics_prometheus)
+    print("!!!!! SCRIPT COMPLETED - process_accounts.py")
+    sys.exit(1 if any(errors.values()) else 0)
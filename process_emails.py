@@ -1,22 +1,277 @@
+import argparse
 import json
-import sqlite3
-from datetime import datetime, timedelta
-from dateutil import parser
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from helpers.api_executor import ApiExecutor
+from helpers.arguments import api_arguments, metrics_arguments, rule_arguments, rule_options
+from helpers.body_store import BodyStore
+from helpers.email_database import DATABASE_PATH, connect_database, iter_email_chunks
 from helpers.gmail_helper import GmailHelper
+from helpers.label_store import LabelStore
+from helpers.metrics import NULL_METRICS, Metrics
+from helpers.pattern_matcher import ContainsMatcher
+from helpers.query_planner import rule_query
+from helpers.rule_compiler import ACTION_LABELS, compile_rule, validate_rules
+from helpers.rule_ledger import RuleLedger
+
+# Gmail accepts at most 1000 message ids in one batchModify call.
+MAX_BATCH_MODIFY_IDS = 1000
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_PROGRESS_INTERVAL = 1000
+# The emails table is split in more shards than workers, so a slow shard doesn't hold up the whole run
+SHARDS_PER_WORKER = 4
 
 class RuleProcessor:
     """This class handles everything related to rules and their processing."""
-    def __init__(self, service):
-        """Initializes RuleProcessor object and loads all rules."""
+    def __init__(self, service, label_store=None, refresh_labels=False, multi_pattern=False, ignore_case=False,
+                 rules=None, now=None, executor=None, metrics=None, ledger=None, body_store=None):
+        """Initializes RuleProcessor object, loads all rules and compiles them.
+
+        rules replace rules.json when given, rules done with an email are recorded in ledger.
+        """
         self.gmail_service = service
-        self.rules = self.__load_rules()
+        self.metrics = metrics or NULL_METRICS
+        self.executor = executor or ApiExecutor.for_service(service, self.metrics)
+        self.label_store = label_store
+        self.refresh_labels = refresh_labels
+        self.multi_pattern = multi_pattern
+        self.ignore_case = ignore_case
+        self.ledger = ledger
+        self.body_store = body_store
+        self.bodies = {}  # email id -> body, for the emails of the last load_bodies call
+        self.planned_rule_hashes = {}  # email id -> hashes of the matched rules, for emails in the plan being applied
+        self.set_rules(self.__load_rules() if rules is None else rules, now)
+
+    def set_rules(self, rules, now=None):
+        """Validates and compiles the rules to apply. Raises ValueError if any rule is invalid."""
+        now = now or datetime.now()
+        validate_rules(rules)
+        # Rules are valid at this point, so the matcher can be built from them
+        matcher = ContainsMatcher(rules, self.ignore_case) if self.multi_pattern or self.ignore_case else None
+        compiled_rules = [compile_rule(rule, now, matcher, self.email_body) for rule in rules]
+        if self.metrics.enabled:
+            # Only wrapped when metrics are on, so rule evaluation costs nothing extra otherwise
+            for number, compiled_rule in enumerate(compiled_rules, 1):
+                compiled_rule.matches = self.__measure_matches(number, compiled_rule.matches)
+        self.compiled_rules = compiled_rules
+        self.rule_hashes = [compiled_rule.hash for compiled_rule in compiled_rules]
+        self.needs_bodies = any(compiled_rule.needs_body for compiled_rule in compiled_rules)
+        self.rule_queries = [rule_query(rule, now, self.ignore_case,
+                                        self.ledger.not_done_condition(compiled_rule.hash) if self.ledger else None)
+                             for rule, compiled_rule in zip(rules, compiled_rules)]
+        self.rules = rules
+        self.now = now
+
+    def load_bodies(self, email_ids):
+        """Reads and decompresses the bodies of the emails at once, when some rule has body conditions."""
+        if not (self.needs_bodies and self.body_store):
+            return
+        with self.metrics.timer('db_read_seconds', table='email_bodies'):
+            self.bodies = self.body_store.get_bodies(email_ids)
+
+    def email_body(self, email):
+        """Returns the body of the email, or None when it has none. Emails not loaded with load_bodies are read one by one."""
+        if email[0] in self.bodies:
+            return self.bodies[email[0]]
+        if not self.body_store:
+            return None
+        self.bodies = {email[0]: self.body_store.get_body(email[0])}
+        return self.bodies[email[0]]
 
     def apply_rules(self, email):
         """Applies all eligible rules to the specified email."""
-        for rule in self.rules:
-            if self.__evaluate_rule(email, rule):
-                self.__execute_rule_actions(email, rule['actions'])
-        
+        done_hashes = []
+        for compiled_rule in self.__pending_rules(email[0]):
+            if compiled_rule.matches(email):
+                self.__execute_rule_actions(email, compiled_rule.actions)
+                done_hashes.append(compiled_rule.hash)
+            elif self.__settles(compiled_rule, email):
+                done_hashes.append(compiled_rule.hash)
+
+        if self.ledger and done_hashes:
+            self.record_done(email[0], done_hashes)
+            # Committed right away, so an interrupted run doesn't apply the actions again, and no write
+            # transaction stays open during the gmail calls of the next email
+            self.commit()
+
+    def plan_rules(self, email, plan):
+        """Evaluates all rules for the email and records the resulting label changes in plan, without calling gmail.
+
+        plan maps (labels_to_add, labels_to_remove) to the list of email ids that need exactly that change.
+        Actions are applied in rule order, so when rules disagree about a label the later one wins.
+        """
+        add_labels, remove_labels, matched_hashes, settled_hashes = self.evaluate_label_changes(email)
+        if self.ledger and settled_hashes:
+            self.record_done(email[0], settled_hashes)
+        self.add_to_plan(email[0], add_labels, remove_labels, plan, matched_hashes)
+
+    def evaluate_label_changes(self, email, compiled_rules=None):
+        """Returns the (labels_to_add, labels_to_remove) sets all matching rules add up to for the email.
+
+        Also returns the hashes of the matched rules, and of the rules that didn't match and can't match later,
+        as the tuple (labels_to_add, labels_to_remove, matched_hashes, settled_hashes).
+        Only compiled_rules are evaluated when given, all rules otherwise.
+        """
+        add_labels, remove_labels, matched_hashes, settled_hashes = set(), set(), [], []
+        for compiled_rule in self.__pending_rules(email[0], compiled_rules):
+            if compiled_rule.matches(email):
+                self.__merge_label_changes(compiled_rule.label_changes, add_labels, remove_labels)
+                matched_hashes.append(compiled_rule.hash)
+            elif self.__settles(compiled_rule, email):
+                settled_hashes.append(compiled_rule.hash)
+        return add_labels, remove_labels, matched_hashes, settled_hashes
+
+    def plan_rules_in_database(self, conn, plan, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Like plan_rules, but lets SQLite find the emails matching each rule, so only matching rows are read.
+
+        Each rule runs as one parameterized query on the emails table of the open connection conn.
+        With a ledger, the queries skip emails each rule is already done with. Rules with body conditions
+        can't be queried, they are evaluated together in python over the emails table, chunk_size emails at a time.
+        """
+        matched_rules = {}  # email id -> positions of the matched rules
+        body_rules = []
+        for position, (compiled_rule, query) in enumerate(zip(self.compiled_rules, self.rule_queries)):
+            if query is None:
+                body_rules.append(compiled_rule)
+                continue
+            # The query is the rule's evaluation here, timed per rule like the python evaluation of the other modes
+            with self.metrics.timer('rule_evaluation_seconds', rule=position + 1), \
+                    self.metrics.timer('db_read_seconds', table='emails'):
+                email_ids = [email_id for (email_id,) in conn.execute(*query)]
+            self.metrics.increment('rule_hits_total', len(email_ids), rule=position + 1)
+            for email_id in email_ids:
+                matched_rules.setdefault(email_id, []).append(position)
+
+        if body_rules:
+            self.__match_body_rules(conn, body_rules, matched_rules, chunk_size)
+
+        for email_id, positions in matched_rules.items():
+            add_labels, remove_labels = set(), set()
+            # Changes are merged in rule order, so the later rule wins like in the other modes
+            for position in sorted(positions):
+                self.__merge_label_changes(self.compiled_rules[position].label_changes, add_labels, remove_labels)
+            self.add_to_plan(email_id, add_labels, remove_labels, plan,
+                             [self.compiled_rules[position].hash for position in sorted(positions)])
+
+    def add_to_plan(self, email_id, add_labels, remove_labels, plan, rule_hashes=()):
+        """Records the email's label changes in plan, leaving out changes the stored labels say are already in place.
+
+        rule_hashes are the rules the changes come from, recorded in the ledger as done once the plan is applied.
+        """
+        current_labels = None
+        if self.label_store and not self.refresh_labels:
+            with self.metrics.timer('db_read_seconds', table='email_labels'):
+                current_labels = self.label_store.get_labels(email_id)
+        if current_labels is not None:
+            add_labels = add_labels - current_labels
+            remove_labels = remove_labels & current_labels
+
+        if add_labels or remove_labels:
+            plan.setdefault((frozenset(add_labels), frozenset(remove_labels)), []).append(email_id)
+            if self.ledger and rule_hashes:
+                self.planned_rule_hashes[email_id] = rule_hashes
+        elif self.ledger and rule_hashes:
+            # Nothing is left to change, so the rules are done with the email already
+            self.record_done(email_id, rule_hashes)
+
+    def apply_plan(self, plan):
+        """Applies the label changes in plan with batchModify calls of up to 1000 emails each.
+
+        Calls run concurrently on the executor. The label store and the ledger are updated as each call completes.
+        """
+        # Ledger writes of planning are committed first, so other writers aren't locked out while gmail calls
+        # are retried and backed off
+        self.commit()
+        calls = []
+        for (add_labels, remove_labels), email_ids in plan.items():
+            for start in range(0, len(email_ids), MAX_BATCH_MODIFY_IDS):
+                body = {'ids': email_ids[start:start + MAX_BATCH_MODIFY_IDS],
+                        'addLabelIds': sorted(add_labels), 'removeLabelIds': sorted(remove_labels)}
+                future = self.executor.submit(self.executor.execute,
+                                              lambda service, body=body: service.users().messages().batchModify(userId='me', body=body),
+                                              'messages.batchModify')
+                calls.append((future, body['ids'], add_labels, remove_labels))
+
+        for future, email_ids, add_labels, remove_labels in calls:
+            future.result()
+            for label in add_labels:
+                self.metrics.increment('actions_applied_total', len(email_ids), label=label, change='add')
+            for label in remove_labels:
+                self.metrics.increment('actions_applied_total', len(email_ids), label=label, change='remove')
+            if self.label_store:
+                with self.metrics.timer('db_write_seconds', table='email_labels'):
+                    self.label_store.update_labels(email_ids, add_labels, remove_labels)
+                    self.label_store.commit()
+            if self.ledger:
+                with self.metrics.timer('db_write_seconds', table='rule_ledger'):
+                    self.ledger.record_many((email_id, rule_hash) for email_id in email_ids
+                                            for rule_hash in self.planned_rule_hashes.pop(email_id, ()))
+                    self.ledger.commit()
+
+        self.commit()
+
+    def record_done(self, email_id, rule_hashes):
+        """Records the rules as done with the email in the ledger. Doesn't commit."""
+        with self.metrics.timer('db_write_seconds', table='rule_ledger'):
+            self.ledger.record(email_id, rule_hashes)
+
+    def commit(self):
+        """Commits the rules recorded as done in the ledger, if any."""
+        if self.ledger:
+            with self.metrics.timer('db_write_seconds', table='rule_ledger'):
+                self.ledger.commit()
+
+    def __pending_rules(self, email_id, compiled_rules=None):
+        """Returns the compiled rules that are not done with the email yet, all of them without a ledger."""
+        compiled_rules = self.compiled_rules if compiled_rules is None else compiled_rules
+        if not self.ledger:
+            return compiled_rules
+        done_hashes = self.ledger.done_rules(email_id, [compiled_rule.hash for compiled_rule in compiled_rules])
+        return [compiled_rule for compiled_rule in compiled_rules if compiled_rule.hash not in done_hashes]
+
+    def __settles(self, compiled_rule, email):
+        """Checks if a rule that didn't match the email can't match it later either.
+
+        Date rules can match once emails age, and body rules once the body of an email without one is fetched.
+        """
+        if compiled_rule.time_dependent:
+            return False
+        return not (compiled_rule.needs_body and self.email_body(email) is None)
+
+    def __match_body_rules(self, conn, body_rules, matched_rules, chunk_size):
+        """Evaluates body_rules on the emails some of them is not done with, adding matches to matched_rules.
+
+        The bodies of each chunk of emails are loaded once for all body rules.
+        """
+        positions = {id(compiled_rule): position for position, compiled_rule in enumerate(self.compiled_rules)}
+        condition = self.ledger.pending_condition([compiled_rule.hash for compiled_rule in body_rules]) if self.ledger else None
+        for chunk in iter_email_chunks(conn, chunk_size, condition=condition):
+            self.load_bodies([email.id for email in chunk])
+            for email in chunk:
+                for compiled_rule in self.__pending_rules(email.id, body_rules):
+                    if compiled_rule.matches(email):
+                        matched_rules.setdefault(email.id, []).append(positions[id(compiled_rule)])
+                    elif self.ledger and self.__settles(compiled_rule, email):
+                        self.record_done(email.id, [compiled_rule.hash])
+
+    def __measure_matches(self, number, matches):
+        """Wraps a compiled rule's matcher to record the evaluation time and hits of rule number."""
+        def measured_matches(email):
+            start = time.perf_counter()
+            matched = matches(email)
+            self.metrics.observe('rule_evaluation_seconds', time.perf_counter() - start, rule=number)
+            if matched:
+                self.metrics.increment('rule_hits_total', rule=number)
+            return matched
+        return measured_matches
+
+    def __merge_label_changes(self, label_changes, add_labels, remove_labels):
+        """Merges a rule's (label, add) changes into the sets, the latest change of a label wins."""
+        for label, add in label_changes:
+            (add_labels if add else remove_labels).add(label)
+            (remove_labels if add else add_labels).discard(label)
 
     def __load_rules(self):
         """Load rules from the JSON file."""
@@ -24,122 +279,198 @@ class RuleProcessor:
             rules = json.load(file)
         return rules
 
-        
-    def __evaluate_rule(self, email, rule):
-        """Checks if the specified rule is applicable on the specified email or not."""
-        match_count = 0
-        for condition in rule['conditions']:
-            field, predicate, value = condition['field'], condition['predicate'], condition['value']
-            email_value = email[self.__convert_field_to_index(field)]
-
-            if field == 'date_received':
-                if self.__evaluate_date_predicate(email_value, predicate, value):
-                    match_count += 1
-            else:
-                if self.__evaluate_string_predicate(email_value, predicate, value):
-                    match_count += 1
-
-        return match_count == len(rule['conditions']) if rule['predicate'] == 'All' else match_count > 0
-
-    def __convert_field_to_index(self, field):
-        """Convert field name to corresponding email table index."""
-        fields = {'id': 0, 'from_email': 1, 'to_email': 2, 'subject': 3, 'date_received': 4}
-        return fields[field]
-
-    def __evaluate_string_predicate(self, email_value, predicate, target):
-        """Evaluate predicates for string type fields."""
-        if predicate == "contains":
-            return target in email_value
-        elif predicate == "does_not_contains":
-            return target not in email_value
-        elif predicate == "equals":
-            return target == email_value
-        elif predicate == "does_not_equals":
-            return target != email_value
-        else:
-            raise ValueError(f"{predicate} - Invalid predicate for string type field")
-
-
-    def __evaluate_date_predicate(self, email_date_str, predicate, target):
-        """Evaluate predicates for date type fields."""
-        # Convert email date string to datetime object
-        email_date = parser.parse(email_date_str, ignoretz=True)
-        current_date = datetime.now(email_date.tzinfo)  # Ensure same timezone
-
-        days = None
-        if 'days' in target:
-            days = int(target.split()[0])
-        elif 'months' in target:
-            days = int(target.split()[0])* 30 # Roughly taking one month = 30 days
-        else:
-            raise ValueError(f"{target} - Invalid time unit in predicate value. Use 'days' or 'months'.")
-            
-            
-        if predicate == 'less_than':
-            target_date = current_date - timedelta(days=days)
-            return email_date > target_date
-        elif predicate == 'greater_than':
-            target_date = current_date - timedelta(days=days)
-            return email_date < target_date
-        else:
-            raise ValueError(f"{predicate} - Invalid predicate for date type field.")
-            
-
     def __execute_rule_actions(self, email, actions):
         """Applies all the specified actions on the specified email."""
         for action in actions:
-            if action == 'mark_as_unread':
-                self.__add_label(email, 'UNREAD')
-            elif action == 'mark_as_read':
-                self.__remove_label(email, 'UNREAD')
-            elif action == 'move_to_starred':
-                self.__add_label(email, 'STARRED')
-            elif action == 'move_to_important':
-                self.__add_label(email, 'IMPORTANT')
-            elif action == 'move_to_spam':
-                self.__add_label(email, 'SPAM')
-            elif action == 'move_to_category_social':
-                self.__add_label(email, 'CATEGORY_SOCIAL')
-            elif action == 'move_to_inbox':
-                self.__add_label(email, 'INBOX')
+            label, add = self.__action_label(action)
+            if add:
+                self.__add_label(email, label)
             else:
-                raise ValueError(f"{action} - Invalid rule action.")
+                self.__remove_label(email, label)
+
+    def __action_label(self, action):
+        """Returns the (label, add) pair the specified action stands for."""
+        if action not in ACTION_LABELS:
+            raise ValueError(f"{action} - Invalid rule action.")
+        return ACTION_LABELS[action]
 
     def __add_label(self, email, label):
         """Adds label to email if not already present."""
-        label_ids = self.gmail_service.users().messages().get(userId='me', id=email[0]).execute()['labelIds']
+        label_ids = self.__get_label_ids(email)
         if label not in label_ids:
-            self.gmail_service.users().messages().modify(userId='me',id=email[0],body={'addLabelIds': [label]}).execute()
+            response = self.executor.execute(
+                lambda service: service.users().messages().modify(userId='me',id=email[0],body={'addLabelIds': [label]}),
+                'messages.modify')
+            self.metrics.increment('actions_applied_total', label=label, change='add')
+            self.__store_label_ids(email, response)
 
     def __remove_label(self, email, label):
         """Removes label from email if present."""
-        label_ids = self.gmail_service.users().messages().get(userId='me', id=email[0]).execute()['labelIds']
+        label_ids = self.__get_label_ids(email)
         if label in label_ids:
-            self.gmail_service.users().messages().modify(userId='me',id=email[0],body={'removeLabelIds': [label]}).execute()
+            response = self.executor.execute(
+                lambda service: service.users().messages().modify(userId='me',id=email[0],body={'removeLabelIds': [label]}),
+                'messages.modify')
+            self.metrics.increment('actions_applied_total', label=label, change='remove')
+            self.__store_label_ids(email, response)
+
+    def __get_label_ids(self, email):
+        """Returns the label ids of the email, from the label store when possible and from gmail otherwise."""
+        if self.label_store and not self.refresh_labels:
+            with self.metrics.timer('db_read_seconds', table='email_labels'):
+                label_ids = self.label_store.get_labels(email[0])
+            if label_ids is not None:
+                return label_ids
+
+        label_ids = self.executor.execute(
+            lambda service: service.users().messages().get(userId='me', id=email[0], format='minimal'),
+            'messages.get')['labelIds']
+        if self.label_store:
+            with self.metrics.timer('db_write_seconds', table='email_labels'):
+                self.label_store.set_labels(email[0], label_ids)
+                self.label_store.commit()
+        return label_ids
+
+    def __store_label_ids(self, email, response):
+        """Saves the label ids gmail returned from a modify call to the label store."""
+        if self.label_store and 'labelIds' in response:
+            with self.metrics.timer('db_write_seconds', table='email_labels'):
+                self.label_store.set_labels(email[0], response['labelIds'])
+                self.label_store.commit()
 
 
 class EmailProcessor:
     """This class handles everything related to emails and their processing."""
-    def __init__(self, rule_processor):
-        """Initializes EmailProcessor object loads all emails."""
+    def __init__(self, rule_processor, load_emails=True, chunk_size=DEFAULT_CHUNK_SIZE,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL, metrics=None, ledger=None, database_path=DATABASE_PATH):
+        """Initializes EmailProcessor object loads all emails from the email database at database_path.
+
+        Without load_emails, the emails table is streamed in chunks of chunk_size rows instead.
+        """
         self.rule_processor = rule_processor
-        self.emails = self.__fetch_emails()
+        self.metrics = metrics or NULL_METRICS
+        self.ledger = ledger
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.database_path = database_path
+        self.emails = self.__fetch_emails() if load_emails else None
 
     def process_emails(self):
         """Processes each email and sends them to rule_processor"""
         print("===== Processing Emails")
         counter = 0
-        for email in self.emails:
-            counter += 1
-            print(f"===== Processing email {counter}/{len(self.emails)}. Applying rules....")
-            self.rule_processor.apply_rules(email)
+        with self.metrics.timer('stage_seconds', stage='process'):
+            for email in self.__email_source():
+                counter += 1
+                self.__report_progress(counter)
+                self.rule_processor.apply_rules(email)
+        self.rule_processor.commit()
+        self.metrics.increment('emails_processed_total', counter)
         
+        print(f"===== All Emails Processed ({counter})")
+
+    def process_emails_planned(self):
+        """Evaluates the rules for every email first, then applies the grouped label changes in bulk."""
+        print("===== Planning rule actions for emails")
+        plan = {}
+        counter = 0
+        with self.metrics.timer('stage_seconds', stage='plan'):
+            for email in self.__email_source():
+                counter += 1
+                self.__report_progress(counter)
+                self.rule_processor.plan_rules(email, plan)
+        self.metrics.increment('emails_processed_total', counter)
+        self.__apply_plan(plan)
+
+    def process_emails_in_database(self):
+        """Finds the emails matching each rule with SQL queries, then applies the grouped label changes in bulk."""
+        print("===== Planning rule actions with database queries")
+        conn = connect_database(self.database_path)
+        plan = {}
+        with self.metrics.timer('stage_seconds', stage='plan'):
+            self.rule_processor.plan_rules_in_database(conn, plan, self.chunk_size)
+        conn.close()
+        self.__apply_plan(plan)
+
+    def process_emails_parallel(self, workers):
+        """Evaluates the rules in a pool of worker processes, then applies the grouped label changes in bulk.
+
+        The emails table is split into rowid ranges. Each worker compiles the rules itself and returns the label
+        changes of its range, and results are merged in rowid order, so the plan doesn't depend on worker timing.
+        """
+        print(f"===== Planning rule actions for emails with {workers} workers")
+        shards = self.__rowid_ranges(workers * SHARDS_PER_WORKER)
+        rule_processor = self.rule_processor
+        plan_range = partial(plan_email_range, rule_processor.rules, rule_processor.now,
+                             {'multi_pattern': rule_processor.multi_pattern, 'ignore_case': rule_processor.ignore_case},
+                             chunk_size=self.chunk_size, use_ledger=self.ledger is not None,
+                             database_path=self.database_path)
+        plan = {}
+        counter = 0
+        with self.metrics.timer('stage_seconds', stage='plan'), ProcessPoolExecutor(max_workers=workers) as executor:
+            for changes in executor.map(plan_range, shards):
+                for email_id, add_labels, remove_labels, matched_hashes, settled_hashes in changes:
+                    if self.ledger and settled_hashes:
+                        rule_processor.record_done(email_id, settled_hashes)
+                    rule_processor.add_to_plan(email_id, set(add_labels), set(remove_labels), plan, matched_hashes)
+                counter += 1
+                print(f"===== Planned {counter}/{len(shards)} shards")
+        self.__apply_plan(plan)
+
+    def iter_emails(self, after_rowid=0, last_rowid=None):
+        """Lazily yields every email of the database as an EmailRecord, reading chunk_size rows at a time.
+
+        Chunks are read by rowid ranges, so no read lock is held between chunks while rule actions write.
+        after_rowid and last_rowid limit the emails to those with after_rowid < rowid <= last_rowid.
+        With a ledger, emails every rule is done with are skipped. The bodies of each chunk are loaded
+        in the rule processor before its emails are yielded.
+        """
+        conn = connect_database(self.database_path)
+        try:
+            condition = self.ledger.pending_condition(self.rule_processor.rule_hashes) if self.ledger else None
+            chunks = iter_email_chunks(conn, self.chunk_size, after_rowid, last_rowid, condition)
+            while True:
+                with self.metrics.timer('db_read_seconds', table='emails'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                self.rule_processor.load_bodies([email.id for email in chunk])
+                yield from chunk
+        finally:
+            conn.close()
+
+    def __apply_plan(self, plan):
+        """Applies the planned label changes through the rule processor."""
+        print(f"===== Applying {len(plan)} distinct label changes to {sum(len(ids) for ids in plan.values())} emails")
+        with self.metrics.timer('stage_seconds', stage='apply'):
+            self.rule_processor.apply_plan(plan)
         print("===== All Emails Processed")
 
+    def __rowid_ranges(self, count):
+        """Splits the emails table into at most count (after_rowid, last_rowid) ranges of about equal rowid span."""
+        conn = connect_database(self.database_path)
+        first_rowid, last_rowid = conn.execute('SELECT min(rowid), max(rowid) FROM emails').fetchone()
+        conn.close()
+        if first_rowid is None:
+            return []
+
+        span = last_rowid - first_rowid + 1
+        step = -(-span // count)  # ceiling division
+        return [(start - 1, min(start + step - 1, last_rowid)) for start in range(first_rowid, last_rowid + 1, step)]
+
+    def __email_source(self):
+        """Returns the loaded emails, or a stream of the emails table when they were not loaded."""
+        return self.emails if self.emails is not None else self.iter_emails()
+
+    def __report_progress(self, counter):
+        """Prints progress every progress_interval emails."""
+        if counter % self.progress_interval == 0:
+            print(f"===== Processed {counter} emails")
+
     def __fetch_emails(self):
         """Fetches emails from database"""
         print("===== Fetching Emails from database")
-        conn = sqlite3.connect('email_database.db')
+        conn = connect_database(self.database_path)
         c = conn.cursor()
         c.execute('SELECT * FROM emails')
         emails = c.fetchall()
@@ -148,14 +479,93 @@ class EmailProcessor:
         return emails
 
 
+def open_processors(service, database_path=DATABASE_PATH, rules=None, executor=None, metrics=None, reprocess=False,
+                    chunk_size=DEFAULT_CHUNK_SIZE, progress_interval=DEFAULT_PROGRESS_INTERVAL, **rule_options):
+    """Opens the email database and builds the rule and email processors on it, with the rule ledger up to date.
+
+    rule_options are passed on to RuleProcessor, e.g. ignore_case=True. reprocess forgets the ledger first.
+    Returns a tuple of (conn, rule_processor, email_processor), the caller closes conn.
+    """
+    conn = connect_database(database_path)
+    ledger = RuleLedger(conn)
+    if reprocess:
+        ledger.clear()
+    rule_processor = RuleProcessor(service, LabelStore(conn), rules=rules, executor=executor, metrics=metrics,
+                                   ledger=ledger, body_store=BodyStore(conn), **rule_options)
+    ledger.prune(rule_processor.rule_hashes)
+    ledger.commit()
+    email_processor = EmailProcessor(rule_processor, load_emails=False, chunk_size=chunk_size,
+                                     progress_interval=progress_interval, metrics=metrics, ledger=ledger,
+                                     database_path=database_path)
+    return conn, rule_processor, email_processor
+
+def plan_email_range(rules, now, options, rowid_range, chunk_size=DEFAULT_CHUNK_SIZE, use_ledger=False,
+                     database_path=DATABASE_PATH):
+    """Worker side of EmailProcessor.process_emails_parallel.
+
+    Evaluates the rules on the emails in rowid_range and returns a list of (email_id, labels_to_add, labels_to_remove,
+    matched_hashes, settled_hashes) for the emails that any rule matched or settled, in rowid order.
+    use_ledger skips the rules the ledger says are done. Workers only read the ledger, the caller records results.
+    Emails are read from the email database at database_path.
+    """
+    conn = connect_database(database_path)
+    ledger = RuleLedger(conn) if use_ledger else None
+    rule_processor = RuleProcessor(None, rules=rules, now=now, ledger=ledger, body_store=BodyStore(conn), **options)
+    email_processor = EmailProcessor(rule_processor, load_emails=False, chunk_size=chunk_size, ledger=ledger,
+                                     database_path=database_path)
+    changes = []
+    for email in email_processor.iter_emails(*rowid_range):
+        add_labels, remove_labels, matched_hashes, settled_hashes = rule_processor.evaluate_label_changes(email)
+        if matched_hashes or (use_ledger and settled_hashes):
+            changes.append((email.id, tuple(sorted(add_labels)), tuple(sorted(remove_labels)), tuple(matched_hashes),
+                            tuple(settled_hashes)))
+    conn.close()
+    return changes
+
+def parse_args(argv=None):
+    """Parses command line options of the process_emails.py script."""
+    arg_parser = argparse.ArgumentParser(description='Apply rules.json to the emails in the email database.',
+                                         parents=[api_arguments(), rule_arguments(), metrics_arguments()])
+    arg_parser.add_argument('--mode', choices=['query', 'plan', 'immediate'], default='query',
+                            help='query: find matching emails with SQL and apply actions in bulk (default), '
+                                 'plan: evaluate rules in python and apply actions in bulk, '
+                                 'immediate: evaluate and apply actions email by email.')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes evaluating rules in plan mode. More than 1 shards the emails table.')
+    arg_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Emails read from the database at a time in plan and immediate modes.')
+    arg_parser.add_argument('--progress-interval', type=int, default=DEFAULT_PROGRESS_INTERVAL,
+                            help='Print progress every this many emails.')
+    arg_parser.add_argument('--reprocess', action='store_true',
+                            help='Forget which rules were already applied to which emails and process every email again.')
+    args = arg_parser.parse_args(argv)
+    if args.workers != 1 and args.mode != 'plan':
+        arg_parser.error(f"--workers {args.workers} - Invalid option, worker processes only evaluate rules with --mode plan.")
+    return args
+
 if __name__ == '__main__':
     print("!!!!! SCRIPT STARTED - process_emails.py")
+    args = parse_args()
     gmail_helper_instance = GmailHelper()
     service = gmail_helper_instance.authenticate_gmail()
     
-    rule_processor = RuleProcessor(service)
-    email_processor = EmailProcessor(rule_processor)
-    email_processor.process_emails()
+    metrics = Metrics() if args.metrics_json or args.metrics_prometheus else NULL_METRICS
+    executor = ApiExecutor(gmail_helper_instance.build_service, max_workers=args.concurrency,
+                           quota_per_second=args.quota or None, metrics=metrics)
+    labels_conn, rule_processor, email_processor = open_processors(
+        service, executor=executor, metrics=metrics, reprocess=args.reprocess, chunk_size=args.chunk_size,
+        progress_interval=args.progress_interval, **rule_options(args))
+    if args.mode == 'immediate':
+        email_processor.process_emails()
+    elif args.mode == 'plan' and args.workers > 1:
+        email_processor.process_emails_parallel(args.workers)
+    elif args.mode == 'plan':
+        email_processor.process_emails_planned()
+    else:
+        email_processor.process_emails_in_database()
+    executor.shutdown()
+    labels_conn.close()
+    metrics.export(args.metrics_json, args.metrics_prometheus)
     print("!!!!! SCRIPT COMPLETED - process_emails.py")
     
     
@@ -0,0 +1,17 @@
+import os
+import tempfile
+import unittest
+from helpers.email_database import connect_database
+
+class EmailDatabaseTestCase(unittest.TestCase):
+    """Test case with an email database file of its own at db_path, in a temporary directory removed after each test."""
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.db_path = os.path.join(self.temp_dir.name, 'email_database.db')
+
+    def connect(self):
+        """Opens the test's email database with connect_database, closed again after the test."""
+        conn = connect_database(self.db_path)
+        self.addCleanup(conn.close)
+        return conn
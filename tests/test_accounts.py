@@ -0,0 +1,44 @@
+import json
+import os
+import tempfile
+import unittest
+from helpers.accounts import load_accounts, parse_accounts
+from helpers.gmail_helper import CREDENTIALS_PATH
+
+class TestAccounts(unittest.TestCase):
+    def test_load_accounts_applies_defaults(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'accounts.json')
+            with open(path, 'w') as file:
+                json.dump([{'name': 'sahil', 'token': 'tokens/sahil.pickle', 'database': 'sahil.db'},
+                           {'name': 'team', 'token': 'tokens/team.pickle', 'database': 'team.db', 'rules': 'team.json',
+                            'label': 'Label_1', 'raw': True}], file)
+            first, second = load_accounts(path)
+
+        self.assertEqual((first.name, first.token, first.database), ('sahil', 'tokens/sahil.pickle', 'sahil.db'))
+        self.assertEqual((first.credentials, first.rules, first.label, first.raw), (CREDENTIALS_PATH, 'rules.json', 'INBOX', False))
+        self.assertEqual((second.rules, second.label, second.raw), ('team.json', 'Label_1', True))
+
+    def test_parse_accounts_lists_every_error(self):
+        with self.assertRaises(ValueError) as context:
+            parse_accounts([{'name': 'sahil', 'token': '', 'databse': 'sahil.db'}, 'team',
+                            {'name': 'team', 'token': 'team.pickle', 'database': 'team.db', 'raw': 'yes'}])
+
+        message = str(context.exception)
+        self.assertIn("Account 1: database - Missing account key.", message)
+        self.assertIn("Account 1: databse - Invalid account key.", message)
+        self.assertIn("Account 1:  - Invalid value for token, expected a non empty string.", message)
+        self.assertIn("Account 2: Invalid account, expected an object.", message)
+        self.assertIn("Account 3: yes - Invalid value for raw, expected true or false.", message)
+
+    def test_parse_accounts_rejects_shared_databases(self):
+        with self.assertRaises(ValueError) as context:
+            parse_accounts([{'name': 'sahil', 'token': 'sahil.pickle', 'database': 'emails.db'},
+                            {'name': 'team', 'token': 'team.pickle', 'database': 'emails.db'}])
+
+        self.assertIn("emails.db - Duplicate database, accounts need one of their own.", str(context.exception))
+        with self.assertRaises(ValueError):
+            parse_accounts({'name': 'sahil'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from helpers.api_executor import ApiExecutor, RetryableError, SharedBudget, TokenBucket, is_retryable
+from helpers.metrics import Metrics
+
+def http_error(status, content=b''):
+    return HttpError(MagicMock(status=status, reason='error'), content)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire_waits_for_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+
+        bucket.acquire(10)
+        self.assertEqual(clock.sleeps, [])
+        bucket.acquire(5)
+        self.assertEqual(clock.sleeps, [0.5])
+
+    def test_acquire_more_than_capacity_leaves_debt(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+
+        bucket.acquire(50)
+        self.assertEqual(bucket.tokens, -40)
+        bucket.acquire(1)
+        self.assertAlmostEqual(sum(clock.sleeps), 4.1)
+
+class TestApiExecutor(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.service = MagicMock()
+        self.executor = ApiExecutor(lambda: self.service, max_workers=2, quota_per_second=None, sleep=self.sleeps.append)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}')))
+        self.assertTrue(is_retryable(RetryableError('throttled')))
+        self.assertFalse(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}')))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(ValueError('bad')))
+
+    def test_execute_retries_with_backoff(self):
+        self.service.users().messages().list().execute.side_effect = [http_error(429), http_error(500), {'messages': []}]
+
+        response = self.executor.execute(lambda service: service.users().messages().list(userId='me'), 'messages.list')
+
+        self.assertEqual(response, {'messages': []})
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertLessEqual(self.sleeps[0], 1.0)
+        self.assertLessEqual(self.sleeps[1], 2.0)
+
+    def test_execute_records_metrics(self):
+        metrics = Metrics()
+        executor = ApiExecutor(lambda: self.service, quota_per_second=None, sleep=self.sleeps.append, metrics=metrics)
+        self.service.users().messages().list().execute.side_effect = [http_error(429), {'messages': []}]
+
+        executor.execute(lambda service: service.users().messages().list(userId='me'), 'messages.list')
+
+        key = (('method', 'messages.list'),)
+        self.assertEqual(metrics.counters['api_calls_total'][key], 2)
+        self.assertEqual(metrics.counters['api_quota_units_total'][key], 10)
+        self.assertEqual(metrics.counters['api_errors_total'][key], 1)
+        self.assertEqual(metrics.counters['api_retries_total'][key], 1)
+        self.assertEqual(metrics.histograms['api_call_seconds'][key][0], 2)
+
+    def test_execute_raises_non_retryable_errors(self):
+        self.service.users().messages().get().execute.side_effect = http_error(404)
+        with self.assertRaises(HttpError):
+            self.executor.execute(lambda service: service.users().messages().get(userId='me', id='1'), 'messages.get')
+        self.assertEqual(self.sleeps, [])
+
+    def test_execute_gives_up_after_max_retries(self):
+        executor = ApiExecutor(lambda: self.service, quota_per_second=None, max_retries=2, sleep=self.sleeps.append)
+        self.service.users().messages().get().execute.side_effect = http_error(503)
+        with self.assertRaises(HttpError):
+            executor.execute(lambda service: service.users().messages().get(userId='me', id='1'), 'messages.get')
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_call_charges_quota_units(self):
+        executor = ApiExecutor(lambda: self.service, quota_per_second=250)
+        executor.rate_limiter = MagicMock()
+        executor.call(lambda service: None, 'messages.batchModify')
+        executor.call(lambda service: None, 'messages.get', units=250)
+        executor.rate_limiter.acquire.assert_any_call(50)
+        executor.rate_limiter.acquire.assert_any_call(250)
+
+    def test_shared_budget_limits_calls_of_every_executor(self):
+        budget = SharedBudget(1, quota_per_second=250)
+        budget.rate_limiter = MagicMock()
+        executors = [ApiExecutor(lambda: self.service, max_workers=2, quota_per_second=None, budget=budget)
+                     for _ in range(2)]
+        running = []
+        peak = []
+        lock = threading.Lock()
+        def track(service):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            threading.Event().wait(0.01)
+            with lock:
+                running.pop()
+        futures = [executor.submit(executor.call, track, 'messages.get') for executor in executors for _ in range(3)]
+        for future in futures:
+            future.result()
+        for executor in executors:
+            executor.shutdown()
+
+        self.assertEqual(max(peak), 1)
+        self.assertEqual(budget.rate_limiter.acquire.call_count, 6)
+        budget.rate_limiter.acquire.assert_called_with(5)
+
+    def test_for_service_runs_submitted_work_in_the_calling_thread(self):
+        executor = ApiExecutor.for_service(self.service)
+        future = executor.submit(executor.call, lambda service: (service, threading.current_thread()), 'getProfile')
+        failed = executor.submit(executor.call, lambda service: 1 / 0, 'getProfile')
+
+        self.assertEqual(future.result(), (self.service, threading.current_thread()))
+        self.assertIsInstance(failed.exception(), ZeroDivisionError)
+        self.assertIsNone(executor.pool)
+
+    def test_each_thread_gets_its_own_service(self):
+        created = []
+        def service_factory():
+            created.append(threading.current_thread().name)
+            return MagicMock()
+        executor = ApiExecutor(service_factory, max_workers=2, quota_per_second=None)
+        barrier = threading.Barrier(2)
+
+        def use_service(service):
+            barrier.wait(timeout=5)
+            return service
+        futures = [executor.submit(executor.call, use_service, 'getProfile') for _ in range(2)]
+        services = [future.result() for future in futures]
+        executor.shutdown()
+
+        self.assertEqual(len(created), 2)
+        self.assertIsNot(services[0], services[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import argparse
+import unittest
+from helpers.api_executor import DEFAULT_BATCH_SIZE, DEFAULT_MAX_WORKERS
+from helpers.arguments import api_arguments, batch_arguments, metrics_arguments, rule_arguments, rule_options
+
+class TestArguments(unittest.TestCase):
+    def setUp(self):
+        self.arg_parser = argparse.ArgumentParser(parents=[api_arguments(), batch_arguments(), rule_arguments(),
+                                                           metrics_arguments()])
+
+    def test_shared_options_defaults(self):
+        args = self.arg_parser.parse_args([])
+
+        self.assertEqual((args.concurrency, args.batch_size), (DEFAULT_MAX_WORKERS, DEFAULT_BATCH_SIZE))
+        self.assertIsNone(args.metrics_json)
+        self.assertEqual(rule_options(args), {'multi_pattern': False, 'ignore_case': False, 'refresh_labels': False})
+
+    def test_shared_options_parsed(self):
+        args = self.arg_parser.parse_args(['--quota', '0', '--ignore-case', '--metrics-prometheus', 'metrics.prom'])
+
+        self.assertEqual(args.quota, 0)
+        self.assertEqual(args.metrics_prometheus, 'metrics.prom')
+        self.assertEqual(rule_options(args), {'multi_pattern': False, 'ignore_case': True, 'refresh_labels': False})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from benchmark import find_regressions, measure, parse_args
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.options = parse_args(['--messages', '200', '--concurrency', '2'])
+        os.chdir(self.temp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_save_emails_saves_the_whole_inbox(self):
+        result = measure('save_emails', self.options)
+
+        self.assertEqual(result['emails'], 200)
+        # One list call and one get per message
+        self.assertEqual(result['api_calls'], 201)
+        self.assertEqual(result['http_requests'], 1 + 200 // self.options.batch_size)
+        self.assertGreater(result['emails_per_second'], 0)
+
+    def test_process_emails_modes_make_the_same_changes(self):
+        api_calls = {}
+        for mode in ('query', 'plan', 'immediate'):
+            self.options.mode = mode
+            result = measure('process_emails', self.options)
+            self.assertEqual(result['emails'], 200)
+            api_calls[mode] = result['api_calls']
+            os.remove('email_database.db')
+
+        # Bulk modes group changes into a few batchModify calls, immediate mode modifies email by email
+        self.assertEqual(api_calls['query'], api_calls['plan'])
+        self.assertGreater(api_calls['immediate'], api_calls['plan'])
+
+    def test_find_regressions(self):
+        baseline = [{'benchmark': 'save_emails', 'emails_per_second': 1000, 'api_calls_per_email': 1.0}]
+        results = [{'benchmark': 'save_emails', 'emails_per_second': 700, 'api_calls_per_email': 1.5},
+                   {'benchmark': 'apply_rules', 'emails_per_second': 1, 'api_calls_per_email': 9.0}]
+
+        self.assertEqual(len(find_regressions(results, baseline)), 2)
+        self.assertEqual(find_regressions(results, baseline, tolerance=0.5), [])
+
+if __name__ == '__main__':
+    unittest.main()
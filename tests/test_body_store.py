@@ -0,0 +1,43 @@
+import sqlite3
+import unittest
+import zlib
+from helpers.body_store import BodyStore
+
+class TestBodyStore(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.body_store = BodyStore(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_bodies_are_stored_compressed(self):
+        body = 'Quarterly numbers are in. ' * 200
+        self.body_store.set_bodies_many([('1', body)])
+
+        blob, = self.conn.execute("SELECT body FROM email_bodies WHERE id = '1'").fetchone()
+        self.assertLess(len(blob), len(body) // 10)
+        self.assertEqual(zlib.decompress(blob).decode('utf-8'), body)
+        self.assertEqual(self.body_store.get_body('1'), body)
+
+    def test_get_bodies_returns_none_for_emails_without_body(self):
+        self.body_store.set_bodies_many([('1', 'Hello'), ('2', 'Grüße')])
+
+        self.assertEqual(self.body_store.get_bodies(['1', '2', '3']), {'1': 'Hello', '2': 'Grüße', '3': None})
+        self.assertIsNone(self.body_store.get_body('3'))
+
+    def test_get_bodies_splits_long_id_lists(self):
+        self.body_store.set_bodies_many((str(i), f'Body {i}') for i in range(1200))
+
+        bodies = self.body_store.get_bodies(str(i) for i in range(1200))
+        self.assertEqual(len(bodies), 1200)
+        self.assertEqual(bodies['1199'], 'Body 1199')
+
+    def test_delete_bodies(self):
+        self.body_store.set_bodies_many([('1', 'Hello'), ('2', 'Hi')])
+        self.body_store.delete_bodies(['1'])
+
+        self.assertEqual(self.body_store.get_bodies(['1', '2']), {'1': None, '2': 'Hi'})
+
+if __name__ == '__main__':
+    unittest.main()
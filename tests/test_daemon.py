@@ -0,0 +1,146 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock
+from daemon import EmailDaemon, RulesWatcher
+from helpers.api_executor import ApiExecutor
+from helpers.email_database import connect_database
+from helpers.fake_gmail import FakeGmailService, FakeMailbox
+
+STAR_ALL_RULES = [{'predicate': 'All', 'conditions': [{'field': 'to_email', 'predicate': 'contains', 'value': '@'}],
+                   'actions': ['move_to_starred']}]
+READ_ALL_RULES = [{'predicate': 'All', 'conditions': [{'field': 'to_email', 'predicate': 'contains', 'value': '@'}],
+                   'actions': ['mark_as_read']}]
+
+class TestRulesWatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, 'rules.json')
+
+    def write_rules(self, content, mtime):
+        with open(self.path, 'w') as file:
+            file.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_poll_returns_rules_only_when_the_file_changed(self):
+        self.write_rules(json.dumps(STAR_ALL_RULES), 1000)
+        watcher = RulesWatcher(self.path)
+
+        self.assertEqual(watcher.poll(), STAR_ALL_RULES)
+        self.assertIsNone(watcher.poll())
+        self.write_rules(json.dumps(READ_ALL_RULES), 2000)
+        self.assertEqual(watcher.poll(), READ_ALL_RULES)
+
+    def test_poll_raises_on_invalid_json_once(self):
+        self.write_rules('[{"predicate": ', 1000)
+        watcher = RulesWatcher(self.path)
+
+        with self.assertRaises(ValueError):
+            watcher.poll()
+        self.assertIsNone(watcher.poll())
+
+class TestEmailDaemon(unittest.TestCase):
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        self.write_rules(STAR_ALL_RULES, 1000)
+        self.mailbox = FakeMailbox(30)
+        self.service = FakeGmailService(self.mailbox)
+        self.executor = ApiExecutor(lambda: self.service, max_workers=2, quota_per_second=None)
+        self.daemon = EmailDaemon(self.service, self.executor, RulesWatcher('rules.json'), poll_interval=0.01)
+
+    def tearDown(self):
+        self.daemon.close()
+        self.executor.shutdown()
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def write_rules(self, rules, mtime):
+        with open('rules.json', 'w') as file:
+            json.dump(rules, file)
+        os.utime('rules.json', (mtime, mtime))
+
+    def starred_count(self):
+        return sum('STARRED' in self.mailbox.label_ids(index) for index in range(self.mailbox.message_count))
+
+    def test_new_emails_flow_from_ingest_to_rules(self):
+        self.daemon.open()
+        conn = connect_database()
+
+        self.assertEqual(self.daemon.ingest(conn), 30)
+        self.assertEqual(self.daemon.process_queued(timeout=0), 30)
+        self.assertEqual(self.starred_count(), 30)
+
+        self.mailbox.add_messages(3)
+        self.assertEqual(self.daemon.ingest(conn), 3)
+        self.assertEqual(self.daemon.email_queue.qsize(), 3)
+        self.assertEqual(self.daemon.process_queued(timeout=0), 3)
+        self.assertEqual(self.starred_count(), 33)
+        self.assertEqual(self.daemon.process_queued(timeout=0), 0)
+        conn.close()
+
+    def test_changed_rules_are_reloaded_and_applied_to_stored_emails(self):
+        self.daemon.open()
+        conn = connect_database()
+        self.daemon.ingest(conn)
+        self.daemon.process_queued(timeout=0)
+        conn.close()
+
+        self.write_rules(READ_ALL_RULES, 2000)
+        self.assertTrue(self.daemon.reload_rules())
+        self.assertFalse(any('UNREAD' in self.mailbox.label_ids(index) for index in range(30)))
+
+        # Invalid rules are reported and the current rules stay in place
+        self.write_rules([{'predicate': 'Some', 'conditions': [], 'actions': []}], 3000)
+        self.assertFalse(self.daemon.reload_rules())
+        self.assertEqual(self.daemon.rule_processor.rules, READ_ALL_RULES)
+
+    def test_ingest_loop_keeps_polling_after_transient_errors(self):
+        errors = [ConnectionError('connection reset')]
+        def ingest(conn):
+            if errors:
+                raise errors.pop()
+            self.daemon.stop()
+            return 0
+        self.daemon.ingest = MagicMock(side_effect=ingest)
+
+        with redirect_stdout(io.StringIO()):
+            self.daemon.ingest_loop()
+
+        self.assertEqual(self.daemon.ingest.call_count, 2)
+        self.assertIsNone(self.daemon.ingest_error)
+
+    def test_ingest_loop_stops_the_daemon_on_other_errors(self):
+        error = ValueError('invalid_grant')
+        self.daemon.ingest = MagicMock(side_effect=error)
+
+        self.daemon.ingest_loop()
+
+        self.daemon.ingest.assert_called_once()
+        self.assertIs(self.daemon.ingest_error, error)
+        self.assertTrue(self.daemon.stop_event.is_set())
+
+    def test_run_processes_emails_until_stopped(self):
+        runner = threading.Thread(target=self.daemon.run)
+        runner.start()
+        deadline = time.monotonic() + 10
+        while self.starred_count() < 30 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.mailbox.add_messages(2)
+        while self.starred_count() < 32 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.daemon.stop()
+        runner.join(10)
+
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(self.starred_count(), 32)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import sqlite3
+import unittest
+from helpers.email_database import (MIGRATIONS, EmailRecord, connect_database, iter_email_chunks,
+                                    migrate_emails_table, parse_date_epoch, upsert_emails)
+from email_database_case import EmailDatabaseTestCase
+
+# Test emails only fill the original columns, the headers added later stay NULL
+INSERT_EMAIL = ('INSERT INTO emails (id, from_email, to_email, subject, date_received, date_epoch) '
+                'VALUES (?, ?, ?, ?, ?, ?)')
+
+class TestEmailDatabase(unittest.TestCase):
+    def test_parse_date_epoch(self):
+        self.assertEqual(parse_date_epoch('Sat, 01 Jun 2024 11:10:09 GMT'), 1717240209)
+        self.assertEqual(parse_date_epoch('Sat, 01 Jun 2024 13:10:09 +0200'), 1717240209)
+        # Dates without a timezone are taken as UTC
+        self.assertEqual(parse_date_epoch('2024-06-01 11:10:09'), 1717240209)
+        self.assertIsNone(parse_date_epoch('not a date'))
+        self.assertIsNone(parse_date_epoch(''))
+
+    def test_migrate_emails_table_backfills_old_rows(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT)')
+        conn.execute("INSERT INTO emails VALUES ('1', 'a@example.com', 'b@example.com', 'Hi', 'Sat, 01 Jun 2024 11:10:09 GMT')")
+        conn.execute("INSERT INTO emails VALUES ('2', 'a@example.com', 'b@example.com', 'Hi', 'garbage')")
+
+        migrate_emails_table(conn.cursor())
+        # Running it again on an up to date table changes nothing
+        migrate_emails_table(conn.cursor())
+
+        rows = conn.execute('SELECT id, date_epoch FROM emails ORDER BY id').fetchall()
+        self.assertEqual(rows, [('1', 1717240209), ('2', None)])
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(emails)')]
+        self.assertIn('idx_emails_date_epoch', indexes)
+        conn.close()
+
+    def test_email_record(self):
+        record = EmailRecord('1', 'a@example.com', 'b@example.com', 'Hi', 'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209)
+
+        self.assertEqual(record.subject, 'Hi')
+        self.assertEqual(record[3], 'Hi')
+        self.assertEqual(record[5], 1717240209)
+        self.assertEqual((record.cc, record.list_id, record.size), ('', '', None))
+        self.assertEqual(len(record), 9)
+        self.assertEqual(record, EmailRecord('1', 'a@example.com', 'b@example.com', 'Hi', 'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+class TestConnectDatabase(EmailDatabaseTestCase):
+    def test_connect_database_migrates_and_tunes_connection(self):
+        conn = connect_database(self.db_path)
+
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertTrue({'emails', 'email_labels', 'sync_state', 'rule_ledger', 'rule_ledger_rules', 'email_bodies'} <= tables)
+        conn.close()
+
+    def test_connect_database_upgrades_unversioned_databases(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT)')
+        conn.execute("INSERT INTO emails VALUES ('1', 'a@example.com', 'b@example.com', 'Hi', 'Sat, 01 Jun 2024 11:10:09 GMT')")
+        conn.commit()
+        conn.close()
+
+        conn = connect_database(self.db_path)
+        self.assertEqual(conn.execute('SELECT date_epoch, cc, list_id, size FROM emails').fetchall(), [(1717240209, '', '', None)])
+        conn.close()
+
+    def test_readers_are_not_blocked_by_an_open_write_transaction(self):
+        writer = connect_database(self.db_path)
+        writer.execute(INSERT_EMAIL, ('1', 'a@example.com', 'b@example.com', 'Hi', '', None))
+        writer.commit()
+        upsert_emails(writer, [('2', 'a@example.com', 'b@example.com', 'Hello', '', None, '', '', None)])
+
+        reader = connect_database(self.db_path)
+        # The reader sees the last committed state while the writer's transaction is still open
+        self.assertEqual(reader.execute('SELECT id FROM emails').fetchall(), [('1',)])
+        writer.commit()
+        self.assertEqual(reader.execute('SELECT id FROM emails ORDER BY id').fetchall(), [('1',), ('2',)])
+        reader.close()
+        writer.close()
+
+    def test_upsert_emails_replaces_stored_fields(self):
+        conn = connect_database(self.db_path)
+        first = ('1', 'a@example.com', 'b@example.com', 'Hi', 'garbage', None, '', '', None)
+        second = ('2', 'a@example.com', 'b@example.com', 'Hello', '', None, '', '', None)
+        self.assertEqual(upsert_emails(conn, [first, second]), [])
+        # Only emails stored with other fields are reported as changed
+        self.assertEqual(upsert_emails(conn, [second, ('1', 'a@example.com', 'b@example.com', 'Hi again',
+                                                       'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209, 'c@example.com',
+                                                       '<list.example.com>', 2048)]), ['1'])
+
+        self.assertEqual(conn.execute('SELECT subject, date_epoch, cc, list_id, size FROM emails WHERE id = ?', ('1',)).fetchall(),
+                         [('Hi again', 1717240209, 'c@example.com', '<list.example.com>', 2048)])
+        conn.close()
+
+    def test_iter_email_chunks(self):
+        conn = connect_database(self.db_path)
+        conn.executemany(INSERT_EMAIL, [(str(i), 'a@example.com', 'b@example.com', f'Subject {i}', '', None) for i in range(5)])
+
+        chunks = list(iter_email_chunks(conn, 2))
+        self.assertEqual([[email.id for email in chunk] for chunk in chunks], [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(chunks[0][0], EmailRecord('0', 'a@example.com', 'b@example.com', 'Subject 0', ''))
+        chunks = list(iter_email_chunks(conn, 10, after_rowid=1, last_rowid=4, condition=('subject != ?', ['Subject 2'])))
+        self.assertEqual([email.id for email in chunks[0]], ['1', '3'])
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
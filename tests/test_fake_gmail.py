@@ -0,0 +1,70 @@
+import unittest
+from googleapiclient.errors import HttpError
+from helpers.api_executor import is_retryable
+from helpers.fake_gmail import FakeGmailService, FakeMailbox
+
+class TestFakeGmailService(unittest.TestCase):
+    def setUp(self):
+        self.mailbox = FakeMailbox(10)
+        self.service = FakeGmailService(self.mailbox)
+
+    def test_list_walks_pages_and_filters_labels(self):
+        first_page = self.service.users().messages().list(userId='me', labelIds=['UNREAD'], maxResults=2).execute()
+        second_page = self.service.users().messages().list(userId='me', labelIds=['UNREAD'], maxResults=2,
+                                                           pageToken=first_page['nextPageToken']).execute()
+
+        ids = [msg['id'] for msg in first_page['messages'] + second_page['messages']]
+        self.assertEqual(ids, [self.mailbox.message_id(index) for index in (0, 3, 6, 9)])
+        self.assertNotIn('nextPageToken', second_page)
+        self.assertEqual(self.service.calls['messages.list'], 2)
+
+    def test_get_metadata_returns_requested_headers(self):
+        msg = self.service.users().messages().get(userId='me', id=self.mailbox.message_id(1), format='metadata',
+                                                  metadataHeaders=['From', 'Subject']).execute()
+
+        self.assertEqual([header['name'] for header in msg['payload']['headers']], ['From', 'Subject'])
+        self.assertEqual(msg['labelIds'], ['INBOX'])
+        # The same index always generates the same message
+        self.assertEqual(self.mailbox.headers(1), FakeMailbox(10).headers(1))
+
+    def test_get_unknown_message_raises_not_found(self):
+        with self.assertRaises(HttpError) as context:
+            self.service.users().messages().get(userId='me', id='unknown').execute()
+        self.assertEqual(context.exception.resp.status, 404)
+
+    def test_batch_is_one_http_request_and_reports_injected_errors(self):
+        service = FakeGmailService(self.mailbox, error_rate=1.0)
+        results = []
+        batch = service.new_batch_http_request(callback=lambda request_id, response, error: results.append((request_id, error)))
+        for index in range(3):
+            batch.add(service.users().messages().get(userId='me', id=self.mailbox.message_id(index)), request_id=str(index))
+        batch.execute()
+
+        self.assertEqual([request_id for request_id, _ in results], ['0', '1', '2'])
+        self.assertTrue(all(is_retryable(error) for _, error in results))
+        self.assertEqual(service.http_requests, 1)
+        self.assertEqual(service.calls['messages.get'], 3)
+        self.assertEqual(service.errors, 3)
+
+    def test_modify_changes_labels_and_records_history(self):
+        start_history_id = self.service.users().getProfile(userId='me').execute()['historyId']
+        self.service.users().messages().batchModify(userId='me', body={
+            'ids': [self.mailbox.message_id(0), self.mailbox.message_id(1)],
+            'addLabelIds': ['STARRED'], 'removeLabelIds': ['UNREAD']}).execute()
+        response = self.service.users().messages().modify(userId='me', id=self.mailbox.message_id(2),
+                                                          body={'addLabelIds': ['SPAM']}).execute()
+
+        self.assertEqual(response['labelIds'], ['INBOX', 'SPAM'])
+        self.assertEqual(self.mailbox.label_ids(0), {'INBOX', 'STARRED'})
+        history = self.service.users().history().list(userId='me', startHistoryId=start_history_id).execute()
+        self.assertEqual(len(history['history']), 4)
+        self.assertEqual(history['history'][1]['labelsRemoved'][0]['labelIds'], ['UNREAD'])
+        self.assertEqual(history['historyId'], str(self.mailbox.history_id))
+
+    def test_batch_modify_rejects_more_than_1000_ids(self):
+        with self.assertRaises(HttpError) as context:
+            self.service.users().messages().batchModify(userId='me', body={'ids': ['0'] * 1001}).execute()
+        self.assertEqual(context.exception.resp.status, 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,63 @@
+import base64
+import io
+import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock, patch
 import sqlite3
-from fetch_emails import fetch_emails, save_emails
+from googleapiclient.errors import HttpError
+from helpers.api_executor import ApiExecutor
+from helpers.body_store import BodyStore
+from helpers.email_database import UPSERT_EMAIL, connect_database
+from helpers.fake_gmail import FakeGmailService, FakeMailbox
+from fetch_emails import fetch_emails, iter_messages, parse_raw_message, save_emails, save_emails_batched, sync_emails
 from helpers.gmail_helper import GmailHelper
+from helpers.label_store import LabelStore
+from helpers.metrics import Metrics
+from helpers.rule_ledger import RuleLedger
+from email_database_case import EmailDatabaseTestCase
+
+def metadata_response(msg_id, sender, subject):
+    return {
+        'id': msg_id,
+        'labelIds': ['INBOX', 'UNREAD'],
+        'payload': {
+            'headers': [
+                {'name': 'From', 'value': sender},
+                {'name': 'To', 'value': 'bob@example.com'},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': 'Sat, 01 Jun 2024 11:10:09 GMT'}
+            ]
+        }
+    }
+
+class FakeBatch:
+    """Stands in for googleapiclient's BatchHttpRequest, answering from a dict of id to response or exception."""
+    def __init__(self, callback, responses, sizes):
+        self.callback = callback
+        self.responses = responses
+        self.sizes = sizes
+        self.request_ids = []
+
+    def add(self, request, request_id=None):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        self.sizes.append(len(self.request_ids))
+        for request_id in self.request_ids:
+            response = self.responses[request_id]
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
+
+def fake_batch_service(responses, sizes):
+    service = MagicMock()
+    service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, responses, sizes)
+    return service
 
 class TestFetchEmailsScript(unittest.TestCase):
     
@@ -18,55 +73,384 @@ class TestFetchEmailsScript(unittest.TestCase):
         self.assertEqual(len(messages), 3)
         self.assertEqual(messages, [{'id': '1'}, {'id': '2'}, {'id': '3'}])
 
-    @patch('fetch_emails.GmailHelper')
-    @patch('sqlite3.connect')
-    def test_save_emails(self, mock_sqlite_connect, MockGmailHelper):
-        mock_service = MockGmailHelper().authenticate_gmail()
-        mock_service.users().messages().get().execute.side_effect = [
-            {
-                'id': '1',
-                'payload': {
-                    'headers': [
-                        {'name': 'From', 'value': 'alice@example.com'},
-                        {'name': 'To', 'value': 'bob@example.com'},
-                        {'name': 'Subject', 'value': 'Hello'},
-                        {'name': 'Date', 'value': 'Sat, 01 Jun 2024 11:10:09 GMT'}
-                    ]
-                }
-            },
-            {
-                'id': '2',
-                'payload': {
-                    'headers': [
-                        {'name': 'From', 'value': 'charlie@example.com'},
-                        {'name': 'To', 'value': 'dave@example.com'},
-                        {'name': 'Subject', 'value': 'Hi'},
-                        {'name': 'Date', 'value': 'Sun, 02 Jun 2024 12:20:19 GMT'}
-                    ]
-                }
-            }
+    def test_fetch_emails_reads_every_page(self):
+        mailbox = FakeMailbox(250)
+
+        self.assertEqual(len(fetch_emails(FakeGmailService(mailbox), 'INBOX')), 250)
+
+    def test_iter_messages_walks_all_pages(self):
+        service = MagicMock()
+        list_method = service.users().messages().list
+        list_method.return_value.execute.side_effect = [
+            {'messages': [{'id': '1'}, {'id': '2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': '3'}]}
         ]
 
-        mock_conn = mock_sqlite_connect.return_value
-        mock_cursor = mock_conn.cursor.return_value
+        messages = iter_messages(service, label_ids=['INBOX'], query='newer_than:7d', max_results=2)
+        # Nothing is listed until the generator is consumed
+        list_method.assert_not_called()
 
-        messages = [{'id': '1'}, {'id': '2'}]
-        save_emails(mock_service, messages)
+        self.assertEqual([msg['id'] for msg in messages], ['1', '2', '3'])
+        list_method.assert_any_call(userId='me', maxResults=2, labelIds=['INBOX'], q='newer_than:7d')
+        list_method.assert_any_call(userId='me', maxResults=2, labelIds=['INBOX'], q='newer_than:7d', pageToken='page2')
 
-        mock_cursor.execute.assert_any_call(
-            '''CREATE TABLE IF NOT EXISTS emails
-                 (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT)''')
+    def test_iter_messages_stops_at_limit(self):
+        service = MagicMock()
+        list_method = service.users().messages().list
+        list_method.return_value.execute.side_effect = [
+            {'messages': [{'id': '1'}, {'id': '2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': '3'}], 'nextPageToken': 'page3'}
+        ]
+
+        messages = list(iter_messages(service, max_results=2, limit=3))
+
+        self.assertEqual([msg['id'] for msg in messages], ['1', '2', '3'])
+        self.assertEqual(list_method.return_value.execute.call_count, 2)
+        list_method.assert_any_call(userId='me', maxResults=1, pageToken='page2')
 
-        mock_cursor.execute.assert_any_call(
-            'INSERT OR IGNORE INTO emails (id, from_email, to_email, subject, date_received) VALUES (?, ?, ?, ?, ?)',
-            ('1', 'alice@example.com', 'bob@example.com', 'Hello', 'Sat, 01 Jun 2024 11:10:09 GMT'))
+    def test_iter_messages_invalid_page_size(self):
+        with self.assertRaises(ValueError):
+            next(iter_messages(MagicMock(), max_results=501))
 
-        mock_cursor.execute.assert_any_call(
-            'INSERT OR IGNORE INTO emails (id, from_email, to_email, subject, date_received) VALUES (?, ?, ?, ?, ?)',
-            ('2', 'charlie@example.com', 'dave@example.com', 'Hi', 'Sun, 02 Jun 2024 12:20:19 GMT'))
+    @patch('fetch_emails.connect_database')
+    def test_save_emails(self, mock_connect_database):
+        responses = {'1': metadata_response('1', 'alice@example.com', 'Hello'),
+                     '2': metadata_response('2', 'charlie@example.com', 'Hi')}
+        responses['2']['payload']['headers'][3]['value'] = 'Sun, 02 Jun 2024 12:20:19 GMT'
+        service = fake_batch_service(responses, [])
+        mock_conn = mock_connect_database.return_value
 
-        mock_conn.commit.assert_called_once()
+        # Every message is saved, not only the first few
+        self.assertEqual(save_emails(service, [{'id': '1'}, {'id': '2'}]), (2, []))
+
+        # Both emails are written with a single executemany
+        mock_conn.executemany.assert_any_call(UPSERT_EMAIL, [
+            ('1', 'alice@example.com', 'bob@example.com', 'Hello', 'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209, '', '', None),
+            ('2', 'charlie@example.com', 'bob@example.com', 'Hi', 'Sun, 02 Jun 2024 12:20:19 GMT', 1717330819, '', '', None)])
         mock_conn.close.assert_called_once()
 
+    @patch('fetch_emails.connect_database')
+    def test_save_emails_tolerates_missing_headers(self, mock_connect_database):
+        service = fake_batch_service({'1': {'id': '1', 'sizeEstimate': 512, 'payload': {'headers': [
+            {'name': 'From', 'value': 'alice@example.com'}, {'name': 'List-ID', 'value': '<dev.example.com>'}]}}}, [])
+
+        save_emails(service, [{'id': '1'}])
+
+        mock_connect_database.return_value.executemany.assert_any_call(UPSERT_EMAIL, [
+            ('1', 'alice@example.com', '', '', '', None, '', '<dev.example.com>', 512)])
+
+    def test_parse_raw_message(self):
+        raw = (b'From: Alice <alice@example.com>\r\nTo: bob@example.com\r\nCc: carol@example.com\r\n'
+               b'Subject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\r\nList-Id: Dev list <dev.example.com>\r\n'
+               b'MIME-Version: 1.0\r\nContent-Type: multipart/alternative; boundary="b"\r\n\r\n'
+               b'--b\r\nContent-Type: text/html; charset=utf-8\r\n\r\n<p>Hi Bob</p>\r\n'
+               b'--b\r\nContent-Type: text/plain; charset=utf-8\r\n\r\nHi Bob\r\n--b--\r\n')
+
+        headers, body = parse_raw_message({'raw': base64.urlsafe_b64encode(raw).decode()})
+
+        self.assertEqual(headers['subject'], 'Grüße')
+        self.assertEqual(headers['cc'], 'carol@example.com')
+        self.assertEqual(headers['list-id'], 'Dev list <dev.example.com>')
+        # The plain text part is preferred over the html one
+        self.assertEqual(body.strip(), 'Hi Bob')
+
+    def test_save_emails_batched_raw_stores_bodies(self):
+        mailbox = FakeMailbox(8)
+        service = FakeGmailService(mailbox)
+        conn = connect_database(':memory:')
+
+        saved_count, _ = save_emails_batched(service, iter_messages(service), batch_size=5, conn=conn, raw=True)
+
+        self.assertEqual(saved_count, 8)
+        self.assertEqual(service.calls['messages.get'], 8)
+        rows = conn.execute('SELECT id, cc, list_id, size FROM emails ORDER BY id').fetchall()
+        self.assertEqual([row[0] for row in rows], [mailbox.message_id(index) for index in range(8)])
+        self.assertEqual(rows[0][1], mailbox.headers(0)['Cc'])
+        self.assertTrue(all(row[3] > 0 for row in rows))
+        bodies = BodyStore(conn).get_bodies(row[0] for row in rows)
+        self.assertEqual(bodies[mailbox.message_id(3)].strip(), mailbox.body(3))
+        conn.close()
+
+    def test_save_emails_batched_records_metrics(self):
+        service = FakeGmailService(FakeMailbox(8))
+        conn = connect_database(':memory:')
+        metrics = Metrics()
+
+        save_emails_batched(service, iter_messages(service), batch_size=5, conn=conn, raw=True, metrics=metrics)
+
+        self.assertEqual(metrics.counters['emails_saved_total'], {(): 8})
+        self.assertEqual(metrics.counters['api_calls_total'], {(('method', 'messages.get'),): 2})
+        writes = metrics.histograms['db_write_seconds']
+        for table in ('emails', 'email_labels', 'email_bodies'):
+            self.assertEqual(writes[(('table', table),)][0], 2)
+        conn.close()
+
+    def test_save_emails_batched_forgets_rules_of_emails_whose_fields_changed(self):
+        responses = {str(i): metadata_response(str(i), f'user{i}@example.com', f'Subject {i}') for i in range(2)}
+        service = fake_batch_service(responses, [])
+        conn = connect_database(':memory:')
+        save_emails_batched(service, [{'id': '0'}, {'id': '1'}], conn=conn)
+        ledger = RuleLedger(conn)
+        ledger.record_many([('0', 'cc_rule'), ('1', 'cc_rule')])
+        ledger.commit()
+
+        responses['1']['payload']['headers'].append({'name': 'Cc', 'value': 'carol@example.com'})
+        save_emails_batched(service, [{'id': '0'}, {'id': '1'}], conn=conn)
+
+        self.assertEqual(ledger.done_rules('0', ['cc_rule']), {'cc_rule'})
+        self.assertEqual(ledger.done_rules('1', ['cc_rule']), set())
+        conn.close()
+
+    def test_save_emails_batched_raw_skips_malformed_messages(self):
+        mailbox = FakeMailbox(3)
+        service = FakeGmailService(mailbox)
+        message = mailbox.message
+        def broken_message(index, *args):
+            resource = message(index, *args)
+            return dict(resource, raw='not base64!') if index == 1 else resource
+        mailbox.message = broken_message
+        conn = connect_database(':memory:')
+
+        with redirect_stdout(io.StringIO()):
+            saved_count, failed_ids = save_emails_batched(service, iter_messages(service), conn=conn, raw=True)
+
+        self.assertEqual((saved_count, failed_ids), (2, [mailbox.message_id(1)]))
+        self.assertEqual([row[0] for row in conn.execute('SELECT id FROM emails ORDER BY id')],
+                         [mailbox.message_id(0), mailbox.message_id(2)])
+        self.assertIsNone(LabelStore(conn).get_labels(mailbox.message_id(1)))
+        conn.close()
+
+    @patch('fetch_emails.connect_database')
+    def test_save_emails_batched(self, mock_connect_database):
+        responses = {str(i): metadata_response(str(i), f'user{i}@example.com', f'Subject {i}') for i in range(5)}
+        sizes = []
+        service = fake_batch_service(responses, sizes)
+        mock_conn = mock_connect_database.return_value
+
+        saved_count, failed_ids = save_emails_batched(service, ({'id': str(i)} for i in range(5)), batch_size=2)
+
+        self.assertEqual(saved_count, 5)
+        self.assertEqual(failed_ids, [])
+        self.assertEqual(sizes, [2, 2, 1])
+        service.users().messages().get.assert_any_call(userId='me', id='0', format='metadata',
+                                                       metadataHeaders=['From', 'To', 'Subject', 'Date', 'Cc', 'List-Id'])
+        # Each batch is written and committed as soon as it completes
+        self.assertEqual(mock_conn.executemany.call_args_list.count(unittest.mock.call(UPSERT_EMAIL, unittest.mock.ANY)), 3)
+        self.assertEqual(mock_conn.commit.call_count, 4)
+        mock_conn.executemany.assert_any_call(UPSERT_EMAIL, [
+            ('4', 'user4@example.com', 'bob@example.com', 'Subject 4', 'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209, '', '', None)])
+        mock_conn.close.assert_called_once()
+
+    def test_save_emails_batched_lets_other_connections_write_between_batches(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, 'email_database.db')
+            mailbox = FakeMailbox(20)
+            service = FakeGmailService(mailbox, latency=0.1)
+            def run_fetch():
+                conn = connect_database(db_path)
+                save_emails_batched(service, iter_messages(service), batch_size=5, conn=conn)
+                conn.close()
+            writer = connect_database(db_path)
+            writer.execute('PRAGMA busy_timeout=50')
+            ledger = RuleLedger(writer)
+            fetch = threading.Thread(target=run_fetch)
+            fetch.start()
+            writes = 0
+            while fetch.is_alive():
+                # Fails with database is locked if the fetch holds the write lock while waiting for gmail
+                ledger.record(mailbox.message_id(writes), ['rule_a'])
+                ledger.commit()
+                writes += 1
+                time.sleep(0.02)
+            fetch.join()
+
+            self.assertGreater(writes, 10)
+            self.assertEqual(writer.execute('SELECT count(*) FROM emails').fetchone()[0], 20)
+            writer.close()
+
+    @patch('fetch_emails.connect_database')
+    def test_save_emails_batched_isolates_failed_messages(self, mock_connect_database):
+        responses = {
+            '1': metadata_response('1', 'alice@example.com', 'Hello'),
+            '2': Exception('404 Not Found'),
+            '3': {'id': '3', 'payload': {'headers': [{'name': 'From', 'value': 'carol@example.com'}]}}
+        }
+        service = fake_batch_service(responses, [])
+        mock_conn = mock_connect_database.return_value
+
+        saved_count, failed_ids = save_emails_batched(service, [{'id': '1'}, {'id': '2'}, {'id': '3'}])
+
+        self.assertEqual(saved_count, 2)
+        self.assertEqual(failed_ids, ['2'])
+        mock_conn.executemany.assert_any_call(UPSERT_EMAIL, [
+            ('1', 'alice@example.com', 'bob@example.com', 'Hello', 'Sat, 01 Jun 2024 11:10:09 GMT', 1717240209, '', '', None),
+            ('3', 'carol@example.com', '', '', '', None, '', '', None)])
+
+    @patch('fetch_emails.connect_database')
+    def test_save_emails_batched_retries_throttled_messages(self, mock_connect_database):
+        throttled = {'2'}
+        responses = {'1': metadata_response('1', 'alice@example.com', 'Hello'),
+                     '2': metadata_response('2', 'bob@example.com', 'Hi')}
+        sizes = []
+
+        class ThrottlingBatch(FakeBatch):
+            def execute(self):
+                self.sizes.append(len(self.request_ids))
+                for request_id in self.request_ids:
+                    if request_id in throttled:
+                        throttled.discard(request_id)
+                        self.callback(request_id, None, HttpError(MagicMock(status=429), b'Too Many Requests'))
+                    else:
+                        self.callback(request_id, self.responses[request_id], None)
+
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback: ThrottlingBatch(callback, responses, sizes)
+        executor = ApiExecutor(lambda: service, max_workers=2, quota_per_second=None, sleep=lambda seconds: None)
+        mock_conn = mock_connect_database.return_value
+
+        saved_count, failed_ids = save_emails_batched(service, [{'id': '1'}, {'id': '2'}], executor=executor)
+        executor.shutdown()
+
+        self.assertEqual((saved_count, failed_ids), (2, []))
+        # Only the throttled message is fetched again
+        self.assertEqual(sizes, [2, 1])
+        rows, = [call.args[1] for call in mock_conn.executemany.call_args_list if call.args[0] == UPSERT_EMAIL]
+        self.assertEqual([row[0] for row in rows], ['1', '2'])
+
+    @patch('fetch_emails.ApiExecutor')
+    @patch('fetch_emails.connect_database')
+    def test_save_emails_batched_closes_connection_and_executor_on_error(self, mock_connect_database, MockApiExecutor):
+        mock_executor = MockApiExecutor.for_service.return_value
+        mock_executor.max_workers = 1
+        mock_executor.submit.return_value.result.side_effect = RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            save_emails_batched(MagicMock(), [{'id': '1'}, {'id': '2'}])
+
+        mock_connect_database.return_value.close.assert_called_once()
+        mock_executor.shutdown.assert_called_once()
+
+    def test_save_emails_batched_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            save_emails_batched(MagicMock(), [], batch_size=101)
+
+class TestSyncEmails(EmailDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = self.connect()
+
+        self.responses = {str(i): metadata_response(str(i), f'user{i}@example.com', f'Subject {i}') for i in range(1, 5)}
+        self.service = fake_batch_service(self.responses, [])
+        self.service.users().getProfile().execute.return_value = {'historyId': '100'}
+        self.service.users().messages().list().execute.return_value = {'messages': [{'id': '1'}, {'id': '2'}, {'id': '3'}]}
+
+    def stored_ids(self):
+        conn = sqlite3.connect(self.db_path)
+        ids = [row[0] for row in conn.execute('SELECT id FROM emails ORDER BY id')]
+        history_id = conn.execute("SELECT value FROM sync_state WHERE name = 'history_id:INBOX'").fetchone()[0]
+        conn.close()
+        return ids, history_id
+
+    def test_sync_emails_applies_history_after_first_full_sync(self):
+        sync_emails(self.service, conn=self.conn)
+        self.assertEqual(self.stored_ids(), (['1', '2', '3'], '100'))
+        conn = connect_database(self.db_path)
+        RuleLedger(conn).record_many([('1', 'rule_a'), ('2', 'rule_a'), ('3', 'rule_a')])
+        conn.commit()
+        conn.close()
+
+        history_list = self.service.users().history().list
+        history_list.return_value.execute.return_value = {
+            'history': [
+                {'messagesAdded': [{'message': {'id': '4', 'labelIds': ['INBOX', 'UNREAD']}}]},
+                {'messagesDeleted': [{'message': {'id': '1'}}]},
+                {'labelsRemoved': [{'message': {'id': '2'}, 'labelIds': ['INBOX']}]},
+                {'labelsRemoved': [{'message': {'id': '3'}, 'labelIds': ['UNREAD']}]}
+            ],
+            'historyId': '120'
+        }
+        self.service.users().messages().list.reset_mock()
+
+        sync_emails(self.service, conn=self.conn)
+
+        self.assertEqual(self.stored_ids(), (['3', '4'], '120'))
+        conn = sqlite3.connect(self.db_path)
+        labels = dict(conn.execute('SELECT id, label_ids FROM email_labels'))
+        ledger_ids = [row[0] for row in conn.execute('SELECT email_id FROM rule_ledger')]
+        conn.close()
+        self.assertEqual(labels, {'3': 'INBOX', '4': 'INBOX,UNREAD'})
+        # Rules done with the removed emails are forgotten with them
+        self.assertEqual(ledger_ids, ['3'])
+        history_list.assert_called_with(userId='me', startHistoryId='100',
+                                        historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'])
+        self.service.users().messages().list.assert_not_called()
+
+    def test_sync_emails_fetches_failed_emails_again_on_the_next_run(self):
+        self.responses['2'] = Exception('500 Backend Error')
+        sync_emails(self.service, conn=self.conn)
+        self.assertEqual(self.stored_ids(), (['1', '3'], '100'))
+
+        self.responses['2'] = metadata_response('2', 'user2@example.com', 'Subject 2')
+        self.service.users().history().list().execute.return_value = {'historyId': '110'}
+        sync_emails(self.service, conn=self.conn)
+
+        self.assertEqual(self.stored_ids(), (['1', '2', '3'], '110'))
+        conn = sqlite3.connect(self.db_path)
+        failed_ids = conn.execute("SELECT value FROM sync_state WHERE name = 'failed_ids:INBOX'").fetchone()[0]
+        conn.close()
+        self.assertEqual(failed_ids, '[]')
+
+    def test_sync_emails_falls_back_to_full_sync_when_history_expired(self):
+        sync_emails(self.service, conn=self.conn)
+        self.service.users().getProfile().execute.return_value = {'historyId': '500'}
+        self.service.users().history().list().execute.side_effect = HttpError(MagicMock(status=404), b'Not Found')
+
+        sync_emails(self.service, conn=self.conn)
+
+        self.assertEqual(self.stored_ids(), (['1', '2', '3'], '500'))
+
+class TestSyncEmailsWithFakeGmail(unittest.TestCase):
+    def test_full_resync_removes_emails_that_left_the_label(self):
+        mailbox = FakeMailbox(5)
+        service = FakeGmailService(mailbox)
+        conn = connect_database(':memory:')
+        sync_emails(service, conn=conn)
+        RuleLedger(conn).record(mailbox.message_id(4), ['rule_a'])
+        conn.commit()
+
+        mailbox.modify(4, remove_labels=['INBOX'])
+        sync_emails(service, full=True, conn=conn)
+
+        stored_ids = [row[0] for row in conn.execute('SELECT id FROM emails ORDER BY id')]
+        self.assertEqual(stored_ids, [mailbox.message_id(index) for index in range(4)])
+        self.assertIsNone(LabelStore(conn).get_labels(mailbox.message_id(4)))
+        self.assertEqual(RuleLedger(conn).done_rules(mailbox.message_id(4), ['rule_a']), set())
+        conn.close()
+
+    def test_sync_emails_refuses_a_second_label(self):
+        mailbox = FakeMailbox(30)
+        service = FakeGmailService(mailbox)
+        conn = connect_database(':memory:')
+        sync_emails(service, conn=conn)
+
+        with self.assertRaises(ValueError):
+            sync_emails(service, label='STARRED', full=True, conn=conn)
+
+        self.assertEqual(conn.execute('SELECT count(*) FROM emails').fetchone()[0], 30)
+        # The label it syncs can still be resynced
+        sync_emails(service, full=True, conn=conn)
+        self.assertEqual(conn.execute('SELECT count(*) FROM emails').fetchone()[0], 30)
+        conn.close()
+
+    def test_full_sync_lists_max_results_ids_per_page(self):
+        mailbox = FakeMailbox(5)
+        service = FakeGmailService(mailbox)
+        conn = connect_database(':memory:')
+
+        self.assertEqual(sync_emails(service, conn=conn, max_results=2), 5)
+
+        self.assertEqual(service.calls['messages.list'], 3)
+        conn.close()
+
 if __name__ == '__main__':
     unittest.main()
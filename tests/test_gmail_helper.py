@@ -0,0 +1,102 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from helpers.gmail_helper import GmailHelper
+
+# Both scripts run from cron every minute, importing them must stay cheap
+COLD_START_IMPORT_BUDGET_SECONDS = 0.5
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TestGmailHelper(unittest.TestCase):
+    def setUp(self):
+        self.reset_shared_state()
+        self.addCleanup(self.reset_shared_state)
+
+    def reset_shared_state(self):
+        GmailHelper.credentials = {}
+        GmailHelper.discovery_document = None
+        GmailHelper.services = {}
+        GmailHelper.token_locks = {}
+
+    @patch('googleapiclient.discovery.build_from_document')
+    @patch.object(GmailHelper, '_GmailHelper__load_credentials')
+    def test_authenticate_gmail_builds_service_once(self, mock_load_credentials, mock_build_from_document):
+        first = GmailHelper().authenticate_gmail()
+        second = GmailHelper().authenticate_gmail()
+
+        self.assertIs(first, second)
+        mock_load_credentials.assert_called_once()
+        mock_build_from_document.assert_called_once()
+        document = mock_build_from_document.call_args.args[0]
+        self.assertEqual(document['name'], 'gmail')
+
+    @patch('googleapiclient.discovery.build_from_document')
+    @patch('googleapiclient.discovery_cache.get_static_doc')
+    @patch.object(GmailHelper, '_GmailHelper__load_credentials')
+    def test_build_service_reuses_credentials_and_discovery_document(self, mock_load_credentials, mock_get_static_doc,
+                                                                     mock_build_from_document):
+        mock_get_static_doc.return_value = json.dumps({'name': 'gmail'})
+        gmail_helper = GmailHelper()
+        gmail_helper.build_service()
+        gmail_helper.build_service()
+
+        mock_load_credentials.assert_called_once()
+        mock_get_static_doc.assert_called_once_with('gmail', 'v1')
+        self.assertEqual(mock_build_from_document.call_count, 2)
+        self.assertIs(mock_build_from_document.call_args.kwargs['credentials'], mock_load_credentials.return_value)
+
+    @patch('googleapiclient.discovery.build_from_document')
+    @patch.object(GmailHelper, '_GmailHelper__load_credentials')
+    def test_each_token_store_gets_its_own_credentials_and_service(self, mock_load_credentials, mock_build_from_document):
+        mock_load_credentials.side_effect = lambda: MagicMock()
+        mock_build_from_document.side_effect = lambda document, credentials: MagicMock(credentials=credentials)
+        first = GmailHelper('tokens/first.pickle').authenticate_gmail()
+        second = GmailHelper('tokens/second.pickle').authenticate_gmail()
+
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.credentials, second.credentials)
+        self.assertIs(GmailHelper('tokens/first.pickle').authenticate_gmail(), first)
+        self.assertEqual(mock_load_credentials.call_count, 2)
+
+    def test_concurrent_token_refresh_happens_once(self):
+        creds = MagicMock(token='expired')
+        refreshes = []
+        started = threading.Event()
+        def refresh(request):
+            refreshes.append(request)
+            started.set()
+            # Give the other thread time to queue up behind the lock
+            threading.Event().wait(0.05)
+            creds.token = 'fresh'
+        creds.refresh = refresh
+
+        with patch.object(GmailHelper, '_GmailHelper__load_credentials', return_value=creds):
+            shared_creds = GmailHelper().get_credentials()
+        threads = [threading.Thread(target=shared_creds.refresh, args=(f'request{i}',)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(shared_creds.token, 'fresh')
+
+    def test_cold_start_skips_google_client_imports(self):
+        script = ('import sys, time\n'
+                  'start = time.perf_counter()\n'
+                  'import fetch_emails, process_emails\n'
+                  'elapsed = time.perf_counter() - start\n'
+                  "loaded = [m for m in sys.modules if m.split('.')[0] in ('googleapiclient', 'google_auth_oauthlib', 'google')]\n"
+                  'print(elapsed, len(loaded))\n')
+        output = subprocess.run([sys.executable, '-c', script], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout
+        elapsed, loaded_count = output.split()
+
+        self.assertEqual(int(loaded_count), 0)
+        self.assertLess(float(elapsed), COLD_START_IMPORT_BUDGET_SECONDS)
+
+if __name__ == '__main__':
+    unittest.main()
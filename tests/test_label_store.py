@@ -0,0 +1,36 @@
+import sqlite3
+import unittest
+from helpers.label_store import LabelStore
+
+class TestLabelStore(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.label_store = LabelStore(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_get_labels_unknown_and_empty(self):
+        self.assertIsNone(self.label_store.get_labels('1'))
+        self.label_store.set_labels('1', [])
+        self.assertEqual(self.label_store.get_labels('1'), set())
+
+    def test_set_labels_many(self):
+        self.label_store.set_labels_many([('1', ['INBOX', 'UNREAD']), ('2', ['STARRED'])])
+        self.assertEqual(self.label_store.get_labels('1'), {'INBOX', 'UNREAD'})
+        self.assertEqual(self.label_store.get_labels('2'), {'STARRED'})
+
+    def test_update_labels_skips_unknown_emails(self):
+        self.label_store.set_labels('1', ['INBOX', 'UNREAD'])
+        self.label_store.update_labels(['1', '2'], add_labels={'STARRED'}, remove_labels={'UNREAD'})
+
+        self.assertEqual(self.label_store.get_labels('1'), {'INBOX', 'STARRED'})
+        self.assertIsNone(self.label_store.get_labels('2'))
+
+    def test_delete_labels(self):
+        self.label_store.set_labels('1', ['INBOX'])
+        self.label_store.delete_labels(['1'])
+        self.assertIsNone(self.label_store.get_labels('1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import unittest
+from helpers.metrics import NULL_METRICS, Metrics
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1.0, float('inf')))
+
+    def test_increment_counts_per_label_set(self):
+        self.metrics.increment('api_calls_total', method='messages.get')
+        self.metrics.increment('api_calls_total', 2, method='messages.get')
+        self.metrics.increment('api_calls_total', method='messages.list')
+
+        self.assertEqual(self.metrics.summary()['counters']['api_calls_total'], [
+            {'labels': {'method': 'messages.get'}, 'value': 3},
+            {'labels': {'method': 'messages.list'}, 'value': 1}
+        ])
+
+    def test_observe_fills_histogram_buckets(self):
+        for value in (0.05, 0.5, 0.5, 3):
+            self.metrics.observe('api_call_seconds', value, method='messages.get')
+
+        histogram = self.metrics.summary()['histograms']['api_call_seconds'][0]
+        self.assertEqual(histogram['count'], 4)
+        self.assertAlmostEqual(histogram['sum'], 4.05)
+        self.assertEqual(histogram['buckets'], {'0.1': 1, '1.0': 2, '+Inf': 1})
+
+    def test_timer_records_when_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('stage_seconds', stage='plan'):
+                raise ValueError()
+
+        self.assertEqual(self.metrics.summary()['histograms']['stage_seconds'][0]['count'], 1)
+
+    def test_to_prometheus(self):
+        self.metrics.increment('rule_hits_total', 4, rule=1)
+        self.metrics.observe('db_read_seconds', 0.5, table='emails')
+
+        self.assertEqual(self.metrics.to_prometheus().splitlines(), [
+            '# TYPE happyfox_rule_hits_total counter',
+            'happyfox_rule_hits_total{rule="1"} 4',
+            '# TYPE happyfox_db_read_seconds histogram',
+            'happyfox_db_read_seconds_bucket{table="emails",le="0.1"} 0',
+            'happyfox_db_read_seconds_bucket{table="emails",le="1.0"} 1',
+            'happyfox_db_read_seconds_bucket{table="emails",le="+Inf"} 1',
+            'happyfox_db_read_seconds_sum{table="emails"} 0.5',
+            'happyfox_db_read_seconds_count{table="emails"} 1'
+        ])
+
+    def test_export_writes_both_files(self):
+        self.metrics.increment('emails_processed_total', 10)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path, prometheus_path = os.path.join(temp_dir, 'metrics.json'), os.path.join(temp_dir, 'metrics.prom')
+            self.metrics.export(json_path, prometheus_path)
+
+            with open(json_path) as file:
+                self.assertEqual(json.load(file)['counters']['emails_processed_total'][0]['value'], 10)
+            with open(prometheus_path) as file:
+                self.assertIn('happyfox_emails_processed_total 10', file.read())
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['metrics.json', 'metrics.prom'])
+
+    def test_labeled_adds_labels_to_every_series(self):
+        account_metrics = self.metrics.labeled(account='support')
+        account_metrics.increment('api_calls_total', method='messages.get')
+        with account_metrics.labeled(stage='plan').timer('stage_seconds'):
+            pass
+
+        self.assertEqual(self.metrics.counters['api_calls_total'], {(('account', 'support'), ('method', 'messages.get')): 1})
+        self.assertEqual(list(self.metrics.histograms['stage_seconds']), [(('account', 'support'), ('stage', 'plan'))])
+        self.assertIs(NULL_METRICS.labeled(account='support'), NULL_METRICS)
+
+    def test_null_metrics_record_nothing(self):
+        self.assertFalse(NULL_METRICS.enabled)
+        NULL_METRICS.increment('api_calls_total', method='messages.get')
+        with NULL_METRICS.timer('stage_seconds', stage='plan'):
+            pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import random
+import unittest
+from unittest.mock import MagicMock, patch
+from helpers.pattern_matcher import AhoCorasick, ContainsMatcher
+from helpers.rule_compiler import compile_rule
+from process_emails import RuleProcessor
+
+class TestAhoCorasick(unittest.TestCase):
+    def test_find_all(self):
+        automaton = AhoCorasick(['he', 'she', 'his', 'hers', 'xyz'])
+        self.assertEqual(automaton.find_all('ushers'), {'he', 'she', 'hers'})
+        self.assertEqual(automaton.find_all('ahis'), {'his'})
+        self.assertEqual(automaton.find_all(''), set())
+
+    def test_empty_pattern_always_found(self):
+        self.assertEqual(AhoCorasick(['', 'ab']).find_all('xyz'), {''})
+
+    def test_find_all_matches_substring_search(self):
+        generator = random.Random(7)
+        patterns = {''.join(generator.choice('abc') for _ in range(generator.randint(1, 4))) for _ in range(40)}
+        automaton = AhoCorasick(patterns)
+        for _ in range(200):
+            text = ''.join(generator.choice('abcd') for _ in range(generator.randint(0, 12)))
+            self.assertEqual(automaton.find_all(text), {pattern for pattern in patterns if pattern in text})
+
+class TestContainsMatcher(unittest.TestCase):
+    def setUp(self):
+        self.rules = [
+            {'predicate': 'All', 'conditions': [
+                {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+                {'field': 'from_email', 'predicate': 'does_not_contains', 'value': 'billing@'}
+            ], 'actions': ['move_to_starred']},
+            {'predicate': 'Any', 'conditions': [
+                {'field': 'subject', 'predicate': 'contains', 'value': 'Urgent'},
+                {'field': 'subject', 'predicate': 'equals', 'value': 'Invoice'}
+            ], 'actions': ['move_to_important']}
+        ]
+        self.email = ('1', 'Billing@shop.com', 'me@example.com', 'URGENT: invoice overdue', '2024-06-01', None)
+
+    def test_scan(self):
+        self.assertEqual(ContainsMatcher(self.rules).scan(self.email), set())
+        self.assertEqual(ContainsMatcher(self.rules, ignore_case=True).scan(self.email),
+                         {('subject', 'invoice'), ('subject', 'urgent'), ('from_email', 'billing@')})
+
+    def test_contains_scans_each_email_once(self):
+        matcher = ContainsMatcher(self.rules)
+        with patch.object(matcher, 'scan', wraps=matcher.scan) as mock_scan:
+            matcher.contains(self.email, 'subject', 'Invoice')
+            matcher.contains(self.email, 'subject', 'Urgent')
+            matcher.contains(self.email, 'from_email', 'billing@')
+        mock_scan.assert_called_once_with(self.email)
+
+    def test_rule_processor_multi_pattern_matches_plain_evaluation(self):
+        emails = [
+            ('1', 'alice@shop.com', 'me@example.com', 'Invoice 42', '2024-06-01', None),
+            ('2', 'billing@shop.com', 'me@example.com', 'Invoice 43', '2024-06-01', None),
+            ('3', 'bob@shop.com', 'me@example.com', 'Urgent: call me', '2024-06-01', None),
+            ('4', 'bob@shop.com', 'me@example.com', 'urgent invoice', '2024-06-01', None)
+        ]
+        plans = []
+        for options in [{}, {'multi_pattern': True}, {'ignore_case': True}]:
+            rule_processor = RuleProcessor(MagicMock(), **options)
+            rule_processor.set_rules(self.rules)
+            plan = {}
+            for email in emails:
+                rule_processor.plan_rules(email, plan)
+            plans.append(plan)
+
+        self.assertEqual(plans[0], plans[1])
+        self.assertEqual(plans[0], {(frozenset({'STARRED'}), frozenset()): ['1'],
+                                    (frozenset({'IMPORTANT'}), frozenset()): ['3']})
+        self.assertEqual(plans[2], {(frozenset({'STARRED'}), frozenset()): ['1'],
+                                    (frozenset({'IMPORTANT'}), frozenset()): ['3'],
+                                    (frozenset({'STARRED', 'IMPORTANT'}), frozenset()): ['4']})
+
+    def test_rule_processor_compiles_each_rule_once_with_matcher(self):
+        rule_processor = RuleProcessor(MagicMock(), rules=[], multi_pattern=True)
+        with patch('process_emails.compile_rule', wraps=compile_rule) as mock_compile_rule:
+            rule_processor.set_rules(self.rules)
+
+        self.assertEqual(mock_compile_rule.call_count, len(self.rules))
+        self.assertTrue(all(call.args[2] is not None for call in mock_compile_rule.call_args_list))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from helpers.accounts import Account
+from helpers.api_executor import SharedBudget
+from helpers.email_database import connect_database
+from helpers.fake_gmail import FakeGmailService, FakeMailbox
+from helpers.metrics import Metrics
+from process_accounts import AccountScheduler
+
+STAR_ALL_RULES = [{'predicate': 'All', 'conditions': [{'field': 'to_email', 'predicate': 'contains', 'value': '@'}],
+                   'actions': ['move_to_starred']}]
+
+class TestAccountScheduler(unittest.TestCase):
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        with open('rules.json', 'w') as file:
+            json.dump(STAR_ALL_RULES, file)
+        self.mailboxes = {'first': FakeMailbox(20, seed=1), 'second': FakeMailbox(30, seed=2)}
+        self.services = {name: FakeGmailService(mailbox) for name, mailbox in self.mailboxes.items()}
+        self.budget = SharedBudget(2)
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def gmail_helper(self, account):
+        service = self.services[account.name]
+        return MagicMock(authenticate_gmail=lambda: service, build_service=lambda: service)
+
+    def scheduler(self, accounts, metrics=None):
+        return AccountScheduler(accounts, self.budget, parallel_accounts=2, concurrency=2, quota_per_second=None,
+                                metrics=metrics, gmail_helper_factory=self.gmail_helper)
+
+    def starred_count(self, name):
+        mailbox = self.mailboxes[name]
+        return sum('STARRED' in mailbox.label_ids(index) for index in range(mailbox.message_count))
+
+    def test_each_account_is_synced_and_processed_in_its_own_database(self):
+        accounts = [Account(name, f'{name}.pickle', f'{name}.db') for name in self.mailboxes]
+
+        self.assertEqual(self.scheduler(accounts).run(), {'first': None, 'second': None})
+        for name, count in (('first', 20), ('second', 30)):
+            conn = connect_database(f'{name}.db')
+            self.assertEqual(conn.execute('SELECT count(*) FROM emails').fetchone()[0], count)
+            conn.close()
+            self.assertEqual(self.starred_count(name), count)
+
+        # Later runs only sync the new emails of each account
+        self.mailboxes['second'].add_messages(2)
+        self.assertEqual(self.scheduler(accounts).run(), {'first': None, 'second': None})
+        self.assertEqual(self.starred_count('second'), 32)
+
+    def test_metrics_are_labeled_by_account(self):
+        accounts = [Account(name, f'{name}.pickle', f'{name}.db') for name in self.mailboxes]
+        metrics = Metrics()
+
+        self.scheduler(accounts, metrics).run()
+
+        for name, count in (('first', 20), ('second', 30)):
+            self.assertEqual(metrics.counters['api_calls_total'][(('account', name), ('method', 'getProfile'))], 1)
+            self.assertEqual(metrics.counters['emails_saved_total'][(('account', name),)], count)
+
+    def test_failing_account_does_not_stop_the_others(self):
+        accounts = [Account('first', 'first.pickle', 'first.db', rules='missing.json'),
+                    Account('second', 'second.pickle', 'second.db')]
+
+        errors = self.scheduler(accounts).run()
+        self.assertIsInstance(errors['first'], FileNotFoundError)
+        self.assertIsNone(errors['second'])
+        self.assertEqual(self.starred_count('first'), 0)
+        self.assertEqual(self.starred_count('second'), 30)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,23 @@
+import io
+import os
+import sqlite3
+import tempfile
 import unittest
+import zlib
+from contextlib import redirect_stderr, redirect_stdout
 from unittest.mock import MagicMock, patch
 from datetime import datetime, timedelta
-from process_emails import RuleProcessor, EmailProcessor
+from helpers.body_store import BodyStore
+from helpers.email_database import EmailRecord, connect_database
+from helpers.label_store import LabelStore
+from helpers.metrics import Metrics
+from helpers.rule_ledger import RuleLedger
+from process_emails import RuleProcessor, EmailProcessor, parse_args
+from email_database_case import EmailDatabaseTestCase
+
+# Test emails only fill the original columns, the headers added later stay NULL
+INSERT_EMAIL = ('INSERT INTO emails (id, from_email, to_email, subject, date_received, date_epoch) '
+                'VALUES (?, ?, ?, ?, ?, ?)')
 
 class TestRuleProcessor(unittest.TestCase):
     def setUp(self):
@@ -9,84 +25,6 @@ class TestRuleProcessor(unittest.TestCase):
         self.gmail_service = MagicMock()
         self.rule_processor = RuleProcessor(self.gmail_service)
 
-    def test_convert_field_to_index(self):
-        self.assertEqual(self.rule_processor._RuleProcessor__convert_field_to_index('id'), 0)
-        self.assertEqual(self.rule_processor._RuleProcessor__convert_field_to_index('from_email'), 1)
-        self.assertEqual(self.rule_processor._RuleProcessor__convert_field_to_index('to_email'), 2)
-        self.assertEqual(self.rule_processor._RuleProcessor__convert_field_to_index('subject'), 3)
-        self.assertEqual(self.rule_processor._RuleProcessor__convert_field_to_index('date_received'), 4)
-
-    def test_evaluate_string_predicate_contains(self):
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "contains", "World"))
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "contains", "Python"))
-
-    def test_evaluate_string_predicate_does_not_contains(self):
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "does_not_contains", "Python"))
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "does_not_contains", "World"))
-
-    def test_evaluate_string_predicate_equals(self):
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "equals", "Hello World"))
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "equals", "Hello"))
-
-    def test_evaluate_string_predicate_does_not_equals(self):
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "does_not_equals", "Python"))
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "does_not_equals", "Hello World"))
-
-    def test_evaluate_string_predicate_invalid(self):
-        with self.assertRaises(ValueError):
-            self.rule_processor._RuleProcessor__evaluate_string_predicate("Hello World", "invalid_predicate", "Python")
-
-    def test_evaluate_date_predicate_less_than(self):
-        email_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_date_predicate(email_date, "less_than", "2 days"))
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_date_predicate(email_date, "less_than", "1 days"))
-
-    def test_evaluate_date_predicate_greater_than(self):
-        email_date = (datetime.now() + timedelta(days=60)).strftime("%Y-%m-%d")
-        self.assertFalse(self.rule_processor._RuleProcessor__evaluate_date_predicate(email_date, "greater_than", "1 months"))
-
-    def test_evaluate_date_predicate_invalid(self):
-        with self.assertRaises(ValueError):
-            self.rule_processor._RuleProcessor__evaluate_date_predicate("2024-06-01", "invalid_predicate", "2 days")
-
-    def test_evaluate_rule_all_predicate(self):
-        # Mock email object
-        email = [
-            1,
-            'example@example.com',
-            'test@test.com',
-            'Test Subject',
-            (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-            ]
-        # Rule with 'All' predicate
-        rule = {
-            'predicate': 'All',
-            'conditions': [
-                {'field': 'from_email', 'predicate': 'equals', 'value': 'example@example.com'},
-                {'field': 'subject', 'predicate': 'contains', 'value': 'Test'}
-            ]
-        }
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_rule(email, rule))
-
-    def test_evaluate_rule_any_predicate(self):
-        # Mock email object
-        email = [
-            1,
-            'example@example.com',
-            'test@test.com',
-            'Test Subject',
-            (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-        ]
-        # Rule with 'Any' predicate
-        rule = {
-            'predicate': 'Any',
-            'conditions': [
-                {'field': 'from_email', 'predicate': 'equals', 'value': 'another@example.com'},
-                {'field': 'subject', 'predicate': 'contains', 'value': 'Test'}
-            ]
-        }
-        self.assertTrue(self.rule_processor._RuleProcessor__evaluate_rule(email, rule))
-
     def test_load_rules(self):
         # Mocking the rules data
         mock_rules_data = [
@@ -157,7 +95,191 @@ class TestRuleProcessor(unittest.TestCase):
 
         # Assert that modify method is called once with the expected label
         self.gmail_service.users().messages().modify.assert_called_once_with(userId='me', id=1, body={'removeLabelIds': ['UNREAD']})
-    
+
+    def test_plan_rules_groups_label_changes(self):
+        self.rule_processor.set_rules([
+            {
+                'predicate': 'All',
+                'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+                'actions': ['mark_as_unread', 'move_to_starred']
+            },
+            {
+                'predicate': 'Any',
+                'conditions': [{'field': 'from_email', 'predicate': 'equals', 'value': 'boss@example.com'}],
+                'actions': ['mark_as_read']
+            }
+        ])
+        emails = [
+            (1, 'example@example.com', 'test@test.com', 'Test Subject', '2024-06-01'),
+            (2, 'boss@example.com', 'test@test.com', 'Test Subject', '2024-06-01'),
+            (3, 'other@example.com', 'test@test.com', 'Test again', '2024-06-01'),
+            (4, 'other@example.com', 'test@test.com', 'Hello', '2024-06-01')
+        ]
+        plan = {}
+        for email in emails:
+            self.rule_processor.plan_rules(email, plan)
+
+        # The later mark_as_read rule overrides mark_as_unread for email 2, email 4 matches nothing
+        self.assertEqual(plan, {
+            (frozenset({'UNREAD', 'STARRED'}), frozenset()): [1, 3],
+            (frozenset({'STARRED'}), frozenset({'UNREAD'})): [2]
+        })
+        self.gmail_service.users().messages().get.assert_not_called()
+        self.gmail_service.users().messages().modify.assert_not_called()
+
+    def test_apply_plan_chunks_batch_modify(self):
+        email_ids = [str(i) for i in range(2500)]
+        plan = {(frozenset({'STARRED', 'IMPORTANT'}), frozenset({'UNREAD'})): email_ids}
+
+        self.rule_processor.apply_plan(plan)
+
+        batch_modify = self.gmail_service.users().messages().batchModify
+        self.assertEqual(batch_modify.call_count, 3)
+        batch_modify.assert_any_call(userId='me', body={'ids': email_ids[2000:], 'addLabelIds': ['IMPORTANT', 'STARRED'],
+                                                        'removeLabelIds': ['UNREAD']})
+        self.assertEqual([len(call.kwargs['body']['ids']) for call in batch_modify.call_args_list], [1000, 1000, 500])
+
+    def test_metrics_record_rule_hits_and_actions(self):
+        metrics = Metrics()
+        rule_processor = RuleProcessor(self.gmail_service, metrics=metrics, rules=[{
+            'predicate': 'All',
+            'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+            'actions': ['move_to_starred']
+        }])
+        self.gmail_service.users().messages().get().execute.return_value = {'labelIds': ['INBOX']}
+
+        rule_processor.apply_rules((1, 'example@example.com', 'test@test.com', 'Test Subject', '2024-06-01'))
+        rule_processor.apply_rules((2, 'example@example.com', 'test@test.com', 'Hello', '2024-06-01'))
+
+        self.assertEqual(metrics.counters['rule_hits_total'], {(('rule', 1),): 1})
+        self.assertEqual(metrics.histograms['rule_evaluation_seconds'][(('rule', 1),)][0], 2)
+        self.assertEqual(metrics.counters['actions_applied_total'], {(('change', 'add'), ('label', 'STARRED')): 1})
+        self.assertEqual(metrics.counters['api_calls_total'], {(('method', 'messages.get'),): 1,
+                                                               (('method', 'messages.modify'),): 1})
+
+    def test_invalid_rules_rejected_at_load_time(self):
+        rules = '[{"predicate": "All", "conditions": [{"field": "subject", "predicate": "starts_with", "value": "Hi"}], "actions": ["archive"]}]'
+        with patch('builtins.open', unittest.mock.mock_open(read_data=rules)):
+            with self.assertRaises(ValueError) as context:
+                RuleProcessor(self.gmail_service)
+
+        self.assertIn('starts_with - Invalid predicate', str(context.exception))
+        self.assertIn('archive - Invalid rule action', str(context.exception))
+
+    def test_execute_rule_actions_invalid(self):
+        with self.assertRaises(ValueError):
+            self.rule_processor._RuleProcessor__execute_rule_actions((1,), ['move_to_trash'])
+
+class TestRuleProcessorLabelStore(unittest.TestCase):
+    def setUp(self):
+        self.gmail_service = MagicMock()
+        self.conn = sqlite3.connect(':memory:')
+        self.label_store = LabelStore(self.conn)
+        self.rule_processor = RuleProcessor(self.gmail_service, self.label_store)
+        self.email = ('1', 'example@example.com', 'test@test.com', 'Test Subject', '2024-06-01')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_add_label_uses_stored_labels(self):
+        self.label_store.set_labels('1', ['INBOX', 'STARRED'])
+        self.rule_processor._RuleProcessor__add_label(self.email, 'STARRED')
+
+        self.gmail_service.users().messages().get.assert_not_called()
+        self.gmail_service.users().messages().modify.assert_not_called()
+
+    def test_add_label_stores_modify_response(self):
+        self.label_store.set_labels('1', ['INBOX'])
+        self.gmail_service.users().messages().modify().execute.return_value = {'id': '1', 'labelIds': ['INBOX', 'STARRED']}
+        self.rule_processor._RuleProcessor__add_label(self.email, 'STARRED')
+
+        self.gmail_service.users().messages().get.assert_not_called()
+        self.assertEqual(self.label_store.get_labels('1'), {'INBOX', 'STARRED'})
+
+    def test_remove_label_fetches_unknown_labels_once(self):
+        self.gmail_service.users().messages().get().execute.return_value = {'labelIds': ['INBOX']}
+        self.gmail_service.users().messages().get.reset_mock()
+        self.rule_processor._RuleProcessor__remove_label(self.email, 'UNREAD')
+        self.rule_processor._RuleProcessor__remove_label(self.email, 'UNREAD')
+
+        self.gmail_service.users().messages().get.assert_called_once_with(userId='me', id='1', format='minimal')
+        self.gmail_service.users().messages().modify.assert_not_called()
+
+    def test_refresh_labels_ignores_stored_labels(self):
+        self.label_store.set_labels('1', ['INBOX'])
+        self.gmail_service.users().messages().get().execute.return_value = {'labelIds': ['INBOX', 'STARRED']}
+        rule_processor = RuleProcessor(self.gmail_service, self.label_store, refresh_labels=True)
+        rule_processor._RuleProcessor__add_label(self.email, 'STARRED')
+
+        self.gmail_service.users().messages().modify.assert_not_called()
+        self.assertEqual(self.label_store.get_labels('1'), {'INBOX', 'STARRED'})
+
+    def test_plan_rules_skips_changes_already_applied(self):
+        self.rule_processor.set_rules([{
+            'predicate': 'All',
+            'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+            'actions': ['mark_as_read', 'move_to_starred']
+        }])
+        self.label_store.set_labels_many([('1', ['INBOX', 'STARRED']), ('2', ['INBOX', 'STARRED', 'UNREAD'])])
+        plan = {}
+        self.rule_processor.plan_rules(self.email, plan)
+        self.rule_processor.plan_rules(('2',) + self.email[1:], plan)
+        self.rule_processor.plan_rules(('3',) + self.email[1:], plan)
+
+        self.assertEqual(plan, {(frozenset(), frozenset({'UNREAD'})): ['2'],
+                                (frozenset({'STARRED'}), frozenset({'UNREAD'})): ['3']})
+
+        self.rule_processor.apply_plan(plan)
+        self.assertEqual(self.label_store.get_labels('2'), {'INBOX', 'STARRED'})
+        self.assertIsNone(self.label_store.get_labels('3'))
+
+    def test_plan_rules_in_database(self):
+        self.rule_processor.set_rules([
+            {
+                'predicate': 'All',
+                'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+                'actions': ['mark_as_unread', 'move_to_starred']
+            },
+            {
+                'predicate': 'Any',
+                'conditions': [{'field': 'from_email', 'predicate': 'equals', 'value': 'boss@example.com'}],
+                'actions': ['mark_as_read']
+            }
+        ])
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT, date_epoch INTEGER)')
+        conn.executemany('INSERT INTO emails VALUES (?, ?, ?, ?, ?, NULL)', [
+            ('1', 'example@example.com', 'test@test.com', 'Test Subject', '2024-06-01'),
+            ('2', 'boss@example.com', 'test@test.com', 'Test Subject', '2024-06-01'),
+            ('3', 'other@example.com', 'test@test.com', 'Test again', '2024-06-01'),
+            ('4', 'other@example.com', 'test@test.com', 'Hello', '2024-06-01')
+        ])
+        plan = {}
+        self.rule_processor.plan_rules_in_database(conn, plan)
+        conn.close()
+
+        self.assertEqual(plan, {
+            (frozenset({'UNREAD', 'STARRED'}), frozenset()): ['1', '3'],
+            (frozenset({'STARRED'}), frozenset({'UNREAD'})): ['2']
+        })
+
+    def test_plan_rules_in_database_times_each_rule_query(self):
+        metrics = Metrics()
+        rule_processor = RuleProcessor(self.gmail_service, metrics=metrics, rules=[
+            {'predicate': 'All', 'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+             'actions': ['move_to_starred']},
+            {'predicate': 'All', 'conditions': [{'field': 'from_email', 'predicate': 'equals', 'value': 'boss@example.com'}],
+             'actions': ['mark_as_read']}
+        ])
+        conn = connect_database(':memory:')
+
+        rule_processor.plan_rules_in_database(conn, {})
+        conn.close()
+
+        self.assertEqual({labels: values[0] for labels, values in metrics.histograms['rule_evaluation_seconds'].items()},
+                         {(('rule', 1),): 1, (('rule', 2),): 1})
+        self.assertEqual(metrics.histograms['db_read_seconds'][(('table', 'emails'),)][0], 2)
+
 class TestEmailProcessor(unittest.TestCase):
     def setUp(self):
         # Mocking the RuleProcessor
@@ -172,7 +294,7 @@ class TestEmailProcessor(unittest.TestCase):
         mock_conn = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
 
-        with unittest.mock.patch('sqlite3.connect', return_value=mock_conn):
+        with unittest.mock.patch('process_emails.connect_database', return_value=mock_conn):
             emails = self.email_processor._EmailProcessor__fetch_emails()
 
         self.assertEqual(len(emails), 1)
@@ -193,6 +315,273 @@ class TestEmailProcessor(unittest.TestCase):
         # Assert that apply_rules method of RuleProcessor is called with the email
         self.rule_processor.apply_rules.assert_called_once_with(emails[0])
 
+    def test_process_emails_planned(self):
+        emails = [(1, 'example@example.com', 'test@test.com', 'Test Subject', '2024-06-01'),
+                  (2, 'example@example.com', 'test@test.com', 'Other Subject', '2024-06-01')]
+        self.email_processor.emails = emails
+        self.email_processor.process_emails_planned()
+
+        self.assertEqual(self.rule_processor.plan_rules.call_count, 2)
+        plan = self.rule_processor.plan_rules.call_args.args[1]
+        self.rule_processor.apply_plan.assert_called_once_with(plan)
+        self.rule_processor.apply_rules.assert_not_called()
+
+
+class TestEmailProcessorStreaming(EmailDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT, date_epoch INTEGER)')
+        conn.executemany(INSERT_EMAIL, [(str(i), 'a@example.com', 'b@example.com', f'Subject {i}', '2024-06-01', 1717200000)
+                                        for i in range(25)])
+        conn.commit()
+        conn.close()
+        self.rule_processor = MagicMock()
+
+    def test_iter_emails_streams_records_in_chunks(self):
+        email_processor = EmailProcessor(self.rule_processor, load_emails=False, chunk_size=10, database_path=self.db_path)
+        self.assertIsNone(email_processor.emails)
+
+        emails = list(email_processor.iter_emails())
+
+        self.assertEqual([email.id for email in emails], [str(i) for i in range(25)])
+        self.assertEqual(emails[3], EmailRecord('3', 'a@example.com', 'b@example.com', 'Subject 3', '2024-06-01', 1717200000))
+
+    def test_process_emails_streaming_reports_progress_at_interval(self):
+        email_processor = EmailProcessor(self.rule_processor, load_emails=False, chunk_size=10, progress_interval=10,
+                                         database_path=self.db_path)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            email_processor.process_emails()
+
+        self.assertEqual(self.rule_processor.apply_rules.call_count, 25)
+        self.assertIn('===== Processed 20 emails', output.getvalue())
+        self.assertEqual(output.getvalue().count('===== Processed'), 2)
+
+    def test_streaming_allows_label_writes_between_chunks(self):
+        labels_conn = sqlite3.connect(self.db_path)
+        label_store = LabelStore(labels_conn)
+        labels_conn.commit()
+        self.rule_processor.apply_rules.side_effect = lambda email: (label_store.set_labels(email.id, ['INBOX']), label_store.commit())
+
+        EmailProcessor(self.rule_processor, load_emails=False, chunk_size=10, database_path=self.db_path).process_emails()
+
+        self.assertEqual(label_store.get_labels('24'), {'INBOX'})
+        labels_conn.close()
+
+class TestRuleProcessorLedger(EmailDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT, date_epoch INTEGER)')
+        self.conn.executemany(INSERT_EMAIL, [(str(i), 'a@example.com', 'b@example.com', f'Test {i}' if i % 2 else f'Hello {i}',
+                                              '2024-06-01', 1717200000) for i in range(6)])
+        self.conn.commit()
+        self.addCleanup(self.conn.close)
+        self.ledger = RuleLedger(self.conn)
+        self.gmail_service = MagicMock()
+        self.gmail_service.users().messages().get().execute.return_value = {'labelIds': ['INBOX']}
+        self.rules = [{
+            'predicate': 'All',
+            'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}],
+            'actions': ['move_to_starred']
+        }]
+
+    def email_processor(self, rules=None):
+        rule_processor = RuleProcessor(self.gmail_service, rules=rules or self.rules, ledger=self.ledger)
+        return EmailProcessor(rule_processor, load_emails=False, chunk_size=2, ledger=self.ledger, database_path=self.db_path)
+
+    def batch_modified_ids(self):
+        batch_modify = self.gmail_service.users().messages().batchModify
+        return sorted(email_id for call in batch_modify.call_args_list for email_id in call.kwargs['body']['ids'])
+
+    def test_plan_mode_skips_emails_on_rerun(self):
+        with redirect_stdout(io.StringIO()):
+            self.email_processor().process_emails_planned()
+            self.assertEqual(self.batch_modified_ids(), ['1', '3', '5'])
+
+            email_processor = self.email_processor()
+            self.assertEqual(list(email_processor.iter_emails()), [])
+            email_processor.process_emails_planned()
+        self.assertEqual(self.batch_modified_ids(), ['1', '3', '5'])
+
+    def test_query_mode_reprocesses_edited_rules(self):
+        edited_rules = [dict(self.rules[0], actions=['move_to_important'])]
+        with redirect_stdout(io.StringIO()):
+            self.email_processor().process_emails_in_database()
+            self.email_processor().process_emails_in_database()
+            self.assertEqual(self.batch_modified_ids(), ['1', '3', '5'])
+
+            self.email_processor(edited_rules).process_emails_in_database()
+        self.assertEqual(self.batch_modified_ids(), ['1', '1', '3', '3', '5', '5'])
+
+    def test_immediate_mode_resumes_after_interruption(self):
+        modify = self.gmail_service.users().messages().modify
+        modify.return_value.execute.side_effect = [{}, RuntimeError('connection lost')]
+        with redirect_stdout(io.StringIO()), self.assertRaises(RuntimeError):
+            self.email_processor().process_emails()
+
+        modify.reset_mock()
+        modify.return_value.execute.side_effect = None
+        modify.return_value.execute.return_value = {}
+        with redirect_stdout(io.StringIO()):
+            self.email_processor().process_emails()
+
+        self.assertEqual([call.kwargs['id'] for call in modify.call_args_list], ['3', '5'])
+
+    def test_ledger_is_committed_before_gmail_calls(self):
+        in_transaction = []
+        def execute():
+            in_transaction.append(self.conn.in_transaction)
+            return {}
+        self.gmail_service.users().messages().batchModify.return_value.execute.side_effect = execute
+        self.gmail_service.users().messages().modify.return_value.execute.side_effect = execute
+        with redirect_stdout(io.StringIO()):
+            self.email_processor().process_emails_planned()
+            self.email_processor([dict(self.rules[0], actions=['move_to_important'])]).process_emails()
+
+        # Other writers, like a running fetch, would wait on an open write transaction until they time out
+        self.assertEqual(in_transaction, [False] * 4)
+
+    def test_unmatched_date_rules_stay_pending(self):
+        rules = [{
+            'predicate': 'All',
+            'conditions': [{'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'}],
+            'actions': ['move_to_starred']
+        }]
+        with redirect_stdout(io.StringIO()):
+            self.email_processor(rules).process_emails_planned()
+
+        # Whether a date condition matches changes as emails age, so non-matches are never recorded
+        self.assertEqual(len(list(self.email_processor(rules).iter_emails())), 6)
+
+class TestRuleProcessorBodies(EmailDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.conn = self.connect()
+        self.conn.executemany(INSERT_EMAIL, [(str(i), 'a@example.com', 'b@example.com', f'Subject {i}', '2024-06-01', 1717200000)
+                                             for i in range(6)])
+        # Email 5 was fetched without its body
+        BodyStore(self.conn).set_bodies_many((str(i), 'Unsubscribe here' if i % 2 else 'Invoice attached') for i in range(5))
+        self.conn.commit()
+        self.gmail_service = MagicMock()
+        self.rules = [
+            {'predicate': 'All', 'conditions': [{'field': 'body', 'predicate': 'contains', 'value': 'Unsubscribe'}],
+             'actions': ['mark_as_read']},
+            {'predicate': 'Any', 'conditions': [{'field': 'subject', 'predicate': 'equals', 'value': 'Subject 0'}],
+             'actions': ['move_to_starred']},
+            {'predicate': 'All', 'conditions': [{'field': 'body', 'predicate': 'does_not_contains', 'value': 'Unsubscribe'}],
+             'actions': ['move_to_important']},
+        ]
+
+    def plan(self, mode):
+        rule_processor = RuleProcessor(self.gmail_service, rules=self.rules, body_store=BodyStore(self.conn))
+        email_processor = EmailProcessor(rule_processor, load_emails=False, chunk_size=4, database_path=self.db_path)
+        plan = {}
+        if mode == 'query':
+            rule_processor.plan_rules_in_database(self.conn, plan, chunk_size=4)
+        else:
+            for email in email_processor.iter_emails():
+                rule_processor.plan_rules(email, plan)
+        return plan
+
+    def test_bodies_are_decompressed_once_per_email(self):
+        with patch('helpers.body_store.decompress_body', side_effect=lambda blob: zlib.decompress(blob).decode()) as decompress:
+            plan = self.plan('plan')
+
+        # Two body rules look at every email, but each stored body is decompressed once
+        self.assertEqual(decompress.call_count, 5)
+        self.assertEqual(plan, {
+            (frozenset(['STARRED', 'IMPORTANT']), frozenset()): ['0'],
+            (frozenset(), frozenset(['UNREAD'])): ['1', '3'],
+            (frozenset(['IMPORTANT']), frozenset()): ['2', '4'],
+        })
+
+    def test_query_mode_evaluates_body_rules_in_python(self):
+        self.assertEqual(self.plan('query'), self.plan('plan'))
+
+    def test_body_rules_stay_pending_for_emails_without_a_body(self):
+        ledger = RuleLedger(self.conn)
+        for mode in ('query', 'plan'):
+            ledger.clear()
+            rule_processor = RuleProcessor(self.gmail_service, rules=self.rules, ledger=ledger, body_store=BodyStore(self.conn))
+            if mode == 'query':
+                rule_processor.plan_rules_in_database(self.conn, {}, chunk_size=4)
+            else:
+                email_processor = EmailProcessor(rule_processor, load_emails=False, ledger=ledger, database_path=self.db_path)
+                for email in email_processor.iter_emails():
+                    rule_processor.plan_rules(email, {})
+
+            # The body of email 5 may still be fetched with --raw, so no body rule is done with it
+            body_rule_hashes = [rule_processor.rule_hashes[0], rule_processor.rule_hashes[2]]
+            self.assertEqual(ledger.done_rules('5', body_rule_hashes), set(), mode)
+            self.assertEqual(ledger.done_rules('1', body_rule_hashes), {body_rule_hashes[1]}, mode)
+
+class TestEmailProcessorParallel(unittest.TestCase):
+    def setUp(self):
+        # Worker processes open email_database.db relative to the working directory
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.temp_dir.name)
+
+        conn = sqlite3.connect('email_database.db')
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, from_email TEXT, to_email TEXT, subject TEXT, date_received TEXT, date_epoch INTEGER)')
+        now_epoch = int(datetime.now().timestamp())
+        conn.executemany(INSERT_EMAIL, [
+            (f'msg{i}', f'user{i % 5}@example.com', 'me@example.com', ['Invoice', 'Report', 'Hello'][i % 3],
+             '', now_epoch - (i % 40) * 86400)
+            for i in range(200)
+        ])
+        conn.commit()
+        conn.close()
+
+        rules = [
+            {'predicate': 'All', 'conditions': [
+                {'field': 'subject', 'predicate': 'equals', 'value': 'Invoice'},
+                {'field': 'date_received', 'predicate': 'less_than', 'value': '10 days'}
+            ], 'actions': ['move_to_starred', 'mark_as_unread']},
+            {'predicate': 'Any', 'conditions': [
+                {'field': 'from_email', 'predicate': 'contains', 'value': 'user3'},
+                {'field': 'date_received', 'predicate': 'greater_than', 'value': '1 months'}
+            ], 'actions': ['mark_as_read']}
+        ]
+        self.gmail_service = MagicMock()
+        self.rule_processor = RuleProcessor(self.gmail_service, rules=rules)
+
+    def test_rowid_ranges_cover_table(self):
+        email_processor = EmailProcessor(self.rule_processor, load_emails=False)
+        ranges = email_processor._EmailProcessor__rowid_ranges(3)
+
+        self.assertEqual(ranges, [(0, 67), (67, 134), (134, 200)])
+        emails = [email.id for shard in ranges for email in email_processor.iter_emails(*shard)]
+        self.assertEqual(emails, [f'msg{i}' for i in range(200)])
+
+    def test_process_emails_parallel_matches_sequential_plan(self):
+        email_processor = EmailProcessor(self.rule_processor, load_emails=False, chunk_size=16)
+        sequential_plan = {}
+        for email in email_processor.iter_emails():
+            self.rule_processor.plan_rules(email, sequential_plan)
+
+        with patch.object(self.rule_processor, 'apply_plan') as mock_apply_plan:
+            email_processor.process_emails_parallel(workers=2)
+
+        self.assertTrue(sequential_plan)
+        mock_apply_plan.assert_called_once_with(sequential_plan)
+
+class TestParseArgs(unittest.TestCase):
+    def test_workers_with_plan_mode(self):
+        args = parse_args(['--mode', 'plan', '--workers', '4'])
+
+        self.assertEqual((args.mode, args.workers), ('plan', 4))
+
+    def test_workers_rejected_outside_plan_mode(self):
+        for argv in [['--workers', '4'], ['--mode', 'immediate', '--workers', '2']]:
+            with self.subTest(argv=argv), redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                parse_args(argv)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from datetime import datetime
+from helpers.email_database import connect_database, parse_date_epoch
+from helpers.query_planner import rule_query
+from helpers.rule_compiler import compile_conditions
+
+# Test emails only fill the original columns, the headers added later stay NULL
+INSERT_EMAIL = ('INSERT INTO emails (id, from_email, to_email, subject, date_received, date_epoch) '
+                'VALUES (?, ?, ?, ?, ?, ?)')
+
+class TestQueryPlanner(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2024, 6, 30, 12, 0, 0)
+        self.conn = connect_database(':memory:')
+        dates = ['2024-06-29 10:00:00', '2024-06-01 10:00:00', '2024-03-01 10:00:00', 'not a date']
+        self.emails = [
+            (str(i), f'user{i % 3}@Example.com', 'me@example.com' if i % 2 else 'other@example.com',
+             ['Invoice 42', 'Weekly report', 'invoice reminder', ''][i % 4], dates[i % 4], parse_date_epoch(dates[i % 4]))
+            for i in range(24)
+        ]
+        self.conn.executemany(INSERT_EMAIL, self.emails)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def assert_same_matches(self, rule):
+        sql, params = rule_query(rule, self.now)
+        sql_ids = [row[0] for row in self.conn.execute(sql, params)]
+        matches = compile_conditions(rule, self.now)
+        python_ids = [email[0] for email in self.emails if matches(email)]
+        self.assertEqual(sql_ids, python_ids)
+        return sql_ids
+
+    def test_rule_query(self):
+        rule = {'predicate': 'All', 'conditions': [
+            {'field': 'from_email', 'predicate': 'equals', 'value': 'user1@Example.com'},
+            {'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'}
+        ]}
+        self.assertEqual(rule_query(rule, self.now), (
+            'SELECT id FROM emails WHERE (from_email = ?) AND (date_epoch > ?) ORDER BY rowid',
+            ['user1@Example.com', int(self.now.timestamp()) - 2 * 86400]))
+
+    def test_rule_query_matches_python_evaluation(self):
+        for predicate in ('All', 'Any'):
+            for conditions in [
+                [{'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'}],
+                [{'field': 'subject', 'predicate': 'does_not_contains', 'value': 'Invoice'}],
+                [{'field': 'to_email', 'predicate': 'does_not_equals', 'value': 'me@example.com'},
+                 {'field': 'from_email', 'predicate': 'contains', 'value': 'user2'}],
+                [{'field': 'date_received', 'predicate': 'greater_than', 'value': '1 months'},
+                 {'field': 'subject', 'predicate': 'equals', 'value': 'Weekly report'}],
+                [{'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'},
+                 {'field': 'from_email', 'predicate': 'does_not_contains', 'value': 'example'}]
+            ]:
+                with self.subTest(predicate=predicate, conditions=conditions):
+                    self.assert_same_matches({'predicate': predicate, 'conditions': conditions})
+
+    def test_size_conditions_and_body_rules(self):
+        rule = {'predicate': 'Any', 'conditions': [
+            {'field': 'size', 'predicate': 'greater_than', 'value': 1024},
+            {'field': 'list_id', 'predicate': 'contains', 'value': 'news'}
+        ]}
+        self.assertEqual(rule_query(rule, self.now), (
+            'SELECT id FROM emails WHERE (size > ?) OR (instr(list_id, ?) > 0) ORDER BY rowid', [1024, 'news']))
+        # Bodies are stored compressed, so rules on them are left to python
+        rule['conditions'].append({'field': 'body', 'predicate': 'contains', 'value': 'unsubscribe'})
+        self.assertIsNone(rule_query(rule, self.now))
+
+    def test_contains_is_case_sensitive(self):
+        rule = {'predicate': 'All', 'conditions': [{'field': 'from_email', 'predicate': 'contains', 'value': 'example'}]}
+        self.assertEqual(self.assert_same_matches(rule), [])
+
+    def test_rule_query_ignore_case(self):
+        rule = {'predicate': 'All', 'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'INVOICE'}]}
+        sql, params = rule_query(rule, self.now, ignore_case=True)
+
+        self.assertEqual(sql, 'SELECT id FROM emails WHERE (instr(unicode_lower(subject), ?) > 0) ORDER BY rowid')
+        ids = [row[0] for row in self.conn.execute(sql, params)]
+        self.assertEqual(ids, [email[0] for email in self.emails if 'invoice' in email[3].lower()])
+
+    def test_rule_query_ignore_case_folds_non_ascii_letters(self):
+        self.conn.execute(INSERT_EMAIL, ('99', 'bank@example.com', 'me@example.com', 'ÜBERWEISUNG eingegangen', '', None))
+        rule = {'predicate': 'All', 'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'überweisung'}]}
+
+        self.assertEqual([row[0] for row in self.conn.execute(*rule_query(rule, self.now, ignore_case=True))], ['99'])
+
+if __name__ == '__main__':
+    unittest.main()
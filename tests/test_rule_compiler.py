@@ -0,0 +1,180 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from helpers.rule_compiler import (compile_condition, compile_conditions, compile_rule, compile_rules, parse_age, rule_hash,
+                                   validate_rule, validate_rules)
+
+class TestRuleCompiler(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2024, 6, 30, 12, 0, 0)
+        self.email = ('1', 'alice@example.com', 'bob@example.com', 'Weekly Report', '2024-06-29 10:00:00')
+
+    def test_parse_age(self):
+        self.assertEqual(parse_age('2 days'), timedelta(days=2))
+        self.assertEqual(parse_age('3 months'), timedelta(days=90))
+        with self.assertRaises(ValueError):
+            parse_age('2 weeks')
+        with self.assertRaises(ValueError):
+            parse_age('two days')
+
+    def test_validate_rule_reports_every_problem(self):
+        rule = {
+            'predicate': 'Some',
+            'conditions': [
+                {'field': 'bcc', 'predicate': 'equals', 'value': 'x'},
+                {'field': 'date_received', 'predicate': 'contains', 'value': '2 weeks'},
+                {'field': 'size', 'predicate': 'contains', 'value': '10'}
+            ],
+            'actions': ['mark_as_read', 'archive']
+        }
+        self.assertEqual(validate_rule(rule), [
+            "Some - Invalid rule predicate. Use 'All' or 'Any'.",
+            "bcc - Invalid field.",
+            "contains - Invalid predicate for date type field.",
+            "2 weeks - Invalid time unit in predicate value. Use 'days' or 'months'.",
+            "contains - Invalid predicate for number type field.",
+            "10 - Invalid value for number type field, expected an integer.",
+            "archive - Invalid rule action."
+        ])
+
+    def condition_matches(self, email, field, predicate, value):
+        return compile_condition({'field': field, 'predicate': predicate, 'value': value}, self.now)(email)
+
+    def rule_with_condition(self, field, predicate, value):
+        return {'predicate': 'All', 'conditions': [{'field': field, 'predicate': predicate, 'value': value}],
+                'actions': ['mark_as_read']}
+
+    def test_conditions_read_their_field(self):
+        for field, value in zip(('id', 'from_email', 'to_email', 'subject'), self.email):
+            self.assertTrue(self.condition_matches(self.email, field, 'equals', value))
+            self.assertFalse(self.condition_matches(self.email, field, 'equals', 'Python'))
+
+    def test_string_conditions(self):
+        email = ('1', 'alice@example.com', 'bob@example.com', 'Hello World', '')
+        self.assertTrue(self.condition_matches(email, 'subject', 'contains', 'World'))
+        self.assertFalse(self.condition_matches(email, 'subject', 'contains', 'Python'))
+        self.assertTrue(self.condition_matches(email, 'subject', 'does_not_contains', 'Python'))
+        self.assertFalse(self.condition_matches(email, 'subject', 'does_not_contains', 'World'))
+        self.assertTrue(self.condition_matches(email, 'subject', 'equals', 'Hello World'))
+        self.assertFalse(self.condition_matches(email, 'subject', 'equals', 'Hello'))
+        self.assertTrue(self.condition_matches(email, 'subject', 'does_not_equals', 'Python'))
+        self.assertFalse(self.condition_matches(email, 'subject', 'does_not_equals', 'Hello World'))
+
+    def test_invalid_string_predicate_rejected(self):
+        with self.assertRaises(ValueError):
+            validate_rules([self.rule_with_condition('subject', 'invalid_predicate', 'Python')])
+
+    def test_date_conditions(self):
+        day_old = ('1', 'a', 'b', 'c', '', int((self.now - timedelta(days=1)).timestamp()))
+        self.assertTrue(self.condition_matches(day_old, 'date_received', 'less_than', '2 days'))
+        self.assertFalse(self.condition_matches(day_old, 'date_received', 'less_than', '1 days'))
+        in_two_months = ('1', 'a', 'b', 'c', '', int((self.now + timedelta(days=60)).timestamp()))
+        self.assertFalse(self.condition_matches(in_two_months, 'date_received', 'greater_than', '1 months'))
+
+    def test_invalid_date_predicate_rejected(self):
+        with self.assertRaises(ValueError):
+            validate_rules([self.rule_with_condition('date_received', 'invalid_predicate', '2 days')])
+
+    def test_compiled_rule_all_and_any_predicates(self):
+        conditions = [{'field': 'from_email', 'predicate': 'equals', 'value': 'another@example.com'},
+                      {'field': 'subject', 'predicate': 'contains', 'value': 'Report'}]
+        rule = {'predicate': 'All', 'conditions': conditions, 'actions': ['mark_as_read']}
+
+        self.assertFalse(compile_rule(rule, self.now).matches(self.email))
+        self.assertTrue(compile_rule(dict(rule, predicate='Any'), self.now).matches(self.email))
+        self.assertTrue(compile_rule(dict(rule, conditions=conditions[1:]), self.now).matches(self.email))
+
+    def test_compile_rules_raises_with_rule_numbers(self):
+        valid_rule = {'predicate': 'Any', 'conditions': [{'field': 'subject', 'predicate': 'equals', 'value': 'Hi'}],
+                      'actions': ['mark_as_read']}
+        with self.assertRaises(ValueError) as context:
+            compile_rules([valid_rule, dict(valid_rule, actions=['archive'])])
+        self.assertIn('Rule 2: archive - Invalid rule action.', str(context.exception))
+
+    def test_compiled_rule_matches(self):
+        rules = [
+            {'predicate': 'All', 'conditions': [
+                {'field': 'from_email', 'predicate': 'contains', 'value': 'alice'},
+                {'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'}
+            ], 'actions': ['mark_as_read', 'move_to_starred']},
+            {'predicate': 'Any', 'conditions': [
+                {'field': 'subject', 'predicate': 'equals', 'value': 'Invoice'},
+                {'field': 'date_received', 'predicate': 'greater_than', 'value': '1 months'}
+            ], 'actions': ['move_to_spam']}
+        ]
+        first, second = compile_rules(rules, now=self.now)
+
+        self.assertTrue(first.matches(self.email))
+        self.assertFalse(second.matches(self.email))
+        self.assertEqual(first.label_changes, [('UNREAD', False), ('STARRED', True)])
+
+    def test_rule_hash_follows_rule_content(self):
+        rule = {'predicate': 'Any', 'conditions': [{'field': 'subject', 'predicate': 'equals', 'value': 'Hi'}],
+                'actions': ['mark_as_read']}
+        reordered = {'actions': ['mark_as_read'], 'predicate': 'Any',
+                     'conditions': [{'value': 'Hi', 'predicate': 'equals', 'field': 'subject'}]}
+
+        self.assertEqual(rule_hash(rule), rule_hash(reordered))
+        self.assertNotEqual(rule_hash(rule), rule_hash(dict(rule, actions=['move_to_starred'])))
+        compiled_rule, = compile_rules([rule])
+        self.assertEqual(compiled_rule.hash, rule_hash(rule))
+        self.assertFalse(compiled_rule.time_dependent)
+
+    def test_conditions_short_circuit_cheapest_first(self):
+        rule = {'predicate': 'All', 'conditions': [
+            {'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'},
+            {'field': 'subject', 'predicate': 'equals', 'value': 'Invoice'}
+        ]}
+        matches = compile_conditions(rule, now=self.now)
+
+        with patch('helpers.rule_compiler.email_epoch') as mock_email_epoch:
+            self.assertFalse(matches(self.email))
+        # The subject check fails first, so the date is never looked at
+        mock_email_epoch.assert_not_called()
+
+    def test_date_conditions_use_stored_epoch(self):
+        rule = {'predicate': 'All', 'conditions': [{'field': 'date_received', 'predicate': 'less_than', 'value': '2 days'}]}
+        matches = compile_conditions(rule, now=self.now)
+        recent_epoch = int(self.now.timestamp()) - 3600
+        old_epoch = int(self.now.timestamp()) - 3 * 86400
+
+        with patch('helpers.rule_compiler.parse_date_epoch') as mock_parse_date_epoch:
+            # The stored epoch wins over the Date header
+            self.assertTrue(matches(('1', 'a', 'b', 'c', 'Mon, 01 Jan 2001 00:00:00 GMT', recent_epoch)))
+            self.assertFalse(matches(('1', 'a', 'b', 'c', 'Mon, 01 Jan 2001 00:00:00 GMT', old_epoch)))
+        mock_parse_date_epoch.assert_not_called()
+
+        # Rows without a stored epoch fall back to parsing, unparseable dates never match
+        self.assertTrue(matches(self.email))
+        self.assertFalse(matches(('1', 'a', 'b', 'c', 'not a date', None)))
+
+    def test_extra_header_and_size_conditions(self):
+        rule = {'predicate': 'All', 'conditions': [
+            {'field': 'list_id', 'predicate': 'contains', 'value': 'news.example.io'},
+            {'field': 'size', 'predicate': 'greater_than', 'value': 1000}
+        ]}
+        matches = compile_conditions(rule, now=self.now)
+
+        self.assertTrue(matches(self.email + (None, '', '<news.example.io>', 2048)))
+        self.assertFalse(matches(self.email + (None, '', '<news.example.io>', 512)))
+        # Emails of unknown size match no size condition
+        self.assertFalse(matches(self.email + (None, '', '<news.example.io>', None)))
+
+    def test_body_conditions_are_checked_last_and_need_a_body(self):
+        rule = {'predicate': 'All', 'conditions': [
+            {'field': 'body', 'predicate': 'does_not_contains', 'value': 'unsubscribe'},
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Report'}
+        ], 'actions': ['mark_as_read']}
+        bodies = {'1': 'Numbers are up this week.'}
+        body_of = MagicMock(side_effect=lambda email: bodies.get(email[0]))
+        compiled_rule, = compile_rules([rule], now=self.now, body_of=body_of)
+
+        self.assertTrue(compiled_rule.needs_body)
+        self.assertFalse(compiled_rule.matches(('1', 'a', 'b', 'Invoice', '')))
+        body_of.assert_not_called()
+        self.assertTrue(compiled_rule.matches(self.email))
+        # An email without a body matches no body condition, not even a negative one
+        self.assertFalse(compiled_rule.matches(('2',) + self.email[1:]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import sqlite3
+import unittest
+from helpers.rule_ledger import RuleLedger
+
+class TestRuleLedger(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY)')
+        self.conn.executemany('INSERT INTO emails VALUES (?)', [('1',), ('2',), ('3',)])
+        self.ledger = RuleLedger(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_record_and_done_rules(self):
+        self.ledger.record('1', ['rule_a', 'rule_b'])
+        self.ledger.record_many([('2', 'rule_a'), ('2', 'rule_a')])
+
+        self.assertEqual(self.ledger.done_rules('1', ['rule_a', 'rule_b', 'rule_c']), {'rule_a', 'rule_b'})
+        self.assertEqual(self.ledger.done_rules('2', ['rule_b']), set())
+        self.assertEqual(self.ledger.done_rules('3', ['rule_a']), set())
+
+    def test_pending_and_not_done_conditions(self):
+        self.ledger.record('1', ['rule_a', 'rule_b'])
+        self.ledger.record('2', ['rule_a'])
+
+        sql, params = self.ledger.pending_condition(['rule_a', 'rule_b'])
+        self.assertEqual([row[0] for row in self.conn.execute(f'SELECT id FROM emails WHERE {sql}', params)], ['2', '3'])
+        sql, params = self.ledger.not_done_condition('rule_a')
+        self.assertEqual([row[0] for row in self.conn.execute(f'SELECT id FROM emails WHERE {sql}', params)], ['3'])
+
+    def test_prune_forgets_removed_rules(self):
+        self.ledger.prune(['rule_a', 'rule_b'])
+        self.ledger.record('1', ['rule_a', 'rule_b'])
+        self.ledger.prune(['rule_a', 'rule_c'])
+
+        self.assertEqual(self.ledger.done_rules('1', ['rule_a', 'rule_b', 'rule_c']), {'rule_a'})
+        self.assertEqual({row[0] for row in self.conn.execute('SELECT rule_hash FROM rule_ledger_rules')}, {'rule_a', 'rule_c'})
+
+    def test_forget_emails(self):
+        self.ledger.record('1', ['rule_a', 'rule_b'])
+        self.ledger.record('2', ['rule_a'])
+        self.ledger.forget_emails(['1', '3'])
+
+        self.assertEqual(self.ledger.done_rules('1', ['rule_a', 'rule_b']), set())
+        self.assertEqual(self.ledger.done_rules('2', ['rule_a']), {'rule_a'})
+
+    def test_clear(self):
+        self.ledger.record('1', ['rule_a'])
+        self.ledger.clear()
+
+        self.assertEqual(self.ledger.done_rules('1', ['rule_a']), set())
+
+if __name__ == '__main__':
+    unittest.main()